@@ -0,0 +1,151 @@
+import threading
+import time
+
+
+class AdaptiveController:
+    """
+    闭环自适应码率/画质控制器。
+
+    持续观察编码耗时、各客户端的发送耗时、最拥塞客户端的拥塞等级和单个客户端收到的帧大小，
+    按"乘性降低、加性恢复"的方式调整 JPEG质量、缩放比例和目标FPS，
+    使端到端延迟和每个客户端的带宽保持在目标值以内。
+
+    带宽按单个客户端计算（每个客户端只收一路画面流），观看人数增加本身不会触发降级。
+    拥塞等级来自各客户端的发送积压检测（见 client_sender），单个客户端轻度拥塞时
+    先由它自己降档位/抽帧，达到 CONGESTED_LEVEL 才降低所有人的画质。
+
+    降级顺序：质量 → 分辨率 → 帧率；恢复顺序相反（先恢复帧率，最后恢复质量）。
+    """
+
+    # 调节范围
+    MIN_QUALITY, MAX_QUALITY = 20, 80
+    MIN_SCALE, MAX_SCALE = 0.3, 1.0
+    MIN_FPS, MAX_FPS = 5, 30
+
+    # 最拥塞的客户端达到此等级（已降档位且抽帧）时视为整体拥塞
+    CONGESTED_LEVEL = 2
+
+    def __init__(self, fps=20, quality=30, scale_factor=0.5,
+                 target_latency_ms=100, target_bandwidth_kbps=20000, adjust_interval=0.5):
+        self.fps = fps
+        self.quality = quality
+        self.scale_factor = scale_factor
+
+        self.target_latency = target_latency_ms / 1000.0
+        self.target_bandwidth = target_bandwidth_kbps * 1000 / 8  # 字节/秒
+        self.adjust_interval = adjust_interval
+
+        self.lock = threading.Lock()
+        self._reset_window()
+        self.last_adjust_time = time.time()
+
+        # 最近一次调节时的测量值，供性能面板显示
+        self.last_measurement = {}
+
+    def _reset_window(self):
+        """清空当前统计窗口"""
+        self.encode_times = []
+        self.frame_sizes = []
+        self.send_times = []
+        self.max_congestion = 0
+
+    def record_encode(self, encode_time, frame_size, congestion):
+        """
+        记录一帧的截图+编码耗时、单个客户端收到的帧大小，以及当时最拥塞客户端的拥塞等级。
+
+        Args:
+            frame_size (int): 各画面流中最大的负载（字节），不是所有画面流之和。
+            congestion (int): 所有客户端中最高的拥塞等级，没有客户端时为0。
+        """
+        with self.lock:
+            self.encode_times.append(encode_time)
+            self.frame_sizes.append(frame_size)
+            self.max_congestion = max(self.max_congestion, congestion)
+
+    def record_send(self, send_time):
+        """记录单个客户端完成一帧发送的耗时"""
+        with self.lock:
+            self.send_times.append(send_time)
+
+    def update(self):
+        """到达调节间隔时根据统计窗口调整参数，返回是否发生了调整"""
+        now = time.time()
+        elapsed = now - self.last_adjust_time
+        if elapsed < self.adjust_interval:
+            return False
+
+        with self.lock:
+            encode_times, frame_sizes, send_times = self.encode_times, self.frame_sizes, self.send_times
+            congestion = self.max_congestion
+            self._reset_window()
+        self.last_adjust_time = now
+
+        if not encode_times:
+            return False
+
+        frame_budget = 1.0 / self.fps
+        encode_time = sum(encode_times) / len(encode_times)
+        # 取最慢的发送耗时，保证所有客户端都不积压
+        send_time = max(send_times) if send_times else 0.0
+        bandwidth = sum(frame_sizes) / elapsed
+        latency = encode_time + send_time
+
+        self.last_measurement = {
+            "encode_ms": encode_time * 1000,
+            "send_ms": send_time * 1000,
+            "bandwidth_kbps": bandwidth * 8 / 1000,
+            "congestion": congestion,
+        }
+
+        congested = (
+            latency > self.target_latency
+            or bandwidth > self.target_bandwidth
+            or encode_time > frame_budget
+            or congestion >= self.CONGESTED_LEVEL
+        )
+        headroom = (
+            latency < self.target_latency * 0.5
+            and bandwidth < self.target_bandwidth * 0.7
+            and encode_time < frame_budget * 0.6
+            and congestion == 0
+        )
+
+        if congested:
+            return self._decrease()
+        if headroom:
+            return self._increase()
+        return False
+
+    def _decrease(self):
+        """乘性降低：依次降低质量、分辨率、帧率"""
+        if self.quality > self.MIN_QUALITY:
+            self.quality = max(self.MIN_QUALITY, int(self.quality * 0.8))
+        elif self.scale_factor > self.MIN_SCALE:
+            self.scale_factor = max(self.MIN_SCALE, round(self.scale_factor * 0.85, 2))
+        elif self.fps > self.MIN_FPS:
+            self.fps = max(self.MIN_FPS, int(self.fps * 0.8))
+        else:
+            return False
+        return True
+
+    def _increase(self):
+        """加性恢复：依次恢复帧率、分辨率、质量"""
+        if self.fps < self.MAX_FPS:
+            self.fps = min(self.MAX_FPS, self.fps + 1)
+        elif self.scale_factor < self.MAX_SCALE:
+            self.scale_factor = min(self.MAX_SCALE, round(self.scale_factor + 0.05, 2))
+        elif self.quality < self.MAX_QUALITY:
+            self.quality = min(self.MAX_QUALITY, self.quality + 2)
+        else:
+            return False
+        return True
+
+    def state(self):
+        """返回当前参数和最近一次的测量值"""
+        info = {
+            "fps": self.fps,
+            "quality": self.quality,
+            "scale_factor": self.scale_factor,
+        }
+        info.update(self.last_measurement)
+        return info
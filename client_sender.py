@@ -0,0 +1,347 @@
+"""
+每个客户端一个常驻发送线程。
+
+原先发送线程每帧为每个客户端新建一个线程并等待 50ms，30个观看端、20 FPS 时
+每秒要创建600个线程，慢客户端遗留的线程还会越积越多。
+
+ClientSender 为每个客户端保留一个"最新帧"槽位：发送端只是把新帧放进槽位并唤醒
+线程，立即返回；客户端发得慢时，槽位中尚未发出的旧帧直接被新帧替换，只影响它自己。
+槽位逻辑在 FrameSlot 中，selectors 后端（network_selector）的连接也复用它。
+
+FrameSlot 还按各自的发送耗时、丢帧和套接字发送队列积压（Linux 上用 SIOCOUTQNSD / SIOCOUTQ 读取）
+判断该客户端是否拥塞，拥塞等级由发送端换算成抽帧间隔和更低的画面档位。
+"""
+import socket
+import struct
+import threading
+import time
+
+from frame_protocol import send_frame, is_keyframe
+from frame_pool import PooledBuffer, release_payload
+
+try:
+    import fcntl
+    import termios
+    SIOCOUTQ = termios.TIOCOUTQ  # Linux 上与 SIOCOUTQ 是同一个请求号
+    OUTQ_AVAILABLE = True
+except (ImportError, AttributeError):
+    OUTQ_AVAILABLE = False
+# TCP 尚未发出的字节数（Linux 2.6.38+）。SIOCOUTQ 还包括已发出、等待确认的字节，
+# 延迟确认会让畅通的连接也显得有积压
+SIOCOUTQNSD = 0x894B
+
+# 拥塞等级 → (降低的画面档位数, 抽帧倍数)
+CONGESTION_LEVELS = [(0, 1), (0, 2), (1, 2), (2, 4)]
+CONGESTION_RAISE_DELAY = 0.5    # 持续拥塞这么久（秒）后升一级
+CONGESTION_RECOVER_DELAY = 5.0  # 持续畅通这么久（秒）后降一级
+BACKLOG_MIN_BYTES = 32 * 1024   # 发送积压至少超过这么多字节才记为拥塞（低分辨率画面每帧只有几KB）
+
+
+def socket_backlog(sock):
+    """
+    套接字发送队列中尚未发出的字节数。
+
+    TCP 用 SIOCOUTQNSD，不含已发出、等待确认的字节；内核不支持时退回 SIOCOUTQ。
+
+    Returns:
+        int: 字节数；平台不支持或套接字已关闭时返回None。
+    """
+    if not OUTQ_AVAILABLE or sock is None:
+        return None
+    try:
+        if sock.type == socket.SOCK_STREAM:
+            try:
+                return struct.unpack('i', fcntl.ioctl(sock.fileno(), SIOCOUTQNSD, b'\0\0\0\0'))[0]
+            except OSError:
+                pass
+        return struct.unpack('i', fcntl.ioctl(sock.fileno(), SIOCOUTQ, b'\0\0\0\0'))[0]
+    except (OSError, ValueError):
+        return None
+
+
+class FrameSlot:
+    """
+    单个客户端的最新帧槽位及发送统计，由具体的发送方式（线程 / 事件循环）继承。
+
+    丢弃过帧（或刚连接）的客户端缺少差分基准，在收到下一个关键帧之前跳过差分帧，
+    并通过 on_dropped 回调请求编码端尽快发送关键帧。
+    """
+
+    def __init__(self, addr, on_sent=None, on_closed=None, on_dropped=None):
+        self.addr = addr
+        self.on_sent = on_sent          # on_sent(sender, send_time)
+        self.on_closed = on_closed      # on_closed(sender)，发送失败时调用
+        self.on_dropped = on_dropped    # on_dropped(sender)，替换掉未发出的帧时调用
+
+        self.cond = threading.Condition()
+        self.pending = None
+        self.running = True
+        self.needs_keyframe = True
+        self.last_keyframe_request = 0.0  # 上次因丢帧请求关键帧的时间，由调用方维护
+        self.protocol_version = 1  # 握手协商的协议版本，v2观看端的画面带帧头
+
+        # 统计信息
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.frames_skipped = 0
+        self.bytes_sent = 0
+        self.last_send_time = 0.0
+        self.avg_send_time = 0.0
+
+        # 拥塞检测
+        self.congestion = 0             # CONGESTION_LEVELS 的下标
+        self.backlog = None             # 最近一次检测到的发送积压（字节）
+        self._checked_dropped = 0
+        self._congestion_score = 0.0    # 最近拥塞比例的指数平均
+        self._congestion_changed = time.time()
+
+    def submit(self, payload):
+        """
+        将一帧放入最新帧槽位并通知发送方，立即返回。
+
+        payload 为池缓冲区时由本方法增加一个引用，发送完毕或被替换后释放。
+        零长度的保活消息不会替换尚未发出的画面。
+
+        Returns:
+            bool: 是否放入了槽位。
+        """
+        keepalive = len(payload) == 0
+        if isinstance(payload, PooledBuffer):
+            payload.retain()
+
+        replaced_frame = False
+        with self.cond:
+            if not self.running or (keepalive and self.pending is not None):
+                dropped, accepted = payload, False
+            else:
+                dropped, accepted = self.pending, True
+                self.pending = payload
+                self._wake()
+                if dropped is not None and len(dropped):
+                    # 被替换的帧可能是后续差分帧的基准
+                    replaced_frame = True
+                    self.frames_dropped += 1
+                    self.needs_keyframe = True
+
+        release_payload(dropped)
+        if replaced_frame and self.on_dropped:
+            self.on_dropped(self)
+        return accepted
+
+    def reset_stream(self):
+        """客户端切换到另一路画面流：在新的关键帧之前跳过差分帧"""
+        with self.cond:
+            self.needs_keyframe = True
+
+    def send_backlog(self):
+        """尚未写到对方的字节数，不支持检测时返回None（由具体发送方式实现）"""
+        return None
+
+    def update_congestion(self, frame_interval, now=None):
+        """
+        按最近的发送情况更新拥塞等级，每个采集周期由发送端调用一次。
+
+        以下任一情况记为一次拥塞：上次检测后有帧被替换丢弃、平均发送耗时超过帧间隔、
+        发送积压超过两帧且超过 BACKLOG_MIN_BYTES。拥塞比例（指数平均）过半且距上次调整超过 CONGESTION_RAISE_DELAY
+        秒时升一级；几乎不再拥塞且超过 CONGESTION_RECOVER_DELAY 秒时降一级，重新试探。
+
+        Returns:
+            tuple: (降低的画面档位数, 抽帧倍数)
+        """
+        now = time.time() if now is None else now
+        self.backlog = self.send_backlog()
+        dropped, self._checked_dropped = self.frames_dropped - self._checked_dropped, self.frames_dropped
+        avg_frame_size = self.bytes_sent / self.frames_sent if self.frames_sent else 0
+
+        congested = (dropped > 0 or self.avg_send_time > frame_interval
+                     or bool(self.backlog and avg_frame_size
+                             and self.backlog > max(2 * avg_frame_size, BACKLOG_MIN_BYTES)))
+        self._congestion_score = self._congestion_score * 0.8 + (0.2 if congested else 0.0)
+
+        since_change = now - self._congestion_changed
+        if (self._congestion_score > 0.5 and since_change >= CONGESTION_RAISE_DELAY
+                and self.congestion < len(CONGESTION_LEVELS) - 1):
+            self.congestion += 1
+            self._congestion_changed = now
+        elif self._congestion_score < 0.1 and since_change >= CONGESTION_RECOVER_DELAY and self.congestion:
+            self.congestion -= 1
+            self._congestion_changed = now
+        return CONGESTION_LEVELS[self.congestion]
+
+    def _wake(self):
+        """槽位有新帧时调用（已持有 cond）"""
+        self.cond.notify()
+
+    def _take(self):
+        """
+        取出槽位中的帧（调用方已持有 cond）。
+
+        Returns:
+            tuple: (payload, data)，data 是要发送的数据；槽位为空，或是等待关键帧时
+                跳过的差分帧（已释放）时返回 (None, None)。
+        """
+        payload, self.pending = self.pending, None
+        if payload is None:
+            return None, None
+        data = payload.view() if isinstance(payload, PooledBuffer) else payload
+        if len(data) and self.needs_keyframe:
+            if not is_keyframe(data):
+                self.frames_skipped += 1
+                del data
+                release_payload(payload)
+                return None, None
+            self.needs_keyframe = False
+        return payload, data
+
+    def _frame_header(self, payload):
+        """该客户端发送 payload 时要加的v2帧头，v1客户端或无帧头的负载返回b''"""
+        if self.protocol_version >= 2 and isinstance(payload, PooledBuffer):
+            return payload.frame_header
+        return b''
+
+    def _record_sent(self, size, send_time):
+        """记录一帧发送完成"""
+        self.frames_sent += 1
+        self.bytes_sent += size
+        self.last_send_time = send_time
+        self.avg_send_time = send_time if self.frames_sent == 1 else self.avg_send_time * 0.9 + send_time * 0.1
+        if self.on_sent:
+            self.on_sent(self, send_time)
+
+    def _stop(self):
+        """停止发送并释放槽位中尚未发出的帧"""
+        with self.cond:
+            self.running = False
+            pending, self.pending = self.pending, None
+            self.cond.notify()
+        release_payload(pending)
+
+    def close(self):
+        """停止发送（不关闭套接字）"""
+        self._stop()
+
+    def stats(self):
+        """返回该客户端的发送统计"""
+        return {
+            "protocol": self.protocol_version,
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "frames_skipped": self.frames_skipped,
+            "bytes_sent": self.bytes_sent,
+            "last_send_ms": self.last_send_time * 1000,
+            "avg_send_ms": self.avg_send_time * 1000,
+            "congestion": self.congestion,
+            "backlog_bytes": self.backlog,
+        }
+
+
+class ClientSender(FrameSlot):
+    """
+    单个客户端的常驻发送线程（阻塞套接字）。
+
+    write_lock 用于与其他线程共用同一方向的连接（同伴会话中的控制消息），
+    每条消息整条写出后才释放。
+    """
+
+    def __init__(self, sock, addr, on_sent=None, on_closed=None, on_dropped=None, write_lock=None):
+        super().__init__(addr, on_sent, on_closed, on_dropped)
+        self.sock = sock
+        self.write_lock = write_lock or threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"sender-{addr[0]}:{addr[1]}")
+        self.thread.start()
+
+    def send_backlog(self):
+        return socket_backlog(self.sock)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    break
+                payload, data = self._take()
+            if payload is None:
+                continue
+
+            try:
+                send_start = time.time()
+                with self.write_lock:
+                    send_frame(self.sock, data, self._frame_header(payload))
+                self._record_sent(len(data), time.time() - send_start)
+            except OSError:
+                self._stop()
+                if self.on_closed:
+                    self.on_closed(self)
+                break
+            finally:
+                del data
+                release_payload(payload)
+
+
+if __name__ == '__main__':
+    # 基准测试：每帧为每个客户端新建线程 vs 常驻发送线程，其中一个客户端很慢
+    import socket
+    from frame_pool import FramePool
+
+    clients = 30
+    frames = 100
+    payload_size = 100 * 1024
+
+    def start_receivers(slow_index):
+        pairs = [socket.socketpair() for _ in range(clients)]
+        for i, (sender_sock, receiver_sock) in enumerate(pairs):
+            sender_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)
+
+            def drain(sock=receiver_sock, slow=(i == slow_index)):
+                buf = bytearray(256 * 1024)
+                try:
+                    while sock.recv_into(buf):
+                        if slow:
+                            time.sleep(0.05)
+                except OSError:
+                    pass
+            threading.Thread(target=drain, daemon=True).start()
+        return pairs
+
+    def legacy_broadcast(pairs, payload):
+        threads = []
+        for sender_sock, _ in pairs:
+            thread = threading.Thread(target=send_frame, args=(sender_sock, payload), daemon=True)
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=0.05)
+
+    for name in ("逐帧新建线程", "常驻发送线程"):
+        pairs = start_receivers(slow_index=0)
+        legacy = name == "逐帧新建线程"
+        pool = FramePool(slots=6, capacity=payload_size)
+        senders = [] if legacy else [ClientSender(sender_sock, ('127.0.0.1', i))
+                                     for i, (sender_sock, _) in enumerate(pairs)]
+
+        start_time = time.time()
+        for _ in range(frames):
+            if legacy:
+                legacy_broadcast(pairs, bytes(payload_size))
+            else:
+                buffer = pool.acquire()
+                buffer.write(bytes(payload_size))
+                for sender in senders:
+                    sender.submit(buffer)
+                buffer.release()
+            time.sleep(0.01)
+        elapsed = time.time() - start_time
+
+        created = clients * frames if legacy else clients
+        print(f"[{name}] 每帧分发耗时: {(elapsed / frames - 0.01) * 1000:.2f} ms, 创建发送线程: {created} 个")
+        if not legacy:
+            time.sleep(0.5)
+            fast, slow = senders[1].stats(), senders[0].stats()
+            print(f"  正常客户端: 发送 {fast['frames_sent']} 帧, 丢弃 {fast['frames_dropped']} 帧")
+            print(f"  慢客户端:   发送 {slow['frames_sent']} 帧, 丢弃 {slow['frames_dropped']} 帧")
+        for sender in senders:
+            sender.close()
+        for sender_sock, receiver_sock in pairs:
+            sender_sock.close()
+            receiver_sock.close()
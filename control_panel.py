@@ -4,9 +4,10 @@ import socket
 import threading
 import json
 from network_comms import NetworkManager
+from network_selector import SelectorNetworkManager
 from viewer_window import ViewerWindow
+from decode_pool import DecodePool
 from settings_dialog import show_settings_dialog
-from queue import Queue
 
 class ControlPanel(tk.Tk):
     def __init__(self):
@@ -19,10 +20,14 @@ class ControlPanel(tk.Tk):
 
         # --- Data Structures ---
         self.viewer_windows = {}  # K: peer_addr, V: ViewerWindow instance
-        self.data_queues = {}     # K: peer_addr, V: Queue for image data
+        # 所有观看窗口共用的解码线程池，解码和缩放不在Tk线程中进行
+        self.decode_pool = DecodePool(self, self.config['viewer'].get('decode_workers', 0),
+                                      on_keyframe_needed=self._request_keyframe)
         
         # --- Network Setup ---
-        self.network_manager = NetworkManager(port=self.config['network']['default_port'])
+        # 观看端很多时可改用单线程事件循环后端
+        backend = SelectorNetworkManager if self.config['network'].get('backend') == 'selectors' else NetworkManager
+        self.network_manager = backend(port=self.config['network']['default_port'])
         self.network_manager.on_peer_connected = self.on_peer_connected
         self.network_manager.on_peer_disconnected = self.on_peer_disconnected
         self.network_manager.on_data_received = self.on_data_received
@@ -47,7 +52,8 @@ class ControlPanel(tk.Tk):
                 "network": {
                     "default_port": 17585,
                     "fps": 8,
-                    "jpeg_quality": 75
+                    "jpeg_quality": 75,
+                    "backend": "threads"
                 },
                 "viewer": {
                     "default_width": 480,
@@ -129,8 +135,13 @@ class ControlPanel(tk.Tk):
         scrollbar.pack(side="right", fill="y")
         self.peer_list.config(yscrollcommand=scrollbar.set)
         
-        self.disconnect_button = ttk.Button(self, text="断开选中连接", command=self.disconnect_peer)
-        self.disconnect_button.pack(pady=5)
+        peer_buttons = ttk.Frame(self)
+        peer_buttons.pack(pady=5)
+        self.disconnect_button = ttk.Button(peer_buttons, text="断开选中连接", command=self.disconnect_peer)
+        self.disconnect_button.pack(side="left", padx=5)
+        # 转发模式：把选中同伴的画面原样转发给连接到本机的观看端
+        self.relay_button = ttk.Button(peer_buttons, text="转发选中画面", command=self.toggle_relay)
+        self.relay_button.pack(side="left", padx=5)
         
         # 性能监控区域
         performance_frame = ttk.LabelFrame(self, text="性能监控", padding=(10, 5))
@@ -159,6 +170,7 @@ class ControlPanel(tk.Tk):
         ttk.Button(perf_control_frame, text="高质量", command=lambda: self.switch_profile("quality")).pack(side="left", padx=2)
         ttk.Button(perf_control_frame, text="平衡", command=lambda: self.switch_profile("balanced")).pack(side="left", padx=2)
         ttk.Button(perf_control_frame, text="高性能", command=lambda: self.switch_profile("performance")).pack(side="left", padx=2)
+        ttk.Button(perf_control_frame, text="自适应", command=lambda: self.switch_profile("adaptive")).pack(side="left", padx=2)
 
         # 底部按钮区域
         bottom_frame = ttk.Frame(self)
@@ -219,6 +231,21 @@ class ControlPanel(tk.Tk):
         
         self.network_manager.disconnect_from_peer(peer_ip, peer_port)
         
+    def toggle_relay(self):
+        """转发选中连接的画面，或停止正在进行的转发"""
+        if self.network_manager.relay_from is not None:
+            self.network_manager.stop_relay()
+            self.relay_button.config(text="转发选中画面")
+            return
+        
+        selected_indices = self.peer_list.curselection()
+        if not selected_indices:
+            messagebox.showerror("错误", "请先从列表中选择一个连接。")
+            return
+        peer_ip, peer_port_str = self.peer_list.get(selected_indices[0]).split(":")
+        if self.network_manager.start_relay(peer_ip, int(peer_port_str)):
+            self.relay_button.config(text="停止转发")
+        
     def on_peer_connected(self, peer_addr):
         self.after(0, self._create_viewer_window, peer_addr)
         
@@ -226,22 +253,21 @@ class ControlPanel(tk.Tk):
         self.after(0, self._destroy_viewer_window, peer_addr)
         
     def on_data_received(self, peer_addr, image_data):
-        """接收到网络数据时，将最新帧放入队列，如果队列已满则丢弃旧帧"""
-        if peer_addr in self.data_queues:
-            q = self.data_queues[peer_addr]
-            try:
-                # 如果队列已满，先移除旧帧，始终保持最新
-                if q.full():
-                    _ = q.get_nowait()
-                q.put_nowait(image_data)
-            except Exception:
-                pass
+        """接收到网络数据时，交给解码线程池；窗口待解码的帧已满时丢弃最旧的帧"""
+        if not image_data:
+            # 零长度的保活消息：对方画面静止，连接仍然正常
+            viewer = self.viewer_windows.get(peer_addr)
+            if viewer:
+                self.after(0, viewer.mark_static)
+            return
+        self.decode_pool.submit(peer_addr, image_data)
             
+    def _request_keyframe(self, peer_addr):
+        """（网络线程）窗口解码积压丢弃了差分帧：有同伴会话时请求对方尽快发送关键帧"""
+        self.network_manager.request_peer_keyframe(*peer_addr)
+
     def _create_viewer_window(self, peer_addr):
         if peer_addr not in self.viewer_windows:
-            # 仅缓存最新帧，避免延迟累积
-            self.data_queues[peer_addr] = Queue(maxsize=1)
-            
             viewer_config = self.config['viewer']
             ui_config = self.config.get('ui', {})
             viewer = ViewerWindow(
@@ -249,11 +275,12 @@ class ControlPanel(tk.Tk):
                 peer_addr,
                 default_size=(viewer_config['default_width'], viewer_config['default_height']),
                 zoom_scale=viewer_config['zoom_scale'],
-                show_fps=ui_config.get('show_fps', True)
+                show_fps=ui_config.get('show_fps', True),
+                reduced_decode=viewer_config.get('reduced_decode', True)
             )
             self.viewer_windows[peer_addr] = viewer
             
-            threading.Thread(target=self._update_viewer_loop, args=(viewer, self.data_queues[peer_addr]), daemon=True).start()
+            self.decode_pool.add_viewer(peer_addr, viewer)
             
             self.peer_list.insert(tk.END, f"{peer_addr[0]}:{peer_addr[1]}")
             self.peer_ip_entry.delete(0, tk.END)
@@ -263,8 +290,7 @@ class ControlPanel(tk.Tk):
             viewer = self.viewer_windows.pop(peer_addr)
             viewer.close_window()
             
-            if peer_addr in self.data_queues:
-                del self.data_queues[peer_addr]
+            self.decode_pool.remove_viewer(peer_addr)
 
             items = list(self.peer_list.get(0, tk.END))
             for i, item in enumerate(items):
@@ -272,22 +298,6 @@ class ControlPanel(tk.Tk):
                     self.peer_list.delete(i)
                     break
                     
-    def _update_viewer_loop(self, viewer, queue):
-        while viewer.winfo_exists():
-            try:
-                # 尝试一次性获取队列中最后一帧，丢弃过时帧
-                data = None
-                while True:
-                    try:
-                        data = queue.get_nowait()
-                    except Exception:
-                        break
-                if data:
-                    viewer.update_image(data)
-            except Exception:
-                pass
-        print(f"Update loop for {viewer.peer_addr} has ended.")
-
     def show_settings(self):
         """显示设置对话框"""
         new_config = show_settings_dialog(self, self.config)
@@ -335,9 +345,13 @@ class ControlPanel(tk.Tk):
                 profile_names = {
                     "quality": "高质量",
                     "balanced": "平衡", 
-                    "performance": "高性能"
+                    "performance": "高性能",
+                    "adaptive": "自适应"
                 }
                 profile_display = profile_names.get(perf_info['profile'], perf_info['profile'])
+                adaptive = perf_info.get('adaptive')
+                if adaptive:
+                    profile_display += f" (Q{adaptive['quality']} ×{adaptive['scale_factor']:.2f} {adaptive['fps']}fps)"
                 self.profile_label.config(text=profile_display)
                 
                 # 更新效率显示（根据效率设置颜色）
@@ -370,7 +384,8 @@ class ControlPanel(tk.Tk):
             profile_names = {
                 "quality": "高质量模式",
                 "balanced": "平衡模式", 
-                "performance": "高性能模式"
+                "performance": "高性能模式",
+                "adaptive": "自适应模式"
             }
             messagebox.showinfo("成功", f"已切换到 {profile_names.get(profile, profile)}")
             print(f"[UI] 性能档案切换完成: {profile}")
@@ -380,6 +395,7 @@ class ControlPanel(tk.Tk):
     def on_closing(self):
         if messagebox.askokcancel("退出", "确定要关闭所有连接并退出程序吗？"):
             self.network_manager.stop()
+            self.decode_pool.stop()
             self.destroy()
 
 if __name__ == '__main__':
@@ -0,0 +1,202 @@
+"""
+观看窗口的解码线程池。
+
+原先每个观看窗口一个更新线程，在 while 循环里不停轮询自己的帧队列（没有等待），
+每开一个窗口就空转占满一个CPU核心；解码、缩放和创建 PhotoImage 也都在这个非Tk线程中进行。
+
+现在所有窗口共用少量解码线程：
+- 网络线程把帧放进窗口的收件箱，窗口没有在处理时才把它排进工作队列，解码线程阻塞等待，
+  没有新帧时不占CPU。同一窗口同一时间只由一个解码线程处理，差分帧按顺序应用。
+- 收件箱满时不能只丢最旧的帧（差分帧会贴到缺了内容的画面上）：丢到最近的关键帧为止；
+  没有关键帧时清空收件箱，在下一个关键帧之前丢弃差分帧，并经同伴会话请求对方尽快发送关键帧。
+- 解码线程一次取走收件箱中的所有帧，从最后一个关键帧开始应用，并缩放到显示尺寸。
+- 缩放好的画面交给Tk线程显示：所有窗口共用一个 after() 回调，每个刷新周期最多执行一次，
+  期间同一窗口更新的多帧只显示最新的一帧，各帧的变化区域合并后一起交给窗口局部更新。
+- 窗口放大/复原时没有缓存好的画面，或画面静止时预先准备两种尺寸，也作为该窗口的任务排队，
+  与解码按顺序执行，缩放不会在Tk线程中进行。
+"""
+import os
+import threading
+from collections import deque
+from queue import Queue
+
+from frame_protocol import is_keyframe
+
+# 显示刷新周期（毫秒），约60Hz
+REFRESH_INTERVAL_MS = 16
+# 每个窗口最多缓存的未处理帧数（差分帧需按顺序应用，不能只保留最新一帧）
+INBOX_SIZE = 30
+
+
+class _Inbox:
+    """单个观看窗口待解码的帧"""
+
+    __slots__ = ('viewer', 'frames', 'render', 'prepare', 'needs_keyframe', 'scheduled', 'removed')
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.frames = deque()
+        self.needs_keyframe = False  # 因积压丢弃过差分帧，在关键帧到达之前丢弃差分帧
+        self.render = False     # 需要按当前显示尺寸重新缩放并显示
+        self.prepare = False    # 需要预先准备各显示尺寸的画面
+        self.scheduled = False  # 已在工作队列中或正在被解码线程处理
+        self.removed = False
+
+    def has_work(self):
+        return bool(self.frames) or self.render or self.prepare
+
+
+class DecodePool:
+    """
+    所有观看窗口共用的解码线程池。
+
+    viewer 需要提供 decode_frames(frames)（在解码线程中调用，返回 (画面, 变化区域) 或None，
+    变化区域为矩形列表，None 表示整幅）和 show_image(image, dirty)（在Tk线程中调用），
+    以及 render() 和 prepare_renditions()（在解码线程中调用，见 request_render / request_prepare）。
+    """
+
+    def __init__(self, master, workers=0, on_keyframe_needed=None):
+        self.master = master
+        self.on_keyframe_needed = on_keyframe_needed  # on_keyframe_needed(peer_addr)，在网络线程中调用
+        self.workers = workers if workers > 0 else min(4, os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        self.inboxes = {}       # K: peer_addr, V: _Inbox
+        self.work = Queue()
+        self.ready = {}         # K: viewer, V: (待显示的画面, 上次显示以来的变化区域)
+        self.flush_scheduled = False
+        self.threads = [threading.Thread(target=self._run, daemon=True, name=f"decode-{i}")
+                        for i in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def add_viewer(self, peer_addr, viewer):
+        with self.lock:
+            self.inboxes[peer_addr] = _Inbox(viewer)
+        viewer.decode_pool = self
+
+    def remove_viewer(self, peer_addr):
+        with self.lock:
+            inbox = self.inboxes.pop(peer_addr, None)
+            if inbox:
+                inbox.removed = True
+                inbox.frames.clear()
+
+    def submit(self, peer_addr, data):
+        """（网络线程）放入一帧；收件箱已满时丢弃旧帧，必要时等待下一个关键帧"""
+        with self.lock:
+            inbox = self.inboxes.get(peer_addr)
+            if inbox is None:
+                return
+            keyframe = is_keyframe(data)
+            if inbox.needs_keyframe and not keyframe:
+                return
+            overflow = len(inbox.frames) >= INBOX_SIZE and not self._trim(inbox, keyframe)
+            inbox.needs_keyframe = overflow
+            if not overflow:
+                inbox.frames.append(data)
+                self._schedule(inbox)
+        if overflow and self.on_keyframe_needed:
+            self.on_keyframe_needed(peer_addr)
+
+    @staticmethod
+    def _trim(inbox, keyframe):
+        """
+        （调用方持有 lock）收件箱已满：新帧是关键帧时清空收件箱，否则丢到收件箱中最近的关键帧为止。
+
+        Returns:
+            bool: 是否腾出了位置；没有可作为起点的关键帧时清空收件箱并返回False。
+        """
+        frames = inbox.frames
+        if not keyframe:
+            for i in range(len(frames) - 1, 0, -1):
+                if is_keyframe(frames[i]):
+                    for _ in range(i):
+                        frames.popleft()
+                    return True
+        frames.clear()
+        return keyframe
+
+    def request_render(self, peer_addr):
+        """（Tk线程）请求按窗口当前的显示尺寸重新缩放当前画面并显示"""
+        with self.lock:
+            inbox = self.inboxes.get(peer_addr)
+            if inbox is not None:
+                inbox.render = True
+                self._schedule(inbox)
+
+    def request_prepare(self, peer_addr):
+        """请求预先准备窗口各显示尺寸的画面（不显示）"""
+        with self.lock:
+            inbox = self.inboxes.get(peer_addr)
+            if inbox is not None:
+                inbox.prepare = True
+                self._schedule(inbox)
+
+    def _schedule(self, inbox):
+        """（调用方持有 lock）窗口没有在处理时排进工作队列"""
+        if not inbox.scheduled:
+            inbox.scheduled = True
+            self.work.put(inbox)
+
+    def _run(self):
+        while True:
+            inbox = self.work.get()
+            if inbox is None:
+                break
+            with self.lock:
+                frames = list(inbox.frames)
+                inbox.frames.clear()
+                render, inbox.render = inbox.render, False
+                prepare, inbox.prepare = inbox.prepare, False
+            try:
+                result = inbox.viewer.decode_frames(frames) if frames else None
+                if result is None and render:
+                    result = inbox.viewer.render()  # 解码出了新画面时已是当前尺寸，不必再缩放
+                if result is not None:
+                    self._post(inbox.viewer, *result)
+                if prepare and not inbox.frames:
+                    inbox.viewer.prepare_renditions()  # 又有新帧时缓存马上作废，不必准备
+            except Exception as e:
+                print(f"解码失败: {e}")
+            with self.lock:
+                if inbox.has_work() and not inbox.removed:
+                    self.work.put(inbox)  # 处理期间又收到了新帧
+                else:
+                    inbox.scheduled = False
+
+    def _post(self, viewer, image, dirty):
+        """登记待显示的画面，需要时预约下一次刷新"""
+        with self.lock:
+            pending = self.ready.get(viewer)
+            if pending is not None:
+                # 上一幅还没显示就被取代，它的变化区域也要在这次一起更新
+                pending_dirty = pending[1]
+                dirty = None if pending_dirty is None or dirty is None else pending_dirty + dirty
+            self.ready[viewer] = (image, dirty)
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        try:
+            self.master.after(REFRESH_INTERVAL_MS, self._flush)
+        except RuntimeError:
+            pass  # 主窗口已关闭
+
+    def _flush(self):
+        """（Tk线程）显示本周期内各窗口的最新画面"""
+        with self.lock:
+            ready, self.ready = self.ready, {}
+            self.flush_scheduled = False
+        for viewer, (image, dirty) in ready.items():
+            try:
+                if viewer.winfo_exists():
+                    viewer.show_image(image, dirty)
+            except Exception as e:
+                print(f"显示画面失败: {e}")
+
+    def stop(self):
+        with self.lock:
+            for inbox in self.inboxes.values():
+                inbox.removed = True
+            self.inboxes.clear()
+        for _ in self.threads:
+            self.work.put(None)
@@ -0,0 +1,181 @@
+"""
+帧缓冲池。
+
+截图线程每帧都要写出一段JPEG/分块帧负载，发送线程再把它交给所有客户端。
+原先每帧都新建 BytesIO 并在压缩过程中反复扩容，20 FPS 下分配器和GC的抖动
+会直接体现为帧间隔的抖动。
+
+FramePool 预先分配固定数量的可复用编码缓冲区，组成一个环：编码阶段从池中取出
+一块直接写入，发送阶段每个客户端持有一个引用，全部发送完毕（或该帧被丢弃）后
+缓冲区自动回到池中。
+"""
+import threading
+import time
+from collections import deque
+
+
+class PooledBuffer:
+    """
+    池中的一块可复用编码缓冲区。
+
+    实现了 file-like 的 write()，Pillow 可以直接把JPEG写进来；写入时按需扩容，
+    复用后只覆盖已有内存，不再重新分配。
+
+    frame_header 是编码完成后附加的协议v2帧头，只发给v2观看端。
+    """
+
+    __slots__ = ('pool', 'data', 'length', 'refs', 'frame_header')
+
+    def __init__(self, pool, capacity):
+        self.pool = pool
+        self.data = bytearray(capacity)
+        self.length = 0
+        self.refs = 0
+        self.frame_header = b''
+
+    def write(self, chunk):
+        size = len(chunk)
+        end = self.length + size
+        if end > len(self.data):
+            self._grow(end)
+        self.data[self.length:end] = chunk
+        self.length = end
+        return size
+
+    def _grow(self, needed):
+        # 旧缓冲区可能仍被发送中的memoryview引用，不能原地扩容，改为换一块更大的
+        data = bytearray(max(needed, len(self.data) * 2))
+        data[:self.length] = memoryview(self.data)[:self.length]
+        self.data = data
+
+    def reset(self):
+        """丢弃已写入的内容（编码失败回退时使用）"""
+        self.length = 0
+
+    def view(self):
+        """返回已写入部分的memoryview（不复制）"""
+        return memoryview(self.data)[:self.length]
+
+    def retain(self):
+        """增加一个引用（每个发送中的客户端持有一个）"""
+        with self.pool.lock:
+            self.refs += 1
+
+    def release(self):
+        """释放一个引用，最后一个引用释放时回到池中"""
+        with self.pool.lock:
+            self.refs -= 1
+            if self.refs == 0:
+                self.pool._recycle(self)
+
+    def __len__(self):
+        return self.length
+
+
+class FramePool:
+    """
+    固定大小的编码缓冲区环。
+
+    池中缓冲区全部被占用（例如某个客户端发送过慢）时会临时分配一块新的，
+    用完后只有在池未满时才会被收回，池的大小始终不超过 slots。
+    """
+
+    def __init__(self, slots=6, capacity=256 * 1024):
+        self.slots = slots
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.free = deque(PooledBuffer(self, capacity) for _ in range(slots))
+
+        # 统计信息：池耗尽时临时分配的次数
+        self.misses = 0
+
+    def acquire(self):
+        """取出一块空缓冲区，调用方持有一个引用，用完后调用 release()"""
+        with self.lock:
+            buffer = self.free.popleft() if self.free else None
+            if buffer is None:
+                self.misses += 1
+        if buffer is None:
+            buffer = PooledBuffer(self, self.capacity)
+        buffer.length = 0
+        buffer.refs = 1
+        buffer.frame_header = b''
+        return buffer
+
+    def _recycle(self, buffer):
+        # 调用方已持有锁
+        if len(self.free) < self.slots:
+            self.free.append(buffer)
+
+    def resize(self, slots):
+        """调整池的大小；变大时缺少的缓冲区在之后的 acquire() 中按需分配"""
+        with self.lock:
+            self.slots = slots
+            while len(self.free) > slots:
+                self.free.pop()
+
+    def available(self):
+        """当前空闲的缓冲区数量"""
+        with self.lock:
+            return len(self.free)
+
+
+def release_payload(payload):
+    """释放负载占用的池缓冲区；普通bytes/memoryview负载无需处理"""
+    if isinstance(payload, PooledBuffer):
+        payload.release()
+
+
+if __name__ == '__main__':
+    # 基准测试：逐帧新建BytesIO vs 复用池缓冲区，比较编码耗时的抖动和内存分配
+    import gc
+    import io
+    import statistics
+    import tracemalloc
+    from PIL import Image
+    from frame_source import ScrollingTextSource
+    from image_scaling import area_downscale, bgra_to_rgb, scaled_size
+
+    # 合成画面本身的渲染也会分配内存，这里只测量 转换→缩放→编码 部分
+    sct_img = ScrollingTextSource(1920, 1080).grab()
+    target = scaled_size(1920, 1080, 0.5)
+    frames = 100
+    pool = FramePool()
+
+    def legacy_frame():
+        img = area_downscale(Image.frombuffer("RGB", sct_img.size, sct_img.raw, "raw", "BGRX", 0, 1), *target)
+        buffer = io.BytesIO()
+        img.save(buffer, format='JPEG', quality=30, optimize=False)
+        return buffer.getvalue()
+
+    rgb_frame = None
+
+    def pooled_frame():
+        global rgb_frame
+        rgb_frame = bgra_to_rgb(sct_img.raw, sct_img.width, sct_img.height, rgb_frame)
+        img = area_downscale(rgb_frame, *target)
+        buffer = pool.acquire()
+        img.save(buffer, format='JPEG', quality=30, optimize=False)
+        buffer.release()
+        return buffer
+
+    for name, produce in (("逐帧分配", legacy_frame), ("缓冲池", pooled_frame)):
+        produce()
+        gc.collect()
+        gc_before = sum(stat['collections'] for stat in gc.get_stats())
+        tracemalloc.start()
+        times = []
+        for _ in range(frames):
+            start_time = time.perf_counter()
+            produce()
+            times.append(time.perf_counter() - start_time)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        gc_runs = sum(stat['collections'] for stat in gc.get_stats()) - gc_before
+
+        times.sort()
+        print(f"[{name}] 平均: {statistics.mean(times) * 1000:.2f} ms, "
+              f"p99: {times[int(frames * 0.99) - 1] * 1000:.2f} ms, "
+              f"抖动(标准差): {statistics.pstdev(times) * 1000:.2f} ms, "
+              f"峰值分配: {peak / 1024:.0f} KB, GC次数: {gc_runs}")
+    print(f"缓冲池临时分配次数: {pool.misses}")
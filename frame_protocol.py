@@ -0,0 +1,398 @@
+"""
+帧负载格式定义（发送端与观看端共用）。
+
+网络上每条消息仍然是 `>Q` 长度头 + 负载。负载有两种：
+- 完整帧：直接是JPEG字节流（以 FF D8 开头），旧版观看端也能显示，同时充当关键帧。
+- 分块帧：以 MAGIC_TILE_FRAME 开头，只携带发生变化的区域及其坐标。
+  带 FLAG_KEYFRAME 标志的分块帧覆盖整个画面（例如并行编码的多条带帧）。
+  只发给在握手中声明 "tiles": true 的观看端。
+
+完整帧和分块帧中的图像数据使用连接建立时协商的编码（见 image_codecs）。
+协商通过握手消息完成：观看端连接后先发送
+MAGIC_HANDSHAKE + JSON {"codecs": [...], "version": 2, "tiles": true}，
+发送端回复 MAGIC_HANDSHAKE + JSON {"codec": "...", "version": n, "tiles": bool}，
+tiles 表示之后是否会发送分块帧。不发送握手的旧版观看端按JPEG处理，只收到完整帧。
+
+协议版本（双方握手中 version 的较小值，缺省为1）：
+- v1：负载就是上面的完整帧或分块帧（是否有分块帧只取决于 tiles，与版本无关）。
+- v2：画面负载前加一个定长帧头（MAGIC_FRAME_V2，见 FRAME_HEADER_V2），携带帧序号、
+  采集时间、编码ID、宽高、标志和区域数量，接收端不解码即可判断帧的先后和是否为关键帧。
+  帧头之后仍是v1负载（分块帧自带各区域的坐标），发送时与负载一起 scatter-gather 写出，
+  不复制负载。保活消息和握手消息不加帧头。
+
+控制消息（MAGIC_CONTROL + JSON {"type": ...}）在同伴会话（见 peer_session）中双向传递，
+用于在同一连接上请求观看对方、请求关键帧和交换统计信息，不是画面，不加帧头。
+"""
+import json
+import socket
+import struct
+import time
+from collections import namedtuple
+
+# 消息长度头
+LENGTH_HEADER = struct.Struct('>Q')
+
+# Windows 上的 socket 没有 sendmsg，退化为分两次 sendall
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+MAGIC_TILE_FRAME = b'GHTF'
+
+# 帧标志位
+FLAG_KEYFRAME = 0x01
+
+# 头部: 魔数, 标志, 整帧宽, 整帧高, 分块数量
+TILE_FRAME_HEADER = struct.Struct('>4sBHHH')
+# 分块描述: x, y, 宽, 高, 数据长度
+TILE_DESCRIPTOR = struct.Struct('>HHHHI')
+
+MAGIC_HANDSHAKE = b'GHHS'
+MAGIC_CONTROL = b'GHCT'
+
+# 本端支持的最高协议版本
+PROTOCOL_VERSION = 2
+
+MAGIC_FRAME_V2 = b'GHF2'
+# v2帧头: 魔数, 帧序号, 采集时间(发送端单调时钟, 微秒), 编码ID, 整帧宽, 整帧高, 标志, 区域数量
+FRAME_HEADER_V2 = struct.Struct('>4sIQBHHBH')
+
+FrameHeader = namedtuple('FrameHeader', 'frame_id timestamp_us codec_id width height flags regions')
+
+
+def is_tile_frame(payload):
+    """判断负载是否为分块帧。"""
+    return len(payload) >= TILE_FRAME_HEADER.size and bytes(payload[:4]) == MAGIC_TILE_FRAME
+
+
+def is_keyframe(payload):
+    """判断负载是否可以独立显示（完整帧，或带关键帧标志的分块帧/v2帧）。"""
+    if is_v2_frame(payload):
+        return bool(FRAME_HEADER_V2.unpack_from(payload, 0)[6] & FLAG_KEYFRAME)
+    if not is_tile_frame(payload):
+        return True
+    return bool(payload[4] & FLAG_KEYFRAME)
+
+
+def pack_frame_header(frame_id, timestamp_us, codec_id, width, height, flags, regions):
+    """打包v2帧头，帧序号按32位回绕。"""
+    return FRAME_HEADER_V2.pack(MAGIC_FRAME_V2, frame_id & 0xFFFFFFFF, timestamp_us, codec_id,
+                                width, height, flags, regions)
+
+
+def is_v2_frame(payload):
+    """判断负载是否带有v2帧头。"""
+    return len(payload) >= FRAME_HEADER_V2.size and bytes(payload[:4]) == MAGIC_FRAME_V2
+
+
+def unpack_frame(payload):
+    """
+    拆分v2帧头和v1负载，不复制负载。
+
+    Returns:
+        tuple: (FrameHeader, memoryview)；不带帧头的v1负载返回 (None, memoryview)。
+    """
+    view = memoryview(payload)
+    if not is_v2_frame(view):
+        return None, view
+    header = FrameHeader(*FRAME_HEADER_V2.unpack_from(view, 0)[1:])
+    return header, view[FRAME_HEADER_V2.size:]
+
+
+def frame_is_newer(frame_id, last_id):
+    """按32位序号回绕比较，判断 frame_id 是否比 last_id 新。"""
+    return 0 < ((frame_id - last_id) & 0xFFFFFFFF) < 0x80000000
+
+
+def pack_tile_frame(width, height, tiles, flags=0, out=None):
+    """
+    将变化区域打包为分块帧。
+
+    Args:
+        width (int): 整帧宽度。
+        height (int): 整帧高度。
+        tiles (list): [(x, y, w, h, data_bytes), ...]
+        flags (int): 帧标志位。
+        out: 可选的可写对象（如帧缓冲池中的缓冲区），给出时直接写入其中。
+
+    Returns:
+        bytes: 分块帧负载；给出 out 时返回 out。
+    """
+    parts = [TILE_FRAME_HEADER.pack(MAGIC_TILE_FRAME, flags, width, height, len(tiles))]
+    for x, y, w, h, data in tiles:
+        parts.append(TILE_DESCRIPTOR.pack(x, y, w, h, len(data)))
+    parts.extend(tile[4] for tile in tiles)
+    if out is not None:
+        for part in parts:
+            out.write(part)
+        return out
+    return b''.join(parts)
+
+
+def unpack_tile_frame(payload):
+    """
+    解析分块帧。
+
+    Returns:
+        tuple: (width, height, flags, [(x, y, w, h, memoryview), ...])
+
+    Raises:
+        ValueError: 负载格式错误。
+    """
+    view = memoryview(payload)
+    if not is_tile_frame(view):
+        raise ValueError("不是分块帧")
+    _, flags, width, height, count = TILE_FRAME_HEADER.unpack_from(view, 0)
+
+    offset = TILE_FRAME_HEADER.size
+    descriptors = []
+    for _ in range(count):
+        descriptors.append(TILE_DESCRIPTOR.unpack_from(view, offset))
+        offset += TILE_DESCRIPTOR.size
+
+    tiles = []
+    for x, y, w, h, length in descriptors:
+        if offset + length > len(view):
+            raise ValueError("分块帧数据不完整")
+        tiles.append((x, y, w, h, view[offset:offset + length]))
+        offset += length
+    return width, height, flags, tiles
+
+
+def pack_handshake(info):
+    """将握手信息打包为消息负载。"""
+    return MAGIC_HANDSHAKE + json.dumps(info).encode('utf-8')
+
+
+def is_handshake(payload):
+    """判断负载是否为握手消息。"""
+    return bytes(payload[:4]) == MAGIC_HANDSHAKE
+
+
+def unpack_handshake(payload):
+    """
+    解析握手消息。
+
+    Raises:
+        ValueError: 不是握手消息或内容不是JSON对象。
+    """
+    if not is_handshake(payload):
+        raise ValueError("不是握手消息")
+    info = json.loads(bytes(payload[4:]).decode('utf-8'))
+    if not isinstance(info, dict):
+        raise ValueError("握手内容格式错误")
+    return info
+
+
+def pack_control(message_type, **fields):
+    """将控制消息打包为消息负载。"""
+    fields["type"] = message_type
+    return MAGIC_CONTROL + json.dumps(fields).encode('utf-8')
+
+
+def is_control(payload):
+    """判断负载是否为控制消息。"""
+    return bytes(payload[:4]) == MAGIC_CONTROL
+
+
+def unpack_control(payload):
+    """
+    解析控制消息。
+
+    Raises:
+        ValueError: 不是控制消息，或内容不是带 type 字段的JSON对象。
+    """
+    if not is_control(payload):
+        raise ValueError("不是控制消息")
+    message = json.loads(bytes(payload[4:]).decode('utf-8'))
+    if not isinstance(message, dict) or not isinstance(message.get("type"), str):
+        raise ValueError("控制消息格式错误")
+    return message
+
+
+def negotiate_version(info):
+    """由对方握手信息中的 version 得出双方共同支持的协议版本，缺省或无效时为1。"""
+    try:
+        version = int(info.get("version", 1))
+    except (TypeError, ValueError):
+        return 1
+    return max(1, min(version, PROTOCOL_VERSION))
+
+
+def recv_exact(sock, size):
+    """从套接字读取恰好 size 字节，对方关闭连接时抛出 ConnectionResetError。"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            raise ConnectionResetError("远程主机关闭连接")
+        received += count
+    return buffer
+
+
+def recv_message(sock, max_size=None):
+    """
+    读取一条 `>Q` 长度头 + 负载 的消息，返回负载。
+
+    Raises:
+        ValueError: 长度超过 max_size（长度头损坏或对方不是本程序）。
+    """
+    size = LENGTH_HEADER.unpack(recv_exact(sock, LENGTH_HEADER.size))[0]
+    if max_size is not None and size > max_size:
+        raise ValueError(f"消息长度 {size} 超过上限 {max_size}")
+    return recv_exact(sock, size)
+
+
+class MessageReader:
+    """
+    增量解析 `>Q` 长度头 + 负载 的消息流，阻塞和非阻塞套接字均可使用。
+
+    读到长度头后分配一块恰好 msg_size 大小的 bytearray，用 recv_into 直接填充，
+    不做拼接和切片复制。
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.header = bytearray(LENGTH_HEADER.size)
+        self.body = None
+        self.filled = 0
+
+    def read_from(self, sock):
+        """
+        从套接字读取一次。
+
+        Returns:
+            bytearray: 本次读取后完整的一条消息负载；消息尚未读完时返回None。
+
+        Raises:
+            ConnectionResetError: 对方关闭连接。
+            ValueError: 长度超过 max_size。
+            BlockingIOError: 非阻塞套接字暂无数据。
+        """
+        target = self.header if self.body is None else self.body
+        count = sock.recv_into(memoryview(target)[self.filled:])
+        if not count:
+            raise ConnectionResetError("远程主机关闭连接")
+        self.filled += count
+        if self.filled < len(target):
+            return None
+        self.filled = 0
+
+        if self.body is None:
+            size = LENGTH_HEADER.unpack(self.header)[0]
+            if self.max_size is not None and size > self.max_size:
+                raise ValueError(f"消息长度 {size} 超过上限 {self.max_size}")
+            if size == 0:
+                return bytearray()
+            self.body = bytearray(size)
+            return None
+
+        message, self.body = self.body, None
+        return message
+
+
+def send_frame(sock, payload, frame_header=b''):
+    """
+    发送一条 `>Q` 长度头 + 负载 的消息。
+
+    使用 sendmsg 将长度头和负载的 memoryview 一起交给内核（scatter-gather），
+    不会为了拼接消息再复制一遍负载。
+
+    Args:
+        sock (socket.socket): 阻塞模式的已连接套接字。
+        payload: bytes / bytearray / memoryview。
+        frame_header (bytes): 可选的v2帧头，写在负载之前，计入消息长度。
+    """
+    header = LENGTH_HEADER.pack(len(frame_header) + len(payload)) + frame_header
+    view = memoryview(payload)
+    if not HAS_SENDMSG:
+        sock.sendall(header)
+        if len(view):
+            sock.sendall(view)
+        return
+
+    total = len(header) + len(view)
+    sent = sock.sendmsg([header, view])
+    # 阻塞套接字也可能只发送了一部分，剩余部分继续发送
+    while sent < total:
+        if sent < len(header):
+            sent += sock.sendmsg([header[sent:], view])
+        else:
+            sock.sendall(view[sent - len(header):])
+            break
+
+
+if __name__ == '__main__':
+    # 基准测试：多客户端时每帧额外分配的内存（拼接消息 vs scatter-gather）
+    import threading
+    import tracemalloc
+
+    clients = 30
+    frames = 50
+    frame = bytes(100 * 1024)
+    pairs = [socket.socketpair() for _ in range(clients)]
+
+    def drain(sock):
+        buf = bytearray(256 * 1024)
+        while sock.recv_into(buf):
+            pass
+
+    for _, receiver in pairs:
+        threading.Thread(target=drain, args=(receiver,), daemon=True).start()
+
+    def legacy_broadcast(payload):
+        # 旧实现：每帧拼接一次消息，再发给所有客户端
+        message = struct.pack('>Q', len(payload)) + payload
+        for sender, _ in pairs:
+            sender.sendall(message)
+
+    def zero_copy_broadcast(payload):
+        for sender, _ in pairs:
+            send_frame(sender, payload)
+
+    for name, broadcast in (("拼接消息", legacy_broadcast), ("scatter-gather", zero_copy_broadcast)):
+        tracemalloc.start()
+        start_time = time.time()
+        for _ in range(frames):
+            broadcast(frame)
+        elapsed = time.time() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"[{name}] {clients}个客户端, 每帧耗时: {elapsed / frames * 1000:.2f} ms, "
+              f"峰值额外内存: {peak / 1024:.1f} KB")
+
+    for sender, receiver in pairs:
+        sender.close()
+        receiver.close()
+
+    # 基准测试：接收端解析（逐块拼接 vs recv_into 预分配缓冲区），高质量档案约180KB一帧
+    frame = bytes(180 * 1024)
+    frames = 200
+
+    def legacy_receive(sock):
+        # 旧实现：8KB分块接收，每块都拼接到 data_buffer 并重新切片
+        data_buffer = b""
+        for _ in range(frames):
+            while len(data_buffer) < LENGTH_HEADER.size:
+                data_buffer += sock.recv(8192)
+            msg_size = LENGTH_HEADER.unpack(data_buffer[:LENGTH_HEADER.size])[0]
+            data_buffer = data_buffer[LENGTH_HEADER.size:]
+            while len(data_buffer) < msg_size:
+                data_buffer += sock.recv(min(8192, msg_size - len(data_buffer)))
+            data_buffer = data_buffer[msg_size:]
+
+    def recv_into_receive(sock):
+        for _ in range(frames):
+            memoryview(recv_message(sock, max_size=32 * 1024 * 1024))
+
+    for name, receive in (("逐块拼接", legacy_receive), ("recv_into", recv_into_receive)):
+        sender, receiver = socket.socketpair()
+        writer = threading.Thread(target=lambda: [send_frame(sender, frame) for _ in range(frames)], daemon=True)
+        writer.start()
+        start_time = time.time()
+        receive(receiver)
+        elapsed = time.time() - start_time
+        writer.join()
+        print(f"[{name}] 接收 {frames} 帧 x {len(frame) // 1024} KB, 每帧耗时: {elapsed / frames * 1000:.3f} ms")
+        sender.close()
+        receiver.close()
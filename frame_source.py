@@ -0,0 +1,333 @@
+"""
+画面来源抽象。
+
+截图引擎和 NetworkManager 通过 FrameSource 获取原始BGRA画面，而不是直接调用
+mss。除了真实屏幕（MssFrameSource），还提供若干合成画面来源，可以在没有显示器的
+构建机上对“截图→编码→发送”整条链路做基准测试和回归测试。
+
+grab() 返回的对象与 mss 的 ScreenShot 保持相同的接口：bgra / size / width / height。
+"""
+import time
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+class Frame:
+    """一帧原始BGRA画面，接口与 mss.screenshot.ScreenShot 兼容。"""
+
+    __slots__ = ('bgra', 'width', 'height')
+
+    def __init__(self, bgra, width, height):
+        self.bgra = bgra
+        self.width = width
+        self.height = height
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def raw(self):
+        return self.bgra
+
+
+class FrameSource:
+    """
+    画面来源基类。
+
+    默认截取整个监视器；通过 set_region() 可以只截取其中一块矩形区域，
+    截图、转换和编码的开销会按面积同比下降。
+    """
+
+    def __init__(self):
+        # 与 mss 监视器描述保持一致，截图引擎据此计算目标分辨率
+        self.monitor = {'left': 0, 'top': 0, 'width': 0, 'height': 0}
+        self.region = None  # 相对于当前监视器的矩形，None 表示全屏
+
+    def grab(self):
+        """获取一帧画面。"""
+        raise NotImplementedError
+
+    def list_monitors(self):
+        """返回可选的监视器列表（序号从1开始，与 mss 一致）。"""
+        return [self.monitor]
+
+    def select_monitor(self, index):
+        """切换到指定监视器，并恢复全屏截取。"""
+        monitors = self.list_monitors()
+        if not 1 <= index <= len(monitors):
+            raise ValueError(f"无效的监视器序号: {index}")
+        self.monitor = monitors[index - 1]
+        self.region = None
+
+    def set_region(self, region):
+        """
+        设置截取区域。
+
+        Args:
+            region: 相对于当前监视器的 {'left', 'top', 'width', 'height'} 或
+                (left, top, width, height)；None 表示截取整个监视器。
+
+        Raises:
+            ValueError: 区域与监视器没有交集。
+        """
+        self.region = normalize_region(region, self.monitor)
+
+    @property
+    def capture_area(self):
+        """实际截取的矩形（屏幕绝对坐标）。"""
+        if self.region is None:
+            return self.monitor
+        return {
+            'left': self.monitor['left'] + self.region['left'],
+            'top': self.monitor['top'] + self.region['top'],
+            'width': self.region['width'],
+            'height': self.region['height'],
+        }
+
+    def close(self):
+        """释放资源。"""
+        pass
+
+
+class MssFrameSource(FrameSource):
+    """使用 mss 截取真实屏幕。"""
+
+    def __init__(self, monitor_index=1):
+        super().__init__()
+        import mss
+        self.sct = mss.mss()
+        self.select_monitor(monitor_index)
+
+    def grab(self):
+        return self.sct.grab(self.capture_area)
+
+    def list_monitors(self):
+        # monitors[0] 是所有屏幕的合并区域，不作为可选项
+        return self.sct.monitors[1:]
+
+    def close(self):
+        self.sct.close()
+
+
+class SyntheticFrameSource(FrameSource):
+    """合成画面来源基类，按指定分辨率生成BGRA画面。"""
+
+    def __init__(self, width=1920, height=1080, seed=0):
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("合成画面来源需要安装numpy")
+        super().__init__()
+        self.monitor = {'left': 0, 'top': 0, 'width': width, 'height': height}
+        self.width = width
+        self.height = height
+        self.rng = np.random.default_rng(seed)
+        self.frame_index = 0
+
+        # 原始画面缓冲环：grab() 轮流写入其中一块，不再每帧分配新的bytes。
+        # 需要两块，静止画面检测要同时比较上一帧和当前帧。
+        self.raw_ring = []
+        self.ring_index = 0
+
+        # 桌面背景：竖直渐变 + 几个"窗口"
+        self.canvas = np.empty((height, width, 4), dtype=np.uint8)
+        gradient = np.linspace(60, 140, height, dtype=np.uint8)[:, None]
+        self.canvas[:, :, 0] = gradient
+        self.canvas[:, :, 1] = gradient // 2 + 40
+        self.canvas[:, :, 2] = 30
+        self.canvas[:, :, 3] = 255
+        for i in range(3):
+            x = width // 8 + i * width // 5
+            y = height // 8 + i * height // 6
+            self.canvas[y:y + height // 3, x:x + width // 3, :3] = 235
+            self.canvas[y:y + 24, x:x + width // 3, :3] = (200, 120, 40)
+
+    RAW_RING_SIZE = 2
+
+    def grab(self):
+        """
+        渲染并返回一帧画面。
+
+        返回的缓冲区来自 raw_ring，RAW_RING_SIZE 次 grab() 之后会被覆盖，
+        调用方需要保留更久时应自行复制。
+        """
+        self._render()
+        self.frame_index += 1
+        area = self.capture_area
+        left, top = area['left'], area['top']
+        width, height = area['width'], area['height']
+        crop = self.canvas[top:top + height, left:left + width]
+
+        raw, view = self._next_raw_buffer(width, height)
+        np.copyto(view, crop)
+        return Frame(raw, width, height)
+
+    def _next_raw_buffer(self, width, height):
+        """从缓冲环中取出下一块，截取区域变化时重新分配。"""
+        size = width * height * 4
+        if not self.raw_ring or len(self.raw_ring[0][0]) != size:
+            self.raw_ring = []
+            for _ in range(self.RAW_RING_SIZE):
+                raw = bytearray(size)
+                self.raw_ring.append((raw, np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4)))
+        self.ring_index = (self.ring_index + 1) % self.RAW_RING_SIZE
+        raw, view = self.raw_ring[self.ring_index]
+        if view.shape[:2] != (height, width):
+            # 面积相同但宽高不同时只需重新解释形状
+            view = view.reshape(height, width, 4)
+            self.raw_ring[self.ring_index] = (raw, view)
+        return raw, view
+
+    def _render(self):
+        """更新 self.canvas，子类实现。"""
+        pass
+
+    def _glyphs(self, rows, cols, glyph_w=8, glyph_h=14):
+        """生成一块类似文字的黑白块图案。"""
+        mask = self.rng.random((rows * 2, cols)) < 0.55
+        block = np.repeat(np.repeat(mask, glyph_h // 2, axis=0), glyph_w, axis=1)
+        # 字符之间留出间隔
+        block[:, glyph_w - 2::glyph_w] = False
+        return block
+
+
+class StaticDesktopSource(SyntheticFrameSource):
+    """完全静止的桌面。"""
+    pass
+
+
+class ScrollingTextSource(SyntheticFrameSource):
+    """中间窗口内的文字持续向上滚动，模拟浏览网页/查看日志。"""
+
+    def __init__(self, width=1920, height=1080, seed=0, scroll_speed=4):
+        super().__init__(width, height, seed)
+        self.scroll_speed = scroll_speed
+        self.x0, self.x1 = width // 6, width * 5 // 6
+        self.y0, self.y1 = height // 6, height * 5 // 6
+        view_h = self.y1 - self.y0
+        glyph_cols = (self.x1 - self.x0) // 8
+        self.text = self._glyphs(view_h * 2 // 14 + 1, glyph_cols)[:view_h * 2, :self.x1 - self.x0]
+
+    def _render(self):
+        view_h = self.y1 - self.y0
+        offset = (self.frame_index * self.scroll_speed) % (self.text.shape[0] - view_h)
+        window = self.canvas[self.y0:self.y1, self.x0:self.x0 + self.text.shape[1], :3]
+        window[:] = 250
+        window[self.text[offset:offset + view_h]] = 20
+
+
+class VideoNoiseSource(SyntheticFrameSource):
+    """每帧全屏随机噪声，模拟全屏视频的最坏情况。"""
+
+    def _render(self):
+        self.canvas[:, :, :3] = self.rng.integers(0, 256, (self.height, self.width, 3), dtype=np.uint8)
+
+
+class TypingSource(SyntheticFrameSource):
+    """在编辑器窗口中逐字输入，每帧只有一个字符大小的区域变化。"""
+
+    def __init__(self, width=1920, height=1080, seed=0, glyph_size=(8, 14)):
+        super().__init__(width, height, seed)
+        self.glyph_w, self.glyph_h = glyph_size
+        self.x0, self.y0 = width // 8, height // 4
+        self.cols = (width * 3 // 4) // self.glyph_w
+        self.rows = (height // 2) // self.glyph_h
+        self.canvas[self.y0:self.y0 + self.rows * self.glyph_h,
+                    self.x0:self.x0 + self.cols * self.glyph_w, :3] = 250
+
+    def _render(self):
+        position = self.frame_index % (self.rows * self.cols)
+        if position == 0:
+            # 写满一屏后清空编辑器
+            self.canvas[self.y0:self.y0 + self.rows * self.glyph_h,
+                        self.x0:self.x0 + self.cols * self.glyph_w, :3] = 250
+        row, col = divmod(position, self.cols)
+        y = self.y0 + row * self.glyph_h
+        x = self.x0 + col * self.glyph_w
+        glyph = self._glyphs(1, 1, self.glyph_w, self.glyph_h)
+        cell = self.canvas[y:y + self.glyph_h, x:x + self.glyph_w, :3]
+        cell[:] = 250
+        cell[glyph] = 20
+
+
+def normalize_region(region, monitor):
+    """将区域统一为字典并裁剪到监视器范围内，None 保持不变。"""
+    if region is None:
+        return None
+    if not isinstance(region, dict):
+        left, top, width, height = region
+        region = {'left': left, 'top': top, 'width': width, 'height': height}
+
+    left = max(0, int(region['left']))
+    top = max(0, int(region['top']))
+    right = min(monitor['width'], int(region['left']) + int(region['width']))
+    bottom = min(monitor['height'], int(region['top']) + int(region['height']))
+    if right <= left or bottom <= top:
+        raise ValueError(f"截取区域超出监视器范围: {region}")
+    return {'left': left, 'top': top, 'width': right - left, 'height': bottom - top}
+
+
+SYNTHETIC_SOURCES = {
+    "static": StaticDesktopSource,
+    "scrolling": ScrollingTextSource,
+    "video": VideoNoiseSource,
+    "typing": TypingSource,
+}
+
+
+def create_frame_source(kind="mss", width=1920, height=1080, monitor_index=1):
+    """
+    按名称创建画面来源。
+
+    Args:
+        kind (str): "mss" 或 SYNTHETIC_SOURCES 中的名称。
+        width (int): 合成画面宽度。
+        height (int): 合成画面高度。
+        monitor_index (int): mss 监视器序号。
+
+    Returns:
+        FrameSource: 画面来源实例。
+    """
+    if kind == "mss":
+        return MssFrameSource(monitor_index)
+    if kind not in SYNTHETIC_SOURCES:
+        raise ValueError(f"未知的画面来源: {kind}")
+    return SYNTHETIC_SOURCES[kind](width, height)
+
+
+if __name__ == '__main__':
+    # 无显示器基准测试：用合成画面驱动完整的 截图→编码→发送→接收 链路
+    import sys
+    from network_comms import NetworkManager
+
+    duration = 5
+    width, height = 1920, 1080
+    kinds = sys.argv[1:] or list(SYNTHETIC_SOURCES)
+
+    for i, kind in enumerate(kinds):
+        for j, profile in enumerate(("performance", "balanced", "quality")):
+            port = 47000 + i * 10 + j * 2
+            sender = NetworkManager(host='127.0.0.1', port=port,
+                                    frame_source=create_frame_source(kind, width, height))
+            sender.performance_profile = profile
+            receiver = NetworkManager(host='127.0.0.1', port=port + 1)
+            stats = {"frames": 0, "bytes": 0}
+
+            def on_data(addr, data, stats=stats):
+                stats["frames"] += 1
+                stats["bytes"] += len(data)
+
+            receiver.on_data_received = on_data
+            receiver.running = True
+            sender.start_server()
+            receiver.connect_to_peer('127.0.0.1', port)
+            time.sleep(duration)
+            sender.stop()
+            receiver.stop()
+
+            frames = max(1, stats["frames"])
+            print(f"[{kind:>9} | {profile:>11}] FPS: {stats['frames'] / duration:5.1f}, "
+                  f"平均帧大小: {stats['bytes'] / frames / 1024:7.2f} KB")
@@ -0,0 +1,290 @@
+"""
+图像编码注册表。
+
+截图链路不再固定使用JPEG：每个连接在握手时由观看端给出自己支持的编码（按偏好排序），
+发送端选出双方都支持的第一个，之后发给该连接的完整帧和分块帧里的每一块都用这种编码。
+文字、终端等内容用无损编码往往比低质量JPEG更清晰，体积也不一定更大。
+
+每种编码的输出都以各自的魔数开头，观看端用 decode_image() 即可自动识别，
+即使连接的是不支持握手的旧版发送端（只发JPEG）也能正常解码。
+"""
+import io
+import struct
+import time
+import zlib
+
+from PIL import Image, features
+
+
+class ImageCodec:
+    """编码基类。子类实现 _save()，并给出输出数据开头的魔数。"""
+
+    name = None
+    id = 0  # 协议v2帧头中的编码ID，一经发布不可更改
+    lossless = False
+    magic = b''
+
+    def is_available(self):
+        """当前Pillow是否支持该编码"""
+        return True
+
+    def encode(self, region, quality=30, out=None):
+        """
+        将一块RGB区域编码。
+
+        Args:
+            region: RGB格式的numpy数组 (H, W, 3) 或 PIL Image。
+            quality (int): 压缩质量，无损编码忽略此参数。
+            out: 可选的帧缓冲池缓冲区，给出时直接写入其中并返回它。
+
+        Returns:
+            memoryview: 指向编码缓冲区的memoryview（不复制）；给出 out 时返回 out。
+        """
+        img = region if isinstance(region, Image.Image) else Image.fromarray(region, 'RGB')
+        if out is not None:
+            self._save(img, out, quality)
+            return out
+        buffer = io.BytesIO()
+        self._save(img, buffer, quality)
+        return buffer.getbuffer()
+
+    def _save(self, img, fp, quality):
+        raise NotImplementedError
+
+    def matches(self, data):
+        """判断数据是否由本编码产生"""
+        return bytes(data[:len(self.magic)]) == self.magic
+
+    def decode(self, data, reduce=1):
+        """
+        解码为RGB图像。
+
+        Args:
+            reduce (int): 缩小倍数，返回 reduced_size(原尺寸, reduce) 大小的图像。
+        """
+        return _reduce(_open_rgb(data), reduce)
+
+    def size(self, data):
+        """只读取头部，返回 (宽, 高)，不解码像素"""
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+
+
+class JpegCodec(ImageCodec):
+    name = "jpeg"
+    id = 1
+    magic = b'\xff\xd8'
+
+    def _save(self, img, fp, quality):
+        img.save(fp, format='JPEG', quality=quality, optimize=False)
+
+    def decode(self, data, reduce=1):
+        """缩小解码时用 draft() 让libjpeg直接按1/2、1/4、1/8做DCT缩放，省去大部分解码开销"""
+        if reduce == 1:
+            return _open_rgb(data)
+        img = Image.open(io.BytesIO(data))
+        target = reduced_size(img.size, reduce)
+        img.draft('RGB', target)
+        img.load()
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # draft() 只支持8以内的2的幂，其余倍数补一次缩放
+        return img if img.size == target else img.resize(target, Image.Resampling.BILINEAR)
+
+
+class WebpCodec(ImageCodec):
+    """WebP。method=0 是最快的压缩档位，适合实时画面。"""
+
+    def __init__(self, lossless=False):
+        self.lossless = lossless
+        self.name = "webp_lossless" if lossless else "webp"
+        self.id = 3 if lossless else 2
+
+    def is_available(self):
+        return features.check('webp')
+
+    def _save(self, img, fp, quality):
+        if self.lossless:
+            # 无损模式下 quality 表示压缩力度，取最低以保证速度
+            img.save(fp, format='WEBP', lossless=True, quality=0, method=0)
+        else:
+            img.save(fp, format='WEBP', quality=quality, method=0)
+
+    def matches(self, data):
+        return bytes(data[:4]) == b'RIFF' and bytes(data[8:12]) == b'WEBP'
+
+
+class PngCodec(ImageCodec):
+    """PNG；palette=True 时先量化为256色调色板，文字界面几乎看不出损失，体积小很多。"""
+
+    magic = b'\x89PNG'
+
+    def __init__(self, palette=False):
+        self.palette = palette
+        self.lossless = not palette
+        self.name = "png_palette" if palette else "png"
+        self.id = 5 if palette else 4
+
+    def _save(self, img, fp, quality):
+        if self.palette:
+            img = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        img.save(fp, format='PNG', compress_level=1)
+
+
+class ZlibRawCodec(ImageCodec):
+    """原始RGB像素 + zlib，编码最快的无损方式。"""
+
+    name = "zlib"
+    id = 6
+    lossless = True
+    magic = b'GHRZ'
+    # 头部: 魔数, 宽, 高
+    HEADER = struct.Struct('>4sHH')
+
+    def _save(self, img, fp, quality):
+        fp.write(self.HEADER.pack(self.magic, img.width, img.height))
+        fp.write(zlib.compress(img.tobytes(), 1))
+
+    def size(self, data):
+        return self.HEADER.unpack_from(data, 0)[1:]
+
+    # 单帧像素数上限（8K），防止对方用很小的压缩数据让观看端解压出巨大的缓冲区
+    MAX_PIXELS = 7680 * 4320
+
+    def decode(self, data, reduce=1):
+        _, width, height = self.HEADER.unpack_from(data, 0)
+        if width * height > self.MAX_PIXELS:
+            raise ValueError(f"zlib帧尺寸 {width}x{height} 超过上限")
+        expected = width * height * 3
+        decompressor = zlib.decompressobj()
+        pixels = decompressor.decompress(memoryview(data)[self.HEADER.size:], expected)
+        if len(pixels) != expected or decompressor.unconsumed_tail:
+            raise ValueError("zlib帧像素数据与尺寸不符")
+        return _reduce(Image.frombytes("RGB", (width, height), pixels), reduce)
+
+
+# 注册表：名称 → 编码实例（顺序即默认偏好顺序）
+CODECS = {codec.name: codec for codec in (
+    JpegCodec(),
+    WebpCodec(),
+    WebpCodec(lossless=True),
+    PngCodec(),
+    PngCodec(palette=True),
+    ZlibRawCodec(),
+)}
+
+DEFAULT_CODEC = "jpeg"
+
+
+def get_codec_by_id(codec_id):
+    """按协议v2帧头中的编码ID取编码，未知ID返回None"""
+    for codec in CODECS.values():
+        if codec.id == codec_id:
+            return codec
+    return None
+
+
+def get_codec(name):
+    """按名称取编码，不存在或当前环境不可用时返回JPEG"""
+    codec = CODECS.get(name)
+    if codec is None or not codec.is_available():
+        return CODECS[DEFAULT_CODEC]
+    return codec
+
+
+def available_codecs():
+    """当前环境可用的编码名称列表"""
+    return [name for name, codec in CODECS.items() if codec.is_available()]
+
+
+def negotiate(offered):
+    """
+    从对方给出的编码列表（按偏好排序）中选出本端支持的第一个。
+
+    Args:
+        offered: 握手中的 codecs 字段，不是字符串列表时按没有给出处理。
+
+    Returns:
+        str: 编码名称；没有共同支持的编码时返回JPEG（所有版本都支持）。
+    """
+    if not isinstance(offered, list):
+        return DEFAULT_CODEC
+    supported = available_codecs()
+    for name in offered:
+        if isinstance(name, str) and name in supported:
+            return name
+    return DEFAULT_CODEC
+
+
+def decode_image(data, reduce=1):
+    """
+    按数据开头的魔数识别编码并解码为RGB图像。
+
+    Args:
+        reduce (int): 缩小倍数（1为原尺寸），JPEG在解码时直接缩小，其余编码解码后再缩小。
+    """
+    for codec in CODECS.values():
+        if codec.matches(data):
+            return codec.decode(data, reduce)
+    # 未知格式交给Pillow自行识别
+    return _reduce(_open_rgb(data), reduce)
+
+
+def reduced_size(size, reduce):
+    """缩小 reduce 倍后的尺寸（向上取整，与libjpeg的DCT缩放一致）"""
+    return (-(-size[0] // reduce), -(-size[1] // reduce))
+
+
+def image_size(data):
+    """按魔数识别编码，只读取头部返回 (宽, 高)"""
+    for codec in CODECS.values():
+        if codec.matches(data):
+            return codec.size(data)
+    with Image.open(io.BytesIO(data)) as img:
+        return img.size
+
+
+def _open_rgb(data):
+    """用Pillow解码并立即读取像素，统一返回RGB图像"""
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+
+def _reduce(img, reduce):
+    """按整数倍缩小（每块像素取平均，比重采样快得多）"""
+    return img if reduce == 1 else img.reduce(reduce)
+
+
+if __name__ == '__main__':
+    # 基准测试：各编码在文字画面和视频画面上的耗时与体积
+    from frame_source import ScrollingTextSource, VideoNoiseSource
+    from image_scaling import area_downscale_bgra
+
+    rounds = 5
+    for source in (ScrollingTextSource(1920, 1080), VideoNoiseSource(1920, 1080)):
+        sct_img = source.grab()
+        img = area_downscale_bgra(sct_img.raw, sct_img.width, sct_img.height, 960, 540)
+        for name in available_codecs():
+            codec = CODECS[name]
+            start_time = time.time()
+            for _ in range(rounds):
+                data = codec.encode(img, quality=30)
+            encode_time = (time.time() - start_time) / rounds
+
+            start_time = time.time()
+            for _ in range(rounds):
+                decoded = decode_image(data)
+            decode_time = (time.time() - start_time) / rounds
+            assert decoded.size == img.size
+
+            # 观看窗口小于画面时的缩小解码（见 ViewerWindow）
+            start_time = time.time()
+            for _ in range(rounds):
+                decoded = decode_image(data, reduce=4)
+            reduced_time = (time.time() - start_time) / rounds
+            assert decoded.size == reduced_size(img.size, 4)
+
+            print(f"[{type(source).__name__:>19} | {name:>13}] 编码: {encode_time * 1000:6.1f} ms, "
+                  f"解码: {decode_time * 1000:6.1f} ms, 1/4解码: {reduced_time * 1000:6.1f} ms, "
+                  f"大小: {len(data) / 1024:7.1f} KB")
@@ -0,0 +1,106 @@
+"""
+区域平均（box filter）缩放。
+
+直接从截图的BGRA缓冲区缩放到目标尺寸并输出RGB图像：BGRX→RGB的通道转换在
+Pillow解包时一次完成，随后按缩放比例选择开销不高于原先隔点采样的做法：
+- 整数倍（如0.5、0.25）：reduce() 精确地求每块像素的平均。
+- 其他比例小于0.5：先最近邻取样到目标尺寸的2倍，再 reduce(2) 求平均，
+  每个输出像素是其覆盖区域内 2×2 个取样点的平均（取样更多时中间图像接近原尺寸，开销反而更高）。
+- 0.5到1之间：直接最近邻取样。Pillow的BOX滤波在这一区间的开销是原方法的2~3倍，
+  而最近邻取样仍保留全分辨率的细节，比原先先隔点采样再放大清晰。
+全部在C代码中完成，支持任意缩放比例。
+"""
+from PIL import Image
+import time
+
+
+def bgra_to_rgb(raw, width, height, out=None):
+    """
+    将BGRA原始数据转换为RGB图像。
+
+    传入上一帧返回的图像作为 out 时，若尺寸一致则直接解码到这块内存中，
+    不再为每帧重新分配一张全尺寸图像。
+
+    Returns:
+        PIL.Image.Image: RGB图像（可能就是 out 本身）。
+    """
+    if out is None or out.size != (width, height):
+        return Image.frombuffer("RGB", (width, height), raw, "raw", "BGRX", 0, 1)
+    out.frombytes(raw, "raw", "BGRX", 0, 1)
+    return out
+
+
+def area_downscale_bgra(raw, width, height, target_width, target_height, out=None):
+    """
+    将BGRA原始数据区域平均缩小到目标尺寸。
+
+    Args:
+        raw: BGRA原始缓冲区（bytes/bytearray/memoryview）。
+        width (int): 源宽度。
+        height (int): 源高度。
+        target_width (int): 目标宽度。
+        target_height (int): 目标高度。
+        out (PIL.Image.Image): 可复用的源尺寸RGB图像，见 bgra_to_rgb()。
+
+    Returns:
+        PIL.Image.Image: 目标尺寸的RGB图像；不缩放时就是转换后的源图像。
+    """
+    return area_downscale(bgra_to_rgb(raw, width, height, out), target_width, target_height)
+
+
+def area_downscale(img, target_width, target_height):
+    """将RGB图像区域平均缩小到目标尺寸（各比例的做法见模块说明），尺寸相同时原样返回。"""
+    if img.size == (target_width, target_height):
+        return img
+    factor = min(img.width // target_width, img.height // target_height)
+    if img.size == (target_width * factor, target_height * factor):
+        return img.reduce(factor)
+    if factor <= 1:
+        return img.resize((target_width, target_height), Image.NEAREST)
+    return img.resize((target_width * 2, target_height * 2), Image.NEAREST).reduce(2)
+
+
+def scaled_size(width, height, scale_factor):
+    """按缩放比例计算目标尺寸（至少1像素）。"""
+    return max(1, int(width * scale_factor)), max(1, int(height * scale_factor))
+
+
+if __name__ == '__main__':
+    # 与原先"隔点采样 + 通道交换 + 最近邻缩放"的做法比较耗时
+    import numpy as np
+    from frame_source import ScrollingTextSource
+
+    sct_img = ScrollingTextSource(1920, 1080).grab()
+    rounds = 20
+    slower = []
+
+    def legacy(target):
+        raw_data = np.frombuffer(sct_img.bgra, dtype=np.uint8).reshape((sct_img.height, sct_img.width, 4))
+        sampled_rgb = raw_data[::2, ::2, :3][:, :, [2, 1, 0]]
+        img = Image.fromarray(sampled_rgb, 'RGB')
+        if img.size != target:
+            img = img.resize(target, Image.NEAREST)
+        return img
+
+    for scale in (0.5, 0.75, 0.6, 0.4, 0.33, 0.3, 0.25):
+        target = scaled_size(1920, 1080, scale)
+
+        start_time = time.time()
+        for _ in range(rounds):
+            legacy(target)
+        legacy_time = (time.time() - start_time) / rounds
+
+        rgb_frame = None
+        start_time = time.time()
+        for _ in range(rounds):
+            # 与截图路径一样复用源尺寸的RGB图像
+            rgb_frame = bgra_to_rgb(sct_img.raw, 1920, 1080, rgb_frame)
+            area_downscale(rgb_frame, *target)
+        area_time = (time.time() - start_time) / rounds
+
+        print(f"[缩放 {scale}] 原方法: {legacy_time * 1000:.1f} ms, 区域平均: {area_time * 1000:.1f} ms")
+        # 开销检查：任何比例都不应比原方法慢（留10%的计时误差）
+        if area_time > legacy_time * 1.1:
+            slower.append(scale)
+
+    print(f"开销检查: {'比原方法慢的缩放比例 ' + str(slower) if slower else '所有缩放比例的开销均不高于原方法'}")
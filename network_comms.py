@@ -1,32 +1,90 @@
 import socket
 import threading
 import time
-import struct
 import json
 from queue import Queue, Empty
 from screen_capture import capture_screen, compress_image
+from frame_source import MssFrameSource, normalize_region
+from frame_protocol import (send_frame, recv_message, unpack_frame, pack_handshake, is_handshake,
+                            unpack_handshake, is_control, unpack_control, negotiate_version,
+                            pack_frame_header, is_tile_frame, TILE_FRAME_HEADER, FLAG_KEYFRAME,
+                            PROTOCOL_VERSION)
+from image_codecs import get_codec, negotiate, image_size, DEFAULT_CODEC
+from frame_pool import FramePool, PooledBuffer, release_payload
+from client_sender import ClientSender
+from udp_transport import UdpSender, UdpReceiver, DEFAULT_FRAGMENT_SIZE, MAX_FEC_GROUP
+from peer_session import PeerSession
+from image_scaling import bgra_to_rgb, area_downscale, scaled_size
 
 # 优化版截图和压缩功能
 try:
-    from screen_capture_optimized import capture_screen_scaled, compress_image_fast
+    from screen_capture_optimized import OptimizedScreenCapture
     OPTIMIZED_AVAILABLE = True
 except ImportError:
     OPTIMIZED_AVAILABLE = False
 
 try:
-    from screen_capture_ultra import capture_and_compress_ultra_fast
+    from screen_capture_ultra import UltraFastScreenCapture
     ULTRA_AVAILABLE = True
 except ImportError:
     ULTRA_AVAILABLE = False
 
+# 分块差分编码与多线程条带编码（需要numpy）
+try:
+    from screen_capture_diff import TileDiffEncoder, NUMPY_AVAILABLE as DIFF_AVAILABLE
+except ImportError:
+    DIFF_AVAILABLE = False
+
+try:
+    from parallel_encoder import StripEncoder, NUMPY_AVAILABLE as PARALLEL_AVAILABLE
+except ImportError:
+    PARALLEL_AVAILABLE = False
+
+from adaptive_controller import AdaptiveController
+
+# 等待观看端握手消息的时间，超时视为不支持握手的旧版观看端（使用JPEG）
+HANDSHAKE_TIMEOUT = 1.0
+MAX_HANDSHAKE_SIZE = 4096
+
+# 默认的单帧大小上限（MB），防止损坏的长度头触发巨量内存分配
+MAX_FRAME_MB = 32
+
+# 同时编码的画面档位（相对于性能档案输出分辨率的比例），观看端只收到满足其显示尺寸的最小档位
+DEFAULT_SIMULCAST_SCALES = [1.0, 0.5, 0.25]
+# 没有客户端时编码的画面流：默认编码、第一档、不抽帧、完整帧
+DEFAULT_STREAM = (DEFAULT_CODEC, 0, 1, False)
+RELAY_MAX_CLIENTS = 8  # 转发模式下每个节点默认最多服务的观看端
+
+# 每路画面流占用的帧缓冲池大小
+FRAME_POOL_SLOTS = 6
+
+# 单个慢客户端因丢帧请求关键帧的最小间隔（秒）
+KEYFRAME_REQUEST_INTERVAL = 1.0
+
 class NetworkManager:
-    def __init__(self, host='0.0.0.0', port=55555):
+    LISTEN_BACKLOG = 5
+    UDP_SUPPORTED = True  # 是否可以按观看端的请求经UDP发送画面
+    SESSION_SUPPORTED = True  # 是否支持同伴会话（互相观看时共用一条连接）
+    
+    def __init__(self, host='0.0.0.0', port=55555, frame_source=None):
         self.host = host
         self.port = port
         self.running = False
         self.server_socket = None
         self.clients = {}  # K: (ip, port), V: socket
+        self.client_senders = {}  # K: (ip, port), V: ClientSender（常驻发送线程）
+        self.client_codecs = {}  # K: (ip, port), V: 握手协商的编码名称
+        self.client_tiles = {}  # K: (ip, port), V: 观看端是否在握手中声明可以解码分块帧
+        self.client_requests = {}  # K: (ip, port), V: (显示尺寸 (宽, 高) 或 None, 需要的帧率)
+        self.client_streams = {}  # K: (ip, port), V: 当前发送的画面流 (编码名称, 档位, 抽帧间隔, 分块帧)
+        self.pending_clients = set()  # 正在握手的客户端地址
+        self.admit_lock = threading.Lock()  # 检查转发上限与登记 pending_clients 须一起完成
         self.peers = {} # K: peer_addr, V: (socket, thread)
+        self.peer_codecs = {}  # K: peer_addr, V: 对方发送端确认的编码名称
+        self.peer_udp = {}  # K: peer_addr, V: UdpReceiver（本端请求了UDP传输时）
+        self.sessions = {}  # K: 同伴的服务端地址, V: PeerSession（互相观看共用的连接）
+        self.relay_from = None  # 转发模式：原样转发给本端观看端的同伴地址，None为发送本机画面
+        self._last_upstream_keyframe_request = 0.0
         self.on_peer_connected = None
         self.on_peer_disconnected = None
         self.on_data_received = None
@@ -36,6 +94,10 @@ class NetworkManager:
         self.capture_thread = None
         self.send_thread = None
         
+        # 按需截图：没有观看端时截图线程停在条件变量上，第一个观看端连接时唤醒
+        self.capture_cond = threading.Condition()
+        self.capture_idle = False
+        
         # 性能统计
         self.frame_count = 0
         self.last_fps_time = time.time()
@@ -47,6 +109,32 @@ class NetworkManager:
         # 性能档案设置
         self.performance_profile = self.config.get("performance", {}).get("profile", "balanced")
         print(f"网络管理器初始化，性能档案: {self.performance_profile}")
+        
+        # 分块差分编码器（每路画面流一个，各自保存差分基准）与并行条带编码器（按需创建）
+        self.tile_encoders = {}
+        self.strip_encoder = None
+        
+        # 自适应码率控制器（仅在 adaptive 档案下创建）
+        self.adaptive_controller = None
+        
+        # 静止画面检测与保活
+        self._last_raw = None
+        self._force_send = True
+        self.static_frames_skipped = 0
+        self._frame_id = 0  # 协议v2帧序号，每个编码出的画面加一
+        self._stream_sizes = []  # 最近一帧各档位的分辨率
+        self._last_send_time = time.time()
+        
+        # 帧缓冲池：编码结果写入复用的缓冲区，所有客户端发送完毕后回收。
+        # 每种编码：队列中最多3帧 + 正在编码1帧 + 正在发送1~2帧
+        self.frame_pool = FramePool(slots=FRAME_POOL_SLOTS)
+        self._rgb_frame = None  # 高质量模式复用的RGB图像
+        
+        # 画面来源：为None时在截图线程中按需创建mss来源
+        self.frame_source = frame_source
+        self._capture_area_changed = True  # 截取区域/监视器设置待应用到画面来源
+        self.optimized_capture = None
+        self.ultra_capture = None
 
     def _load_config(self):
         """加载配置文件"""
@@ -63,9 +151,16 @@ class NetworkManager:
                 return config
         except (FileNotFoundError, json.JSONDecodeError):
             return {
-                "network": {"default_port": 55555, "fps": 15, "jpeg_quality": 50},
-                "viewer": {"default_width": 480, "default_height": 270, "zoom_scale": 1.5},
-                "performance": {"profile": "balanced"}
+                "network": {"default_port": 55555, "fps": 15, "jpeg_quality": 50, "backend": "threads",
+                            "max_frame_mb": MAX_FRAME_MB, "relay_max_clients": RELAY_MAX_CLIENTS},
+                "viewer": {"default_width": 480, "default_height": 270, "zoom_scale": 1.5, "codec": "jpeg",
+                           "transport": "tcp", "udp_fec": 0, "max_fps": 0},
+                "capture": {"monitor": 1, "region": None},
+                "performance": {"profile": "balanced", "tile_diff": True, "tile_size": 64, "keyframe_interval": 60,
+                                "parallel_encode": True, "encode_workers": 0,
+                                "static_suppression": True, "keepalive_interval": 1.0,
+                                "target_latency_ms": 100, "target_bandwidth_kbps": 20000,
+                                "simulcast_scales": DEFAULT_SIMULCAST_SCALES, "capture_warmup": True}
             }
 
     def start_server(self):
@@ -73,11 +168,10 @@ class NetworkManager:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 优化：允许端口重用
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.LISTEN_BACKLOG)
         
         # 启动各个优化线程
-        server_thread = threading.Thread(target=self._server_loop, daemon=True)
-        server_thread.start()
+        self._start_accepting()
         
         self.capture_thread = threading.Thread(target=self._capture_loop, daemon=True)
         self.capture_thread.start()
@@ -88,48 +182,270 @@ class NetworkManager:
         print(f"[*] 优化服务已启动，监听于 {self.host}:{self.port}")
         print(f"[*] 性能档案: {self.performance_profile}, 目标FPS: {self.config['network']['fps']}")
 
+    def _start_accepting(self):
+        """启动接受客户端连接的线程"""
+        server_thread = threading.Thread(target=self._server_loop, daemon=True)
+        server_thread.start()
+
+    def _configure_client_socket(self, client_socket):
+        """设置新客户端连接的套接字选项"""
+        # 优化：设置TCP_NODELAY减少延迟
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # 优化：设置发送缓冲区大小
+        client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)  # 128KB发送缓冲
+
     def _server_loop(self):
         """接受客户端连接的循环"""
         while self.running:
             try:
                 client_socket, addr = self.server_socket.accept()
-                # 优化：设置TCP_NODELAY减少延迟
-                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-                # 优化：设置发送缓冲区大小
-                client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 131072)  # 128KB发送缓冲
+                self._configure_client_socket(client_socket)
                 print(f"[+] 新的连接来自: {addr}")
-                self.clients[addr] = client_socket
+                # 握手在单独的线程中进行，不阻塞后续连接
+                threading.Thread(target=self._accept_client, args=(client_socket, addr), daemon=True).start()
             except OSError:
                 break # Socket was closed
         print("服务器循环已停止.")
+    
+    def _accept_client(self, client_socket, addr):
+        """等待观看端的握手消息并协商编码，完成后加入客户端列表"""
+        if not self._reserve_client(addr):
+            client_socket.close()
+            return
+        session = self._handshake_session({})  # 旧版观看端不发送握手
+        try:
+            client_socket.settimeout(HANDSHAKE_TIMEOUT)
+            message = recv_message(client_socket, MAX_HANDSHAKE_SIZE)
+            if is_handshake(message):
+                session = self._handshake_session(unpack_handshake(message))
+                if session["peer_port"] and (addr[0], session["peer_port"]) in self.sessions:
+                    session["peer_port"] = 0  # 与对方已有会话（例如双方同时连接），这条连接按普通观看端处理
+                send_frame(client_socket, self._handshake_reply(session))
+        except socket.timeout:
+            pass  # 旧版观看端不发送握手
+        except Exception as e:
+            # 任何失败都要释放登记的名额，否则该连接会一直占用转发上限
+            print(f"[-] 客户端 {addr} 握手失败: {e}")
+            client_socket.close()
+            self.pending_clients.discard(addr)
+            return
+        client_socket.settimeout(None)
+        
+        if session["udp"]:
+            try:
+                sender = self._create_udp_sender(client_socket, addr, *session["udp"])
+            except OSError as e:
+                print(f"[-] 客户端 {addr} 创建UDP发送失败: {e}")
+                client_socket.close()
+                self.pending_clients.discard(addr)
+                return
+        elif session["peer_port"]:
+            # 同伴会话：对方之后可以经这条连接请求本端观看它
+            peer_session = PeerSession(client_socket, (addr[0], session["peer_port"]), dialed=False)
+            peer_session.watched = True
+            self.sessions[peer_session.key] = peer_session
+            sender = ClientSender(client_socket, addr, on_sent=self._on_client_sent,
+                                  on_closed=self._on_client_closed, on_dropped=self._on_client_dropped,
+                                  write_lock=peer_session.write_lock)
+            self._register_client(addr, client_socket, sender, session)
+            self._start_session_reader(peer_session)
+            return
+        else:
+            sender = ClientSender(client_socket, addr, on_sent=self._on_client_sent,
+                                  on_closed=self._on_client_closed, on_dropped=self._on_client_dropped)
+        self._register_client(addr, client_socket, sender, session)
+    
+    def _admit_client(self, addr):
+        """转发模式下限制下游观看端数量（network.relay_max_clients），超出时拒绝连接"""
+        if self.relay_from is None:
+            return True
+        limit = self.config.get("network", {}).get("relay_max_clients", RELAY_MAX_CLIENTS)
+        if 0 < limit <= len(self.clients) + self._pending_client_count():
+            print(f"[-] 拒绝 {addr}：转发的观看端已达上限 {limit}")
+            return False
+        return True
+    
+    def _reserve_client(self, addr):
+        """
+        检查转发上限并登记为正在握手的连接。两步在同一把锁内完成，
+        同时到达的多个连接各自的握手线程不会都通过检查而超出上限。
+        """
+        with self.admit_lock:
+            if not self._admit_client(addr):
+                return False
+            self.pending_clients.add(addr)
+            return True
+
+    def _pending_client_count(self):
+        """已接受、尚未完成握手的连接数"""
+        return len(self.pending_clients)
+    
+    def _handshake_session(self, info):
+        """
+        根据观看端的握手信息协商本连接的参数；info 为空字典时得到旧版观看端的默认值。
+        握手内容来自网络，格式不对的字段按缺省处理，不会抛出异常。
+        
+        Returns:
+            dict: codec（编码名称）, version（协议版本）, tiles（是否发送分块帧）,
+                udp（(UDP端口, FEC分组大小) 或 None）,
+                display（观看端显示的最大尺寸 (宽, 高)，未知为None）, fps（观看端需要的帧率，0为不限）,
+                peer_port（对方请求同伴会话时其服务端口，否则为0）
+        """
+        def number(key, convert=int):
+            try:
+                return convert(info.get(key) or 0)
+            except (TypeError, ValueError, OverflowError):
+                return 0
+        
+        udp_port, fec_group = number("udp_port"), number("fec")
+        udp = None
+        if self.UDP_SUPPORTED and 0 < udp_port <= 65535:
+            udp = (udp_port, max(0, min(fec_group, MAX_FEC_GROUP)))
+        
+        display = info.get("display")
+        try:
+            display = (int(display[0]), int(display[1])) if isinstance(display, (list, tuple)) else None
+        except (TypeError, ValueError, IndexError, OverflowError):
+            display = None
+        
+        codec_name = negotiate(info.get("codecs")) if info else DEFAULT_CODEC
+        if self.relay_from is not None:
+            # 转发的画面保持上游的编码（观看端按数据本身的格式标识解码）
+            codec_name = self.peer_codecs.get(self.relay_from, DEFAULT_CODEC)
+        
+        return {
+            "codec": codec_name,
+            "version": negotiate_version(info),
+            # 只有在握手中声明能解码分块帧的观看端才收到差分帧；旧版观看端只收完整的JPEG帧
+            "tiles": info.get("tiles") is True,
+            "udp": udp,
+            "display": display if display and display[0] > 0 and display[1] > 0 else None,
+            "fps": max(0.0, number("fps", float)),
+            # 会话的两个方向共用TCP连接；请求UDP传输的观看端不建立会话
+            "peer_port": number("session_port") if self.SESSION_SUPPORTED and not udp else 0,
+        }
+    
+    def _handshake_reply(self, session):
+        """握手回复：告知观看端选定的编码、协议版本、是否发送分块帧、传输方式，以及是否接受同伴会话"""
+        reply = {"codec": session["codec"], "version": session["version"], "tiles": session["tiles"],
+                 "transport": "udp" if session["udp"] else "tcp"}
+        if session["peer_port"]:
+            reply["session"] = True
+        return pack_handshake(reply)
+    
+    def _create_udp_sender(self, client_socket, addr, udp_port, fec_group):
+        """为请求UDP传输的观看端创建发送线程，画面发往其IP的 udp_port"""
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+            udp_socket.connect((addr[0], udp_port))
+        except OSError:
+            udp_socket.close()
+            raise
+        print(f"[*] 客户端 {addr} 使用UDP传输，端口 {udp_port}，FEC分组 {fec_group or '关闭'}")
+        return UdpSender(udp_socket, client_socket, addr, DEFAULT_FRAGMENT_SIZE, fec_group,
+                         on_sent=self._on_client_sent, on_closed=self._on_client_closed,
+                         on_dropped=self._on_client_dropped)
+    
+    def _register_client(self, addr, client_socket, sender, session):
+        """握手完成后加入客户端列表，从下一帧开始向其发送画面"""
+        display = "{}x{}".format(*session["display"]) if session["display"] else "未知"
+        print(f"[*] 客户端 {addr} 使用编码: {session['codec']}, 协议v{session['version']}, "
+              f"{'分块帧' if session['tiles'] else '仅完整帧'}, 显示尺寸: {display}, 帧率: {session['fps'] or '不限'}")
+        sender.protocol_version = session["version"]
+        self.client_codecs[addr] = session["codec"]
+        self.client_tiles[addr] = session["tiles"]
+        self.client_requests[addr] = (session["display"], session["fps"])
+        self.client_senders[addr] = sender
+        self.clients[addr] = client_socket
+        self.pending_clients.discard(addr)
+        # 新客户端需要完整画面作为差分基准，即使画面静止也要发送；
+        # 下一帧为它选定画面流时会向对应的差分编码器请求关键帧
+        self._force_send = True
+        self._wake_capture()
+        if self.relay_from is not None:
+            self._request_upstream_keyframe()
+    
+    def _wake_capture(self):
+        """唤醒等待观看端的截图线程（有客户端加入或服务停止时调用）"""
+        with self.capture_cond:
+            self.capture_cond.notify_all()
+    
+    def _capture_paused(self):
+        """没有观看端，或处于转发模式（观看端收到的是转发的画面）时不需要截图"""
+        return not self.client_senders or self.relay_from is not None
+    
+    def _wait_for_clients(self):
+        """
+        没有观看端时暂停截图和编码，直到第一个客户端连接或服务停止；转发模式下同样暂停。
+        
+        performance.capture_warmup 开启时，暂停前先创建画面来源并截取一帧，
+        让第一个观看端连接时无需等待mss初始化。
+        """
+        if not self._capture_paused() or not self.running:
+            return
+        
+        if self.relay_from is not None:
+            print(f"[*] 转发 {self.relay_from} 的画面，暂停本机截图")
+        else:
+            if self.config.get("performance", {}).get("capture_warmup", True):
+                try:
+                    capture_screen(self._get_frame_source())
+                except Exception as e:
+                    print(f"截图预热失败: {e}")
+            print("[*] 没有观看端，暂停截图")
+        self.capture_idle = True
+        self.current_fps = 0
+        with self.capture_cond:
+            while self.running and self._capture_paused():
+                self.capture_cond.wait()
+        self.capture_idle = False
+        
+        # 暂停期间的画面不能作为静止检测和差分的基准
+        self._last_raw = None
+        self.frame_count = 0
+        self.last_fps_time = time.time()
+        if self.running:
+            print("[*] 恢复截图")
+    
+    def _request_keyframes(self):
+        """要求所有差分编码器下一帧发送关键帧（丢帧后重新建立基准）"""
+        for encoder in list(self.tile_encoders.values()):
+            encoder.request_keyframe()
         
     def _capture_loop(self):
-        """专门负责截图和压缩的线程"""
+        """专门负责截图和压缩的线程，没有观看端时暂停"""
         
         while self.running:
+            self._wait_for_clients()
+            if not self.running:
+                break
             frame_start = time.time()
             
-            # 实时读取当前配置（支持动态切换）
-            fps = self.config['network']['fps']
-            jpeg_quality = self.config['network']['jpeg_quality']
+            # 实时读取当前配置（支持动态切换），自适应模式下由控制器决定
+            controller = self._get_adaptive_controller()
+            if controller:
+                controller.update()
+                fps = controller.fps
+                jpeg_quality = controller.quality
+            else:
+                fps = self.config['network']['fps']
+                jpeg_quality = self.config['network']['jpeg_quality']
             target_frame_time = 1.0 / max(1, fps)
             
             try:
-                # 根据性能档案选择截图和压缩方法
+                # 根据性能档案选择截图和压缩方法，得到 {编码名称: 负载}
                 img_bytes = self._capture_and_compress_by_profile(jpeg_quality)
                 
+                if img_bytes and controller:
+                    # 每个客户端只收一路画面流：按最大的一路计带宽，观看人数增加不算拥塞
+                    frame_size = max(len(payload) for payload in img_bytes.values())
+                    congestion = max((sender.congestion for sender in list(self.client_senders.values())),
+                                     default=0)
+                    controller.record_encode(time.time() - frame_start, frame_size, congestion)
+                
                 if img_bytes:
-                    try:
-                        # 如果队列满了，先清空旧帧，只保留最新的
-                        if self.image_queue.full():
-                            try:
-                                while True:
-                                    self.image_queue.get_nowait()
-                            except Empty:
-                                pass
-                        self.image_queue.put_nowait(img_bytes)
-                    except Exception as e:
-                        print(f"队列操作错误: {e}")
+                    self._queue_frame(img_bytes)
                         
             except Exception as e:
                 print(f"截图时发生错误: {e}")
@@ -140,86 +456,433 @@ class NetworkManager:
             if sleep_time > 0:
                 time.sleep(sleep_time)
 
+    def _queue_frame(self, img_bytes):
+        """把一帧放入发送队列，队列满时丢弃旧帧，只保留最新的"""
+        try:
+            if self.image_queue.full():
+                try:
+                    while True:
+                        release_payload(self.image_queue.get_nowait())
+                except Empty:
+                    pass
+                self._on_frames_dropped()
+            self.image_queue.put_nowait(img_bytes)
+        except Exception as e:
+            release_payload(img_bytes)
+            print(f"队列操作错误: {e}")
+
+    def _on_frames_dropped(self):
+        """发送队列丢弃了帧（可能含差分帧），后续画面需要重新以关键帧为基准"""
+        if self.relay_from is None:
+            self._request_keyframes()
+            return
+        # 转发模式下本端没有编码器：各发送线程跳过差分帧直到上游的关键帧，并请求上游尽快发送
+        for sender in list(self.client_senders.values()):
+            sender.reset_stream()
+        self._request_upstream_keyframe()
+
     def _send_loop(self):
-        """专门负责发送数据的线程"""
+        """专门负责分发数据的线程：新帧到达即唤醒，交给各客户端的发送线程"""
         while self.running:
             try:
+                # 阻塞等待新帧，超时用于定期检查是否需要发送保活消息
+                try:
+                    img_bytes = self.image_queue.get(timeout=0.1)
+                except Empty:
+                    self._send_keepalive_if_idle()
+                    continue
+                
                 # 如果队列中有多帧，仅取最后一帧，丢弃旧帧
-                img_bytes = None
+                dropped = 0
                 while True:
                     try:
-                        img_bytes = self.image_queue.get_nowait()
+                        next_bytes = self.image_queue.get_nowait()
+                        release_payload(img_bytes)
+                        img_bytes = next_bytes
+                        dropped += 1
                     except Empty:
                         break
-                if img_bytes is None:
-                    time.sleep(0.01)
-                    continue
+                if dropped > 0:
+                    self._on_frames_dropped()
                 
                 # 更新FPS统计
                 self._update_fps_stats()
                 
-                # 构造消息
-                message = struct.pack('>Q', len(img_bytes)) + img_bytes
-                
-                # 并发发送给所有客户端
-                disconnected_clients = []
-                send_threads = []
-                
-                for addr, client in list(self.clients.items()):
-                    # 创建单独的发送线程，避免单个客户端阻塞整体
-                    thread = threading.Thread(
-                        target=self._send_to_client, 
-                        args=(client, message, addr, disconnected_clients),
-                        daemon=True
-                    )
-                    send_threads.append(thread)
-                    thread.start()
-                
-                # 等待所有发送完成（设置超时）
-                for thread in send_threads:
-                    thread.join(timeout=0.05)  # 50ms超时
-                
-                # 清理断开的客户端
-                for addr in disconnected_clients:
-                    if addr in self.clients:
-                        self.clients[addr].close()
-                        del self.clients[addr]
+                # 放入各客户端的最新帧槽位，由其发送线程写出
+                self._broadcast(img_bytes)
                         
-            except Empty:
-                # 队列为空，继续等待
-                continue
             except Exception as e:
                 print(f"发送时发生错误: {e}")
 
+    def _send_keepalive_if_idle(self):
+        """画面静止期间定期发送零长度消息，让观看端知道连接仍然存活"""
+        interval = self.config.get("performance", {}).get("keepalive_interval", 1.0)
+        if self.clients and time.time() - self._last_send_time >= interval:
+            self._broadcast(b'')
+
+    def _broadcast(self, frames):
+        """
+        将一帧交给所有客户端的发送线程，立即返回，慢客户端只会丢弃它自己的帧。
+        
+        Args:
+            frames: {画面流: 负载}，每个客户端发送其画面流对应的负载；
+                所有客户端共用的消息（如保活消息）直接传入负载。
+        """
+        self._last_send_time = time.time()
+        tile_frame = isinstance(frames, PooledBuffer) and is_tile_frame(frames.view())
+        
+        for addr, sender in list(self.client_senders.items()):
+            if isinstance(frames, dict):
+                payload = frames.get(self.client_streams.get(addr))
+                if payload is None:
+                    continue  # 刚完成握手的客户端，或本帧按其帧率跳过
+            else:
+                payload = frames
+                if tile_frame and not self.client_tiles.get(addr):
+                    continue  # 转发的分块帧只发给能解码的观看端，旧版观看端只收完整帧
+            # 发送线程各自持有池缓冲区的一个引用
+            sender.submit(payload)
+        
+        # 释放编码阶段的引用，所有客户端发送完毕（或丢弃）后缓冲区回到池中
+        release_payload(frames)
+
     def _capture_and_compress_by_profile(self, quality):
-        """根据性能档案选择截图和压缩方法"""
+        """
+        根据性能档案选择截图和压缩方法，画面静止时返回None。
+        
+        截图和缩放只做一次，再按已连接客户端使用的每路画面流（编码 × 档位 × 抽帧间隔）
+        分别压缩。返回 {画面流: 负载}，负载写入帧缓冲池的缓冲区，调用方持有其引用；
+        本帧按抽帧间隔跳过的画面流不在其中。
+        """
         profile = self.performance_profile
+        if profile == "adaptive":
+            # 自适应模式使用超高速截图路径，缩放比例由控制器决定
+            profile = "performance"
+        sct_img = capture_screen(self._get_frame_source())
+        timestamp_us = int(time.monotonic() * 1000000)
+        
+        # 画面未变化时跳过编码和发送，由发送线程定期发送保活消息
+        if self._is_static_frame(sct_img):
+            return None
+        self._frame_id = (self._frame_id + 1) & 0xFFFFFFFF
+        
+        renditions = {}
+        scales = self._simulcast_scales()
+        def get_rendition(index):
+            # 缩放后的画面及各档位供所有编码共用，只在第一次需要时转换
+            if index not in renditions:
+                if index == 0:
+                    renditions[0] = self._convert_frame_by_profile(profile, sct_img)
+                else:
+                    base = get_rendition(0)
+                    renditions[index] = area_downscale(base, *scaled_size(base.width, base.height, scales[index]))
+            return renditions[index]
+        
+        streams = self._update_client_streams(get_rendition, scales)
+        if self.frame_pool.slots != FRAME_POOL_SLOTS * len(streams):
+            self.frame_pool.resize(FRAME_POOL_SLOTS * len(streams))
+        
+        frames = {}
+        try:
+            for stream in streams:
+                codec_name, rendition, divisor, _ = stream
+                if self._frame_id % divisor:
+                    continue
+                out = self.frame_pool.acquire()
+                try:
+                    payload = self._encode_by_profile(profile, sct_img, quality, out, stream,
+                                                      lambda: get_rendition(rendition))
+                except Exception:
+                    out.release()
+                    raise
+                if payload is None:
+                    out.release()
+                else:
+                    if isinstance(payload, PooledBuffer):
+                        payload.frame_header = self._build_frame_header(payload.view(), codec_name, timestamp_us)
+                    frames[stream] = payload
+        except Exception:
+            release_payload(frames)
+            raise
+        return frames or None
+
+    def _build_frame_header(self, data, codec_name, timestamp_us):
+        """按编码后的v1负载生成协议v2帧头（分块帧读取其头部，完整帧只读取图像头部）"""
+        if is_tile_frame(data):
+            _, flags, width, height, regions = TILE_FRAME_HEADER.unpack_from(data, 0)
+        else:
+            (width, height), flags, regions = image_size(data), FLAG_KEYFRAME, 1
+        return pack_frame_header(self._frame_id, timestamp_us, get_codec(codec_name).id,
+                                 width, height, flags, regions)
+
+    def _simulcast_scales(self):
+        """画面档位列表，第一档始终是性能档案的输出分辨率"""
+        scales = self.config.get("performance", {}).get("simulcast_scales", DEFAULT_SIMULCAST_SCALES)
+        return [1.0] + sorted({float(scale) for scale in scales if 0 < float(scale) < 1.0}, reverse=True)
+
+    def _update_client_streams(self, get_rendition, scales):
+        """
+        为每个客户端选出本帧使用的画面流 (编码名称, 档位, 抽帧间隔, 分块帧)：
+        档位取能满足其显示尺寸的最小一档，抽帧间隔按其需要的帧率计算；
+        拥塞的客户端再按其拥塞等级降低档位、加大抽帧间隔，其他客户端不受影响。
+        
+        Returns:
+            set: 需要编码的画面流；没有客户端时只编码默认画面流。
+        """
+        requests = {addr: self.client_requests.get(addr, (None, 0)) for addr in list(self.client_codecs)}
+        sizes = []
+        if len(scales) > 1 and any(display for display, _ in requests.values()):
+            base = get_rendition(0)
+            sizes = [scaled_size(base.width, base.height, scale) for scale in scales]
+        self._stream_sizes = sizes
+        
+        controller = self.adaptive_controller
+        target_fps = controller.fps if controller else self.config['network']['fps']
+        for addr, (display, fps) in requests.items():
+            rendition = 0
+            if display and sizes:
+                for index, (width, height) in enumerate(sizes):
+                    if width >= display[0] and height >= display[1]:
+                        rendition = index
+            divisor = max(1, int(target_fps // fps)) if fps else 1
+            
+            sender = self.client_senders.get(addr)
+            if sender:
+                rendition_drop, decimation = sender.update_congestion(1.0 / max(1, target_fps))
+                rendition = min(rendition + rendition_drop, len(scales) - 1)
+                divisor *= decimation
+            
+            stream = (self.client_codecs.get(addr, DEFAULT_CODEC), rendition, divisor,
+                      self.client_tiles.get(addr, False))
+            if self.client_streams.get(addr) == stream:
+                continue
+            # 切换到另一路画面流：之前的差分基准不再适用，在新的关键帧之前跳过差分帧
+            self.client_streams[addr] = stream
+            if sender:
+                sender.reset_stream()
+            encoder = self.tile_encoders.get(stream)
+            if encoder:
+                encoder.request_keyframe()
+        return self._active_streams()
+
+    def _stream_label(self, rendition):
+        """画面档位的显示名称：最近一帧的分辨率，未知时用缩放比例"""
+        if rendition < len(self._stream_sizes):
+            return "{}x{}".format(*self._stream_sizes[rendition])
+        scales = self._simulcast_scales()
+        return f"{scales[rendition]:g}x" if rendition < len(scales) else str(rendition)
+
+    def _active_streams(self):
+        """当前客户端使用的画面流集合；没有客户端时按默认编码、第一档压缩"""
+        return {self.client_streams[addr] for addr in list(self.client_codecs) if addr in self.client_streams} \
+            or {DEFAULT_STREAM}
+
+    def _active_codecs(self):
+        """当前客户端使用的编码集合；没有客户端时按默认编码压缩"""
+        return set(self.client_codecs.values()) or {DEFAULT_CODEC}
+
+    def _encode_by_profile(self, profile, sct_img, quality, out, stream, get_frame):
+        """按性能档案和画面流压缩一帧，写入 out；失败时清空 out 后依次回退"""
+        codec_name, rendition, _, tiles = stream
+        codec = get_codec(codec_name)
+        strip_encoder = self._get_strip_encoder()
+        # 分块差分帧和多条带帧都是分块帧，只编码给声明能解码它的观看端使用的画面流；
+        # 其余画面流回退为单线程编码的一张完整图像
+        if tiles:
+            encoder = self._get_tile_encoder(stream)
+        else:
+            encoder = strip_encoder = None
+        if encoder:
+            try:
+                return encoder.encode(get_frame(), quality=quality, out=out)
+            except Exception as e:
+                print(f"[ERROR] 差分编码失败，回退到完整帧: {e}")
+                encoder.request_keyframe()
+                out.reset()
+        elif strip_encoder:
+            try:
+                return strip_encoder.encode(get_frame(), quality=quality, out=out, codec=codec)
+            except Exception as e:
+                print(f"[ERROR] 并行编码失败，回退到单线程编码: {e}")
+                out.reset()
+        
+        if codec.name != DEFAULT_CODEC or rendition:
+            # 非JPEG编码或缩小的档位：直接压缩该档位的画面
+            return codec.encode(get_frame(), quality, out)
         
         try:
             if profile == "performance" and ULTRA_AVAILABLE:
-                # 高性能模式：使用超高速一体化方法
-                return capture_and_compress_ultra_fast(quality=quality)
+                # 高性能模式：使用超高速方法
+                return self._get_ultra_capture().compress(get_frame(), quality=quality, out=out)
             elif profile == "balanced" and OPTIMIZED_AVAILABLE:
                 # 平衡模式：使用优化版本
-                img = capture_screen_scaled()
-                return compress_image_fast(img, quality=quality)
+                return self._get_optimized_capture().compress_image_fast(get_frame(), quality=quality, out=out)
             else:
                 # 高质量模式或回退：使用原始方法
-                sct_img = capture_screen()
-                return compress_image(sct_img, quality=quality)
+                return compress_image(sct_img, quality=quality, out=out)
         except Exception as e:
-            print(f"[ERROR] 截图失败，回退到原始模式: {e}")
+            print(f"[ERROR] 压缩失败，回退到原始模式: {e}")
             # 发生错误时回退到原始方法
-            sct_img = capture_screen()
-            return compress_image(sct_img, quality=quality)
+            out.reset()
+            return compress_image(sct_img, quality=quality, out=out)
 
-    def _send_to_client(self, client, message, addr, disconnected_list):
-        """向单个客户端发送数据"""
-        try:
-            client.sendall(message)
-        except (ConnectionResetError, BrokenPipeError, OSError):
-            print(f"[-] 客户端 {addr} 断开连接")
-            disconnected_list.append(addr)
+    def _convert_frame_by_profile(self, profile, sct_img):
+        """根据性能档案缩放截图，返回未压缩的RGB画面（供差分编码和并行编码使用）"""
+        if profile == "performance" and ULTRA_AVAILABLE:
+            return self._get_ultra_capture().capture_frame(sct_img)
+        elif profile == "balanced" and OPTIMIZED_AVAILABLE:
+            return self._get_optimized_capture().capture_screen_scaled(sct_img)
+        else:
+            self._rgb_frame = bgra_to_rgb(sct_img.raw, sct_img.width, sct_img.height, self._rgb_frame)
+            return self._rgb_frame
+
+    def _is_static_frame(self, sct_img):
+        """与上一帧的原始BGRA数据逐字节比较（memcmp），判断画面是否静止"""
+        raw = sct_img.raw  # 直接比较原始缓冲区，避免bgra属性产生副本
+        prev_raw = self._last_raw
+        self._last_raw = raw
+        
+        if not self.config.get("performance", {}).get("static_suppression", True):
+            return False
+        # 新客户端或丢帧后需要完整画面，不能跳过
+        if self._force_send or any(encoder.force_keyframe for encoder in list(self.tile_encoders.values())):
+            self._force_send = False
+            return False
+        if prev_raw is None or prev_raw is raw or len(prev_raw) != len(raw):
+            return False
+        if prev_raw == raw:
+            self.static_frames_skipped += 1
+            return True
+        return False
+
+    def _get_frame_source(self):
+        """返回画面来源（mss实例需在截图线程中创建），并应用最新的截取区域设置"""
+        capture_config = self.config.get("capture", {})
+        if self.frame_source is None:
+            self.frame_source = MssFrameSource(capture_config.get("monitor", 1))
+        
+        if self._capture_area_changed:
+            self._capture_area_changed = False
+            try:
+                monitor_index = capture_config.get("monitor", 1)
+                monitors = self.frame_source.list_monitors()
+                if 1 <= monitor_index <= len(monitors) and monitors[monitor_index - 1] is not self.frame_source.monitor:
+                    self.frame_source.select_monitor(monitor_index)
+                self.frame_source.set_region(capture_config.get("region"))
+                area = self.frame_source.capture_area
+                print(f"[*] 截取区域: 监视器{monitor_index} {area['width']}x{area['height']}+{area['left']}+{area['top']}")
+            except (ValueError, IndexError) as e:
+                print(f"❌ 应用截取区域失败: {e}")
+        return self.frame_source
+
+    def _get_ultra_capture(self):
+        if self.ultra_capture is None:
+            self.ultra_capture = UltraFastScreenCapture(self._get_frame_source())
+        if self.adaptive_controller:
+            self.ultra_capture.scale_factor = self.adaptive_controller.scale_factor
+        else:
+            self.ultra_capture.scale_factor = UltraFastScreenCapture.DEFAULT_SCALE_FACTOR
+        return self.ultra_capture
+
+    def _get_adaptive_controller(self):
+        """adaptive 档案下返回自适应控制器，其他档案返回None"""
+        if self.performance_profile != "adaptive":
+            self.adaptive_controller = None
+            return None
+        if self.adaptive_controller is None:
+            perf_config = self.config.get("performance", {})
+            self.adaptive_controller = AdaptiveController(
+                fps=self.config['network']['fps'],
+                quality=self.config['network']['jpeg_quality'],
+                scale_factor=UltraFastScreenCapture.DEFAULT_SCALE_FACTOR if ULTRA_AVAILABLE else 1.0,
+                target_latency_ms=perf_config.get("target_latency_ms", 100),
+                target_bandwidth_kbps=perf_config.get("target_bandwidth_kbps", 20000)
+            )
+        return self.adaptive_controller
+
+    def _get_optimized_capture(self):
+        if self.optimized_capture is None:
+            self.optimized_capture = OptimizedScreenCapture(self._get_frame_source())
+        return self.optimized_capture
+
+    def _get_tile_encoder(self, stream=DEFAULT_STREAM):
+        """根据配置返回指定画面流的分块差分编码器，未启用时返回None"""
+        perf_config = self.config.get("performance", {})
+        if not (DIFF_AVAILABLE and perf_config.get("tile_diff", False)):
+            self.tile_encoders = {}
+            return None
+        
+        # 已没有客户端使用的画面流不再保留差分基准
+        active = self._active_streams()
+        for key in [key for key in self.tile_encoders if key not in active]:
+            del self.tile_encoders[key]
+        
+        tile_size = perf_config.get("tile_size", 64)
+        keyframe_interval = perf_config.get("keyframe_interval", 60)
+        encoder = self.tile_encoders.get(stream)
+        if (encoder is None or encoder.tile_size != tile_size
+                or encoder.keyframe_interval != keyframe_interval
+                or encoder.strip_encoder is not self.strip_encoder):
+            encoder = TileDiffEncoder(tile_size=tile_size, keyframe_interval=keyframe_interval,
+                                      strip_encoder=self.strip_encoder, codec=get_codec(stream[0]))
+            self.tile_encoders[stream] = encoder
+        return encoder
+
+    def _get_strip_encoder(self):
+        """根据配置返回多线程条带编码器，未启用时返回None"""
+        perf_config = self.config.get("performance", {})
+        if not (PARALLEL_AVAILABLE and perf_config.get("parallel_encode", False)):
+            if self.strip_encoder:
+                self.strip_encoder.shutdown()
+                self.strip_encoder = None
+            return None
+        
+        workers = perf_config.get("encode_workers", 0)
+        if self.strip_encoder is None or (workers > 0 and self.strip_encoder.workers != workers):
+            if self.strip_encoder:
+                self.strip_encoder.shutdown()
+            self.strip_encoder = StripEncoder(workers=workers)
+        return self.strip_encoder
+
+    def _on_client_sent(self, sender, send_time):
+        """客户端发送线程完成一帧发送时调用"""
+        controller = self.adaptive_controller
+        if controller:
+            controller.record_send(send_time)
+
+    def _on_client_dropped(self, sender):
+        """
+        客户端来不及发送而丢帧时调用：该客户端需要新的关键帧作为差分基准。
+        关键帧会发给同一编码的所有客户端，因此限制单个慢客户端请求的频率。
+        """
+        now = time.time()
+        if now - sender.last_keyframe_request < KEYFRAME_REQUEST_INTERVAL:
+            return
+        sender.last_keyframe_request = now
+        encoder = self.tile_encoders.get(self.client_streams.get(sender.addr))
+        if encoder:
+            encoder.request_keyframe()
+        elif self.relay_from is not None:
+            self._request_upstream_keyframe()
+
+    def _on_client_closed(self, sender):
+        """客户端发送失败（连接断开）时调用"""
+        print(f"[-] 客户端 {sender.addr} 断开连接")
+        self._remove_client(sender.addr)
+
+    def _remove_client(self, addr):
+        """停止客户端的发送线程并关闭连接"""
+        sender = self.client_senders.pop(addr, None)
+        if sender:
+            sender.close()
+        client = self.clients.pop(addr, None)
+        if client and not any(peer_session.sock is client and not peer_session.closed
+                              for peer_session in list(self.sessions.values())):
+            client.close()  # 同伴会话的连接在双方都不再观看时才关闭
+        self.client_codecs.pop(addr, None)
+        self.client_tiles.pop(addr, None)
+        self.client_requests.pop(addr, None)
+        self.client_streams.pop(addr, None)
 
     def _update_fps_stats(self):
         """更新FPS统计"""
@@ -235,76 +898,352 @@ class NetworkManager:
         if (peer_host, peer_port) in self.peers:
             print(f"已经连接到 {peer_host}:{peer_port}")
             return True
+        
+        peer_session = self.sessions.get((peer_host, peer_port))
+        if peer_session and peer_session.confirmed and not peer_session.closed:
+            # 对方已经在观看本端：经同一连接请求观看对方，不再建立新连接
+            return self._watch_over_session(peer_session)
 
+        udp_socket = None
         try:
-            peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # 优化：设置连接超时和TCP_NODELAY
-            peer_socket.settimeout(10)
-            peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            # 优化：设置接收缓冲区大小（连接前设置）
-            peer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)  # 128KB接收缓冲
-            peer_socket.connect((peer_host, peer_port))
-            peer_socket.settimeout(None)
+            udp_socket = self._open_peer_udp_socket()
+            hello = self._viewer_hello(udp_socket)
+            peer_socket = self._open_peer_socket(peer_host, peer_port, hello)
+            if udp_socket:
+                # 先于TCP接收线程启动，握手回复表明对方不支持UDP时才能找到并关闭它
+                self._start_peer_udp((peer_host, peer_port), udp_socket, peer_socket.getpeername()[0])
+            if "session_port" in hello:
+                # 先登记会话，握手回复确认后对方才能经这条连接观看本端
+                peer_session = PeerSession(peer_socket, (peer_host, peer_port), dialed=True)
+                peer_session.watching = True
+                self.sessions[peer_session.key] = peer_session
             
             thread = threading.Thread(target=self._peer_receive_loop, args=(peer_socket, (peer_host, peer_port)), daemon=True)
+            if "session_port" in hello:
+                peer_session.reader = thread
             thread.start()
-            
             self.peers[(peer_host, peer_port)] = (peer_socket, thread)
             print(f"[*] 成功连接到 {peer_host}:{peer_port}")
             if self.on_peer_connected:
                 self.on_peer_connected((peer_host, peer_port))
             return True
         except Exception as e:
+            if udp_socket:
+                udp_socket.close()
             print(f"[!] 连接到 {peer_host}:{peer_port} 失败: {e}")
             return False
 
+    def _watch_over_session(self, peer_session):
+        """经已有的同伴会话请求观看对方（对方在同一连接上回复握手并开始发送画面）"""
+        addr = peer_session.key
+        peer_session.watching = True
+        self.peers[addr] = (peer_session.sock, peer_session.reader)
+        if not peer_session.send_control("watch", **self._viewer_hello()):
+            peer_session.watching = False
+            self.peers.pop(addr, None)
+            print(f"[!] 经已有连接观看 {addr[0]}:{addr[1]} 失败")
+            return False
+        print(f"[*] 经已有连接观看 {addr[0]}:{addr[1]}")
+        if self.on_peer_connected:
+            self.on_peer_connected(addr)
+        return True
+
+    def _start_session_reader(self, peer_session):
+        """被观看的一端读取会话连接：接收控制消息，本端也观看对方时接收画面"""
+        peer_session.reader = threading.Thread(target=self._peer_receive_loop,
+                                               args=(peer_session.sock, peer_session.key), daemon=True,
+                                               name=f"session-{peer_session.key[0]}:{peer_session.key[1]}")
+        peer_session.reader.start()
+
+    def _on_control(self, addr, message):
+        """处理同伴会话中对方发来的控制消息"""
+        peer_session = self.sessions.get(addr)
+        if peer_session is None:
+            return
+        kind = message["type"]
+        if kind == "watch":
+            self._accept_watch(peer_session, message)
+        elif kind == "unwatch":
+            if peer_session.watched:
+                print(f"[-] {addr} 停止观看本端，连接保留")
+                peer_session.watched = False
+                self._remove_client(peer_session.addr)
+        elif kind == "refused":
+            print(f"[!] {addr} 拒绝了观看请求")
+            self.disconnect_from_peer(*addr)
+        elif kind == "keyframe":
+            sender = self.client_senders.get(peer_session.addr)
+            if sender:
+                self._on_client_dropped(sender)
+        elif kind == "stats_request":
+            peer_session.send_control("stats", fps=round(self.current_fps, 1), clients=len(self.clients),
+                                      profile=self.performance_profile)
+        elif kind == "stats":
+            peer_session.stats = message
+
+    def _accept_watch(self, peer_session, info):
+        """对方经会话请求观看本端：在同一连接上回复握手，并登记为客户端"""
+        if peer_session.watched:
+            return
+        if not self._reserve_client(peer_session.addr):
+            peer_session.send_control("refused")
+            return
+        try:
+            session = self._handshake_session(dict(info, udp_port=0))
+            session["peer_port"] = 0  # 会话已经建立
+            with peer_session.write_lock:
+                send_frame(peer_session.sock, self._handshake_reply(session))
+        except Exception as e:
+            print(f"[-] {peer_session.key} 观看请求处理失败: {e}")
+            self.pending_clients.discard(peer_session.addr)
+            return
+        sender = ClientSender(peer_session.sock, peer_session.addr, on_sent=self._on_client_sent,
+                              on_closed=self._on_client_closed, on_dropped=self._on_client_dropped,
+                              write_lock=peer_session.write_lock)
+        peer_session.watched = True
+        print(f"[+] {peer_session.key} 经已有连接观看本端")
+        self._register_client(peer_session.addr, peer_session.sock, sender, session)
+
+    def _close_session(self, peer_session):
+        """会话连接断开，或双方都不再观看：关闭连接，结束两个方向的观看"""
+        if self.sessions.get(peer_session.key) is peer_session:
+            del self.sessions[peer_session.key]
+        peer_session.close()
+        if peer_session.watched:
+            peer_session.watched = False
+            self._remove_client(peer_session.addr)
+        if peer_session.watching:
+            self.disconnect_from_peer(*peer_session.key)
+
+    def _session_for(self, addr, sock):
+        """addr 对应且使用 sock 的同伴会话，没有时返回None"""
+        peer_session = self.sessions.get(addr)
+        return peer_session if peer_session and peer_session.sock is sock else None
+
+    def request_peer_stats(self, peer_host, peer_port):
+        """
+        经同伴会话请求对方的统计信息，回复到达后出现在 get_performance_info 的 peer_stats 中。
+        
+        Returns:
+            bool: 是否已发送请求（没有会话时返回False）。
+        """
+        peer_session = self.sessions.get((peer_host, peer_port))
+        return bool(peer_session) and peer_session.send_control("stats_request")
+
+    def request_peer_keyframe(self, peer_host, peer_port):
+        """
+        经同伴会话请求正在观看的对方尽快发送关键帧（例如本端解码积压丢弃了差分帧）。
+        
+        Returns:
+            bool: 是否已发送请求（没有会话时返回False，只能等待对方的周期关键帧）。
+        """
+        peer_session = self.sessions.get((peer_host, peer_port))
+        return bool(peer_session) and peer_session.send_control("keyframe")
+
+    def _request_upstream_keyframe(self):
+        """转发模式下经同伴会话请求上游尽快发送关键帧，让新的下游观看端不必等待周期关键帧"""
+        peer_session = self.sessions.get(self.relay_from) if self.relay_from else None
+        now = time.time()
+        if peer_session and now - self._last_upstream_keyframe_request >= KEYFRAME_REQUEST_INTERVAL:
+            self._last_upstream_keyframe_request = now
+            peer_session.send_control("keyframe")
+
+    def start_relay(self, peer_host, peer_port):
+        """
+        转发模式：把从该同伴收到的画面原样转发给本端的观看端，不重新编码，本机截图暂停。
+        
+        可以多级转发组成分发树，上游发送端的出口流量不随观看人数增加。
+        上游断开后仍保持转发模式，重新连接到同一地址即恢复转发。
+        
+        Returns:
+            bool: 是否已连接到该同伴。
+        """
+        addr = (peer_host, peer_port)
+        if addr not in self.peers:
+            print(f"未连接到 {peer_host}:{peer_port}，无法转发")
+            return False
+        self.relay_from = addr
+        # 已连接的观看端改收上游画面，需等上游的关键帧作为新的差分基准
+        for sender in list(self.client_senders.values()):
+            sender.reset_stream()
+        self._request_upstream_keyframe()
+        print(f"[*] 开始转发 {peer_host}:{peer_port} 的画面")
+        return True
+
+    def stop_relay(self):
+        """退出转发模式，观看端恢复接收本机画面"""
+        if self.relay_from is None:
+            return
+        print(f"[*] 停止转发 {self.relay_from} 的画面")
+        self.relay_from = None
+        for sender in list(self.client_senders.values()):
+            sender.reset_stream()
+        self._force_send = True
+        self._request_keyframes()
+        self._wake_capture()
+
+    def _relay_frame(self, addr, data):
+        """转发模式下把上游的一帧复制到帧缓冲池，不重新编码交给发送线程（v2帧头只发给v2观看端）"""
+        if addr != self.relay_from or not len(data) or not self.client_senders:
+            return  # 保活消息不转发，本端的发送线程会在空闲时自行发送
+        header, payload = unpack_frame(data)
+        out = self.frame_pool.acquire()
+        out.write(payload)
+        if header is not None:
+            # 改用本端的帧序号：切换转发、上游重启时下游看到的序号仍然连续
+            self._frame_id = (self._frame_id + 1) & 0xFFFFFFFF
+            out.frame_header = pack_frame_header(self._frame_id, *header[1:])
+        self._queue_frame(out)
+
+    def _open_peer_udp_socket(self):
+        """配置为UDP传输时，创建接收画面的UDP套接字（端口在握手中告知对方）"""
+        if self.config.get("viewer", {}).get("transport", "tcp") != "udp":
+            return None
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        udp_socket.bind(('0.0.0.0', 0))
+        return udp_socket
+
+    def _start_peer_udp(self, addr, udp_socket, peer_ip):
+        """启动UDP画面接收线程，只接受来自 peer_ip（TCP连接的对端地址）的数据报，重组后的画面同样交给 on_data_received"""
+        def on_frame(frame):
+            self._relay_frame(addr, frame)
+            if self.on_data_received:
+                self.on_data_received(addr, frame)
+        
+        receiver = UdpReceiver(udp_socket, on_frame, self._max_frame_size(), peer_ip)
+        self.peer_udp[addr] = receiver
+        threading.Thread(target=receiver.run, args=(lambda: self.running and addr in self.peer_udp,),
+                         daemon=True, name=f"udp-receiver-{addr[0]}:{addr[1]}").start()
+
+    def _on_peer_handshake(self, addr, info):
+        """收到对方发送端的握手回复"""
+        # 对方确认的编码；图像数据本身带有格式标识，这里只做记录
+        codec_name = info.get("codec")
+        self.peer_codecs[addr] = codec_name if isinstance(codec_name, str) else DEFAULT_CODEC
+        print(f"[*] {addr} 使用编码: {self.peer_codecs[addr]}, "
+              f"{'分块帧' if info.get('tiles') is True else '仅完整帧'}")
+        peer_session = self.sessions.get(addr)
+        if peer_session and peer_session.dialed and not peer_session.confirmed:
+            if info.get("session"):
+                peer_session.confirmed = True
+            else:
+                del self.sessions[addr]  # 对方不支持会话，这条连接只用于观看对方
+        if info.get("transport") != "udp":
+            # 对方不支持UDP（旧版本或selectors后端），画面仍经TCP到达
+            receiver = self.peer_udp.pop(addr, None)
+            if receiver:
+                print(f"[*] {addr} 不支持UDP传输，使用TCP")
+                receiver.sock.close()
+
+    def _open_peer_socket(self, peer_host, peer_port, hello):
+        """连接到对方并发送握手消息 hello，返回阻塞模式的套接字"""
+        peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # 优化：设置连接超时和TCP_NODELAY
+            peer_socket.settimeout(10)
+            peer_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # 优化：设置接收缓冲区大小（连接前设置）
+            peer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 131072)  # 128KB接收缓冲
+            peer_socket.connect((peer_host, peer_port))
+            peer_socket.settimeout(None)
+            
+            # 握手：告知对方本端偏好的画面编码，对方在第一条消息中回复选定的编码
+            send_frame(peer_socket, pack_handshake(hello))
+        except Exception:
+            peer_socket.close()
+            raise
+        return peer_socket
+
+    def _viewer_hello(self, udp_socket=None):
+        """观看端的握手信息（经同伴会话请求观看时作为 watch 控制消息的内容）"""
+        hello = {"codecs": self._preferred_codecs(), "version": PROTOCOL_VERSION, "tiles": True}
+        if udp_socket:
+            hello["udp_port"] = udp_socket.getsockname()[1]
+            hello["fec"] = self.config.get("viewer", {}).get("udp_fec", 0)
+        elif self.SESSION_SUPPORTED:
+            # 请求同伴会话：对方要观看本端时可以复用这条连接
+            hello["session_port"] = self.port
+        # 告知发送端观看窗口的最大显示尺寸和需要的帧率，便于选择合适的画面档位
+        viewer_config = self.config.get("viewer", {})
+        zoom = viewer_config.get("zoom_scale", 1.0)
+        hello["display"] = [int(viewer_config.get("default_width", 480) * zoom),
+                            int(viewer_config.get("default_height", 270) * zoom)]
+        if viewer_config.get("max_fps", 0) > 0:
+            hello["fps"] = viewer_config["max_fps"]
+        return hello
+
+    def _preferred_codecs(self):
+        """观看端希望使用的编码（按偏好排序），JPEG始终作为最后的备选"""
+        preferred = self.config.get("viewer", {}).get("codec", DEFAULT_CODEC)
+        codecs = preferred if isinstance(preferred, list) else [preferred]
+        return list(dict.fromkeys(codecs + [DEFAULT_CODEC]))
+
+    def _max_frame_size(self):
+        """单帧大小上限（字节）"""
+        return int(self.config.get("network", {}).get("max_frame_mb", MAX_FRAME_MB) * 1024 * 1024)
+
     def _peer_receive_loop(self, peer_socket, addr):
-        """优化的数据接收循环"""
-        payload_size = struct.calcsize(">Q")
-        data_buffer = b""
+        """
+        数据接收循环。
         
-        # 接收缓冲区已在连接时设置，这里不需要重复设置
+        先读8字节长度头，再分配恰好 msg_size 大小的缓冲区，用 recv_into 直接填满，
+        以 memoryview 交给 on_data_received，不做拼接和切片复制。
+        缓冲区不在帧之间复用：观看端会把帧放进队列稍后解码。
+        """
+        max_size = self._max_frame_size()
 
         while self.running:
             try:
-                # 接收长度头
-                while len(data_buffer) < payload_size:
-                    packet = peer_socket.recv(8192)  # 增大接收缓冲区
-                    if not packet:
-                        raise ConnectionResetError("远程主机关闭连接")
-                    data_buffer += packet
+                frame_data = memoryview(recv_message(peer_socket, max_size))
                 
-                packed_msg_size = data_buffer[:payload_size]
-                data_buffer = data_buffer[payload_size:]
-                msg_size = struct.unpack(">Q", packed_msg_size)[0]
-
-                # 接收图像数据
-                while len(data_buffer) < msg_size:
-                    remaining = msg_size - len(data_buffer)
-                    chunk_size = min(8192, remaining)  # 分块接收
-                    packet = peer_socket.recv(chunk_size)
-                    if not packet:
-                        raise ConnectionResetError("远程主机关闭连接")
-                    data_buffer += packet
-
-                frame_data = data_buffer[:msg_size]
-                data_buffer = data_buffer[msg_size:]
+                if is_handshake(frame_data):
+                    self._on_peer_handshake(addr, unpack_handshake(frame_data))
+                    continue
+                if is_control(frame_data):
+                    self._on_control(addr, unpack_control(frame_data))
+                    continue
                 
+                self._relay_frame(addr, frame_data)
                 if self.on_data_received:
                     self.on_data_received(addr, frame_data)
 
+            except ValueError as e:
+                # 长度头损坏后数据流已无法同步，只能断开
+                print(f"[-] 来自 {addr} 的数据异常: {e}")
+                self._on_peer_lost(addr, peer_socket)
+                break
             except (ConnectionResetError, OSError):
                 print(f"[-] 来自 {addr} 的连接已断开.")
-                self.disconnect_from_peer(addr[0], addr[1])
+                self._on_peer_lost(addr, peer_socket)
                 break
         print(f"接收循环停止 for {addr}.")
 
+    def _on_peer_lost(self, addr, peer_socket):
+        """接收循环因连接断开或数据异常退出"""
+        peer_session = self._session_for(addr, peer_socket)
+        if peer_session:
+            self._close_session(peer_session)
+        elif self.peers.get(addr, (None,))[0] is peer_socket:
+            self.disconnect_from_peer(addr[0], addr[1])
+
     def disconnect_from_peer(self, peer_host, peer_port):
         addr = (peer_host, peer_port)
         if addr in self.peers:
-            peer_socket, _ = self.peers[addr]
-            peer_socket.close()
-            del self.peers[addr]
+            peer_socket, _ = self.peers.pop(addr)
+            peer_session = self._session_for(addr, peer_socket)
+            if peer_session:
+                peer_session.watching = False
+                if peer_session.watched and not peer_session.closed:
+                    peer_session.send_control("unwatch")  # 对方仍在观看本端，连接保留
+                else:
+                    self._close_session(peer_session)
+            else:
+                peer_socket.close()
+            self.peer_codecs.pop(addr, None)
+            receiver = self.peer_udp.pop(addr, None)
+            if receiver:
+                receiver.sock.close()
             print(f"[*] 已从 {addr} 断开连接.")
             if self.on_peer_disconnected:
                 self.on_peer_disconnected(addr)
@@ -312,20 +1251,26 @@ class NetworkManager:
     def stop(self):
         print("正在停止网络服务...")
         self.running = False
+        self._wake_capture()
         
         # Close server socket to unblock accept()
         if self.server_socket:
             self.server_socket.close()
             
         # Close all client connections
-        for client in self.clients.values():
-            client.close()
-        self.clients.clear()
+        for addr in list(self.clients):
+            self._remove_client(addr)
         
         # Close all peer connections
         for peer_socket, _ in self.peers.values():
             peer_socket.close()
         self.peers.clear()
+        for receiver in self.peer_udp.values():
+            receiver.sock.close()
+        self.peer_udp.clear()
+        for peer_session in list(self.sessions.values()):
+            peer_session.close()
+        self.sessions.clear()
 
         print("网络服务已停止。")
 
@@ -336,18 +1281,86 @@ class NetworkManager:
     
     def get_performance_info(self):
         """获取性能信息"""
-        target_fps = self.config['network']['fps']
+        controller = self.adaptive_controller
+        target_fps = controller.fps if controller else self.config['network']['fps']
         return {
             "current_fps": self.current_fps,
             "target_fps": target_fps,
             "profile": self.performance_profile,
             "efficiency": (self.current_fps / target_fps) if target_fps > 0 else 0,
-            "queue_size": self.image_queue.qsize()
+            "queue_size": self.image_queue.qsize(),
+            "capture_idle": self.capture_idle,
+            "relay_from": f"{self.relay_from[0]}:{self.relay_from[1]}" if self.relay_from else None,
+            "tile_diff": bool(self.tile_encoders),
+            "codecs": sorted(self._active_codecs()),
+            "streams": sorted(f"{codec}@{self._stream_label(rendition)}/{divisor}"
+                              for codec, rendition, divisor, _ in self._active_streams()),
+            "encode_workers": self.strip_encoder.workers if self.strip_encoder else 1,
+            "static_frames_skipped": self.static_frames_skipped,
+            "frame_pool_misses": self.frame_pool.misses,
+            "changed_ratio": max((encoder.last_changed_ratio for encoder in list(self.tile_encoders.values())),
+                                 default=1.0),
+            "adaptive": controller.state() if controller else None,
+            "clients": {f"{addr[0]}:{addr[1]}": self._client_info(addr, sender)
+                        for addr, sender in list(self.client_senders.items())},
+            "udp_peers": {f"{addr[0]}:{addr[1]}": receiver.stats() for addr, receiver in list(self.peer_udp.items())},
+            "sessions": {f"{addr[0]}:{addr[1]}": {"watching": peer_session.watching, "watched": peer_session.watched}
+                         for addr, peer_session in list(self.sessions.items())},
+            "peer_stats": {f"{addr[0]}:{addr[1]}": peer_session.stats
+                           for addr, peer_session in list(self.sessions.items()) if peer_session.stats}
         }
     
+    def _client_info(self, addr, sender):
+        """单个客户端的发送统计，附带当前画面流（拥塞时可看到降低后的档位和抽帧间隔）"""
+        info = sender.stats()
+        stream = self.client_streams.get(addr)
+        if stream:
+            info["stream"] = f"{stream[0]}@{self._stream_label(stream[1])}/{stream[2]}"
+        return info
+    
+    def list_monitors(self):
+        """返回可选的监视器列表 [{'left', 'top', 'width', 'height'}, ...]，序号从1开始"""
+        if self.frame_source is not None:
+            return list(self.frame_source.list_monitors())
+        source = MssFrameSource()
+        try:
+            return list(source.list_monitors())
+        finally:
+            source.close()
+    
+    def select_monitor(self, index):
+        """切换要共享的监视器（序号从1开始），同时恢复全屏截取；运行中立即生效"""
+        monitors = self.list_monitors()
+        if not 1 <= index <= len(monitors):
+            print(f"❌ 无效的监视器序号: {index}")
+            return False
+        capture_config = self.config.setdefault("capture", {})
+        capture_config["monitor"] = index
+        capture_config["region"] = None
+        self._capture_area_changed = True
+        return True
+    
+    def set_capture_region(self, region):
+        """
+        只共享当前监视器中的一块矩形区域；运行中立即生效，无需重建mss实例。
+        
+        Args:
+            region: {'left', 'top', 'width', 'height'} 或 (left, top, width, height)，
+                相对于当前监视器左上角；None 恢复整个监视器。
+        """
+        capture_config = self.config.setdefault("capture", {})
+        try:
+            monitor = self.list_monitors()[capture_config.get("monitor", 1) - 1]
+            capture_config["region"] = normalize_region(region, monitor)
+        except (ValueError, IndexError) as e:
+            print(f"❌ 无效的截取区域: {e}")
+            return False
+        self._capture_area_changed = True
+        return True
+    
     def switch_performance_profile(self, profile):
         """切换性能档案"""
-        valid_profiles = ["quality", "balanced", "performance"]
+        valid_profiles = ["quality", "balanced", "performance", "adaptive"]
         if profile in valid_profiles:
             old_profile = self.performance_profile
             self.performance_profile = profile
@@ -366,6 +1379,7 @@ class NetworkManager:
             elif profile == "quality":
                 self.config["network"]["fps"] = 8
                 self.config["network"]["jpeg_quality"] = 75
+            # adaptive 模式以当前参数为起点，由控制器动态调整
             
             try:
                 import os
@@ -386,6 +1400,7 @@ class NetworkManager:
         """重新加载配置文件"""
         try:
             self.config = self._load_config()
+            self._capture_area_changed = True
             old_profile = self.performance_profile
             self.performance_profile = self.config.get("performance", {}).get("profile", "balanced")
             print(f"✅ 配置已重新加载，性能档案: {old_profile} → {self.performance_profile}")
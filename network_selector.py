@@ -0,0 +1,490 @@
+"""
+基于 selectors 的网络后端。
+
+NetworkManager 为每个观看端保留一个阻塞发送线程，几十个观看端没有问题，
+但观看端达到数百个时线程数、栈内存和线程切换开销都随之线性增长。
+
+SelectorNetworkManager 保持相同的接口（start_server / connect_to_peer /
+on_data_received 等），把所有连接的接受、握手、读取和写出都放到一个I/O线程中：
+- 套接字全部为非阻塞模式，由 selectors 统一等待可读/可写事件；
+- 每个连接有自己的写出状态（当前正在写的帧及已写出的偏移量），内核发送缓冲区满时
+  只是暂停该连接，等可写时从断点继续，不会阻塞其他连接；
+- 背压沿用"最新帧槽位"：连接还没写完上一帧时新帧只替换槽位中未开始发送的帧，
+  慢观看端只会丢弃它自己的帧。
+
+截图、编码和分发（_broadcast）与线程后端完全相同，分发时只是唤醒I/O线程。
+"""
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+
+from frame_protocol import (LENGTH_HEADER, HAS_SENDMSG, MessageReader, pack_handshake,
+                            is_handshake, unpack_handshake, PROTOCOL_VERSION)
+from image_codecs import DEFAULT_CODEC
+from frame_pool import release_payload
+from client_sender import FrameSlot, socket_backlog
+from network_comms import NetworkManager, HANDSHAKE_TIMEOUT, MAX_HANDSHAKE_SIZE
+
+# 单次 select 的最长等待时间（秒），用于检查停止标志
+SELECT_TIMEOUT = 0.1
+
+
+class SelectorConnection(FrameSlot):
+    """
+    事件循环中的一个连接：读取状态 + 最新帧槽位 + 写出状态。
+
+    role 为 "handshake"（等待观看端握手）、"client"（观看端）或 "peer"（本端作为观看端）。
+    除 submit() / close() / stats() 外，所有方法只在I/O线程中调用。
+    """
+
+    def __init__(self, backend, sock, addr, role):
+        super().__init__(addr, on_sent=backend._on_client_sent, on_dropped=backend._on_client_dropped)
+        self.backend = backend
+        self.sock = sock
+        self.role = role
+        self.reader = MessageReader(MAX_HANDSHAKE_SIZE if role == "handshake" else backend._max_frame_size())
+        self.handshake_deadline = time.time() + HANDSHAKE_TIMEOUT
+
+        # 握手回复等不可丢弃的消息，优先于画面发送
+        self.control = deque()
+
+        # 写出状态：当前正在写的消息
+        self.out_payload = None
+        self.out_header = None
+        self.out_view = None
+        self.out_offset = 0
+        self.out_start = 0.0
+        self.want_write = False
+
+    def _wake(self):
+        self.backend._wakeup(self)
+
+    def send_backlog(self):
+        """内核发送队列加上当前消息尚未交给内核的部分"""
+        backlog = socket_backlog(self.sock)
+        if backlog is not None and self.out_view is not None:
+            backlog += len(self.out_header) + len(self.out_view) - self.out_offset
+        return backlog
+
+    def send_control(self, payload):
+        """排队一条不可丢弃的消息"""
+        self.control.append(payload)
+        self.flush()
+
+    def _next_message(self):
+        """取出下一条要写出的消息，没有时返回False"""
+        if self.control:
+            payload, data = None, self.control.popleft()
+        else:
+            with self.cond:
+                if not self.running:
+                    return False
+                payload, data = self._take()
+            if payload is None:
+                return False
+        frame_header = self._frame_header(payload)
+        self.out_payload = payload
+        self.out_header = LENGTH_HEADER.pack(len(frame_header) + len(data)) + frame_header
+        self.out_view = memoryview(data)
+        self.out_offset = 0
+        self.out_start = time.time()
+        return True
+
+    def flush(self):
+        """
+        尽量写出排队的消息，内核发送缓冲区满时停在断点，等待可写事件后继续。
+
+        Raises:
+            OSError: 连接已断开。
+        """
+        while self.out_view is not None or self._next_message():
+            header_size = len(self.out_header)
+            offset = self.out_offset
+            try:
+                if offset < header_size:
+                    if HAS_SENDMSG:
+                        sent = self.sock.sendmsg([self.out_header[offset:], self.out_view])
+                    else:
+                        sent = self.sock.send(self.out_header[offset:])
+                else:
+                    sent = self.sock.send(self.out_view[offset - header_size:])
+            except BlockingIOError:
+                break
+
+            self.out_offset += sent
+            if self.out_offset < header_size + len(self.out_view):
+                continue
+
+            size = len(self.out_view)
+            self.out_view = None
+            release_payload(self.out_payload)
+            self.out_payload = None
+            if self.role == "client":
+                self._record_sent(size, time.time() - self.out_start)
+
+        self._update_interest()
+
+    def _update_interest(self):
+        """只有还有数据没写完时才关注可写事件，避免空转"""
+        want_write = self.out_view is not None
+        if want_write != self.want_write:
+            self.want_write = want_write
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if want_write else 0)
+            self.backend.selector.modify(self.sock, events, self)
+
+    def discard(self):
+        """停止发送并释放写出中和槽位中的帧"""
+        self._stop()
+        self.out_view = None
+        release_payload(self.out_payload)
+        self.out_payload = None
+
+
+class SelectorNetworkManager(NetworkManager):
+    """单个I/O线程处理所有连接的 NetworkManager"""
+
+    LISTEN_BACKLOG = 128
+    UDP_SUPPORTED = False  # 画面只经事件循环中的TCP连接发送；作为观看端时仍可经UDP接收
+    SESSION_SUPPORTED = False  # 尚未实现同伴会话，互相观看时各自建立连接
+
+    def __init__(self, host='0.0.0.0', port=55555, frame_source=None):
+        super().__init__(host, port, frame_source)
+        self.selector = selectors.DefaultSelector()
+        self.connections = {}  # K: socket, V: SelectorConnection（含握手中的连接）
+        self.peer_connections = {}  # K: peer_addr, V: SelectorConnection
+        self.handshakes = set()  # 等待握手的连接
+        self.io_thread = None
+
+        # 其他线程唤醒I/O线程：待写出的连接和待执行的调用
+        self._wakeup_lock = threading.Lock()
+        self._dirty = set()
+        self._calls = deque()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self.selector.register(self._wakeup_recv, selectors.EVENT_READ, None)
+
+    # ---------- I/O线程 ----------
+
+    def _ensure_io_loop(self):
+        if self.io_thread is None or not self.io_thread.is_alive():
+            self.io_thread = threading.Thread(target=self._io_loop, daemon=True, name="selector-io")
+            self.io_thread.start()
+
+    def _notify_loop(self):
+        # 调用方已持有 _wakeup_lock；唤醒字节已在途时不再重复写入
+        if len(self._dirty) + len(self._calls) == 1:
+            try:
+                self._wakeup_send.send(b'\0')
+            except BlockingIOError:
+                pass
+
+    def _wakeup(self, conn):
+        """某个连接的槽位有新帧（由分发线程调用）"""
+        with self._wakeup_lock:
+            if conn not in self._dirty:
+                self._dirty.add(conn)
+                self._notify_loop()
+
+    def _call_in_loop(self, func, *args):
+        """在I/O线程中执行 func(*args)；已在I/O线程中时直接执行"""
+        if threading.current_thread() is self.io_thread:
+            func(*args)
+            return
+        with self._wakeup_lock:
+            self._calls.append((func, args))
+            self._notify_loop()
+
+    def _io_loop(self):
+        """事件循环：接受连接、读取消息、写出帧"""
+        while self.running:
+            for key, events in self.selector.select(self._select_timeout()):
+                conn = key.data
+                if key.fileobj is self._wakeup_recv:
+                    self._drain_wakeups()
+                elif key.fileobj is self.server_socket:
+                    self._accept_ready()
+                elif conn.sock.fileno() != -1:
+                    if events & selectors.EVENT_READ:
+                        self._read_ready(conn)
+                    if events & selectors.EVENT_WRITE and conn.sock.fileno() != -1:
+                        self._flush(conn)
+            self._expire_handshakes()
+        print("事件循环已停止.")
+
+    def _select_timeout(self):
+        timeout = SELECT_TIMEOUT
+        now = time.time()
+        for conn in self.handshakes:
+            timeout = min(timeout, max(0.0, conn.handshake_deadline - now))
+        return timeout
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._wakeup_lock:
+            dirty, self._dirty = self._dirty, set()
+            calls, self._calls = self._calls, deque()
+        for func, args in calls:
+            func(*args)
+        for conn in dirty:
+            if conn.sock.fileno() != -1:
+                self._flush(conn)
+
+    def _accept_ready(self):
+        while True:
+            try:
+                client_socket, addr = self.server_socket.accept()
+            except (BlockingIOError, OSError):
+                return
+            self._configure_client_socket(client_socket)
+            client_socket.setblocking(False)
+            print(f"[+] 新的连接来自: {addr}")
+            if not self._admit_client(addr):
+                client_socket.close()
+                continue
+            self._add_connection(SelectorConnection(self, client_socket, addr, "handshake"))
+
+    def _add_connection(self, conn):
+        self.connections[conn.sock] = conn
+        if conn.role == "handshake":
+            self.handshakes.add(conn)
+        self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+
+    def _read_ready(self, conn):
+        """读取连接上的消息；每次最多读取固定次数，避免单个连接占满事件循环"""
+        try:
+            for _ in range(16):
+                message = conn.reader.read_from(conn.sock)
+                if message is not None:
+                    self._handle_message(conn, message)
+                    if conn.sock.fileno() == -1:
+                        return
+        except BlockingIOError:
+            pass
+        except (ValueError, OSError) as e:
+            self._connection_lost(conn, e)
+        except Exception as e:
+            # 处理单个连接的消息出错时只断开该连接，不能让异常结束整个事件循环
+            print(f"[-] 处理 {conn.addr} 的消息出错: {e}")
+            if conn.sock.fileno() != -1:
+                self._connection_lost(conn, e)
+
+    def _handle_message(self, conn, message):
+        if conn.role == "handshake":
+            session = self._handshake_session({})
+            if is_handshake(message):
+                session = self._handshake_session(unpack_handshake(message))
+                conn.send_control(self._handshake_reply(session))
+            self._promote_client(conn, session)
+        elif conn.role == "peer":
+            if is_handshake(message):
+                self._on_peer_handshake(conn.addr, unpack_handshake(message))
+            else:
+                self._relay_frame(conn.addr, memoryview(message))
+                if self.on_data_received:
+                    self.on_data_received(conn.addr, memoryview(message))
+        # 观看端在握手后不会再发送数据，忽略
+
+    def _promote_client(self, conn, session):
+        """握手完成（或超时按旧版观看端处理）后开始向其发送画面"""
+        conn.role = "client"
+        self.handshakes.discard(conn)
+        conn.reader.max_size = MAX_HANDSHAKE_SIZE
+        self._register_client(conn.addr, conn.sock, conn, session)
+
+    def _expire_handshakes(self):
+        now = time.time()
+        for conn in list(self.handshakes):
+            if now >= conn.handshake_deadline:
+                self._promote_client(conn, self._handshake_session({}))  # 旧版观看端不发送握手
+
+    def _flush(self, conn):
+        try:
+            conn.flush()
+        except OSError as e:
+            self._connection_lost(conn, e)
+
+    def _connection_lost(self, conn, error):
+        if conn.role == "client":
+            print(f"[-] 客户端 {conn.addr} 断开连接")
+            self._remove_client(conn.addr)
+            if conn.sock.fileno() != -1:
+                self._close_connection(conn)  # 已不在客户端列表中（例如正在停止）
+        elif conn.role == "peer":
+            print(f"[-] 来自 {conn.addr} 的连接已断开.")
+            self.disconnect_from_peer(*conn.addr)
+        else:
+            print(f"[-] 客户端 {conn.addr} 握手失败: {error}")
+            self._close_connection(conn)
+
+    def _close_connection(self, conn):
+        """注销并关闭连接（I/O线程中调用）"""
+        conn.discard()
+        self.handshakes.discard(conn)
+        if self.connections.pop(conn.sock, None) is not None:
+            self.selector.unregister(conn.sock)
+        conn.sock.close()
+
+    # ---------- 覆盖线程后端的接口 ----------
+
+    def _pending_client_count(self):
+        return len(self.handshakes)
+
+    def _start_accepting(self):
+        self.server_socket.setblocking(False)
+        self._call_in_loop(self.selector.register, self.server_socket, selectors.EVENT_READ, None)
+        self._ensure_io_loop()
+
+    def _remove_client(self, addr):
+        sender = self.client_senders.pop(addr, None)
+        self.clients.pop(addr, None)
+        self.client_codecs.pop(addr, None)
+        self.client_tiles.pop(addr, None)
+        self.client_requests.pop(addr, None)
+        self.client_streams.pop(addr, None)
+        if sender:
+            sender.close()
+            self._call_in_loop(self._close_connection, sender)
+
+    def connect_to_peer(self, peer_host, peer_port):
+        addr = (peer_host, peer_port)
+        if addr in self.peers:
+            print(f"已经连接到 {peer_host}:{peer_port}")
+            return True
+
+        udp_socket = None
+        try:
+            udp_socket = self._open_peer_udp_socket()
+            peer_socket = self._open_peer_socket(peer_host, peer_port, self._viewer_hello(udp_socket))
+        except Exception as e:
+            if udp_socket:
+                udp_socket.close()
+            print(f"[!] 连接到 {peer_host}:{peer_port} 失败: {e}")
+            return False
+
+        peer_socket.setblocking(False)
+        conn = SelectorConnection(self, peer_socket, addr, "peer")
+        self.peers[addr] = (peer_socket, None)
+        self.peer_connections[addr] = conn
+        if udp_socket:
+            self._start_peer_udp(addr, udp_socket, peer_socket.getpeername()[0])
+        self._call_in_loop(self._add_connection, conn)
+        self._ensure_io_loop()
+        print(f"[*] 成功连接到 {peer_host}:{peer_port}")
+        if self.on_peer_connected:
+            self.on_peer_connected(addr)
+        return True
+
+    def disconnect_from_peer(self, peer_host, peer_port):
+        addr = (peer_host, peer_port)
+        conn = self.peer_connections.pop(addr, None)
+        if conn is None:
+            return
+        self.peers.pop(addr, None)
+        self.peer_codecs.pop(addr, None)
+        receiver = self.peer_udp.pop(addr, None)
+        if receiver:
+            receiver.sock.close()
+        self._call_in_loop(self._close_connection, conn)
+        print(f"[*] 已从 {addr} 断开连接.")
+        if self.on_peer_disconnected:
+            self.on_peer_disconnected(addr)
+
+    def stop(self):
+        print("正在停止网络服务...")
+        self.running = False
+        self._wake_capture()
+        for addr in list(self.peer_connections):
+            self.disconnect_from_peer(*addr)
+
+        if self.io_thread and self.io_thread is not threading.current_thread():
+            self._call_in_loop(lambda: None)
+            self.io_thread.join(timeout=1.0)
+
+        # 事件循环已退出，剩余连接直接关闭
+        for addr in list(self.client_senders):
+            sender = self.client_senders.pop(addr)
+            sender.discard()
+        self.clients.clear()
+        self.client_codecs.clear()
+        self.client_tiles.clear()
+        self.client_requests.clear()
+        self.client_streams.clear()
+        for conn in list(self.connections.values()):
+            conn.discard()
+            conn.sock.close()
+        self.connections.clear()
+        if self.server_socket:
+            self.server_socket.close()
+        self.selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        print("网络服务已停止。")
+
+
+def _viewer_process(port, count, ready, stop):
+    """基准测试用的观看端进程：建立 count 个连接并持续读取"""
+    from frame_protocol import send_frame
+
+    sel = selectors.DefaultSelector()
+    socks = []
+    for _ in range(count):
+        sock = socket.create_connection(("127.0.0.1", port))
+        send_frame(sock, pack_handshake({"codecs": [DEFAULT_CODEC], "version": PROTOCOL_VERSION, "tiles": True}))
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+        socks.append(sock)
+    ready.set()
+
+    buf = bytearray(256 * 1024)
+    while not stop.is_set():
+        for key, _ in sel.select(0.1):
+            try:
+                key.fileobj.recv_into(buf)
+            except BlockingIOError:
+                pass
+    for sock in socks:
+        sock.close()
+
+
+if __name__ == '__main__':
+    # 基准测试：本机回环上逐步增加观看端数量，比较两种后端的CPU占用和线程数
+    import multiprocessing
+    from frame_source import VideoNoiseSource
+
+    window = 3.0
+    port = 56555
+    for viewers in (10, 50, 100, 200):
+        for backend in (NetworkManager, SelectorNetworkManager):
+            manager = backend(host='127.0.0.1', port=port, frame_source=VideoNoiseSource(320, 180))
+            manager.start_server()
+
+            ready, stop = multiprocessing.Event(), multiprocessing.Event()
+            viewer = multiprocessing.Process(target=_viewer_process, args=(port, viewers, ready, stop))
+            viewer.start()
+            ready.wait()
+            time.sleep(HANDSHAKE_TIMEOUT + 0.5)
+            # 观看端进程建立全部连接之前不读取，先连上的连接会真的积压而被降级；
+            # 等拥塞等级恢复后再计时，比较的是稳定状态
+            deadline = time.time() + 30
+            while time.time() < deadline and any(s.congestion for s in list(manager.client_senders.values())):
+                time.sleep(0.5)
+
+            cpu_start, sent_start = time.process_time(), sum(s.frames_sent for s in list(manager.client_senders.values()))
+            time.sleep(window)
+            cpu = (time.process_time() - cpu_start) / window
+            sent = sum(s.frames_sent for s in list(manager.client_senders.values())) - sent_start
+            threads = threading.active_count()
+
+            stop.set()
+            viewer.join()
+            manager.stop()
+            port += 1
+            print(f"[{backend.__name__:>22} | {viewers:3d}个观看端] CPU: {cpu * 100:5.1f}%, "
+                  f"线程数: {threads:3d}, 每秒送达: {sent / window:7.1f} 帧, FPS: {manager.get_current_fps():.1f}")
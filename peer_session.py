@@ -0,0 +1,57 @@
+"""
+同伴会话：两个人互相观看时共用一条TCP连接。
+
+原先 A 连接 B 观看之后，B 要观看 A 还得反向再建立一条连接：两条连接、两次握手、
+两套接收/发送线程。现在连接时在握手中告知本端的服务端口（"session"），
+对方确认后这条连接就是一个会话：
+
+- 两个方向各自是独立的字节流。每端只往自己写出的方向写，画面由发送线程写，
+  控制消息由其他线程写，用 write_lock 保证消息不会交错。
+- 已在会话中被对方观看的一端要观看对方时，发送 watch 控制消息（内容与观看端的握手相同），
+  对方在同一连接上回复握手并开始发送画面；unwatch 停止观看而不断开连接。
+- keyframe 控制消息请求发送端尽快发送关键帧（转发节点有新的下游观看端时使用），
+  stats_request / stats 交换简单的统计信息。
+
+只有双方都不再观看对方时才关闭连接。
+"""
+import threading
+
+from frame_protocol import send_frame, pack_control
+
+
+class PeerSession:
+    """与一个同伴之间的一条双向连接及其两个方向的观看状态。"""
+
+    def __init__(self, sock, key, dialed):
+        self.sock = sock
+        self.key = key              # 对方服务端地址 (host, port)，作为观看窗口和同伴列表的键
+        self.dialed = dialed        # 是否由本端发起连接
+        self.addr = sock.getpeername()  # 连接的对端地址，被对方观看时作为客户端列表的键
+        self.write_lock = threading.Lock()
+        self.confirmed = not dialed  # 对方是否确认支持会话（发起端在握手回复中得知）
+        self.watching = False       # 本端正在观看对方
+        self.watched = False        # 对方正在观看本端
+        self.closed = False
+        self.reader = None          # 读取本连接的线程
+        self.stats = None           # 对方最近一次回复的统计信息
+
+    def send_control(self, message_type, **fields):
+        """
+        发送一条控制消息。
+
+        Returns:
+            bool: 是否已发送；对方未确认支持会话或连接已断开时返回False。
+        """
+        if not self.confirmed or self.closed:
+            return False
+        try:
+            with self.write_lock:
+                send_frame(self.sock, pack_control(message_type, **fields))
+            return True
+        except OSError:
+            return False
+
+    def close(self):
+        """关闭连接（两个方向的观看都随之结束）"""
+        self.closed = True
+        self.sock.close()
@@ -3,36 +3,46 @@ import mss.tools
 from PIL import Image
 import io
 
-def capture_screen():
+def capture_screen(source=None):
     """
     捕获整个屏幕的截图。
 
     使用 mss.mss() 作为上下文管理器，可以确保即使发生错误也能正确清理资源。
     
+    Args:
+        source (FrameSource): 可选的画面来源；为None时直接使用mss截取第一个监视器。
+
     Returns:
         mss.screenshot.ScreenShot: 返回一个mss的截图对象，包含了屏幕的原始像素数据和尺寸信息。
     """
+    if source is not None:
+        return source.grab()
     with mss.mss() as sct:
         # 获取第一个监视器的截图
         monitor = sct.monitors[1]
         sct_img = sct.grab(monitor)
         return sct_img
 
-def compress_image(sct_img, quality=75):
+def compress_image(sct_img, quality=75, out=None):
     """
     将mss截图对象压缩为JPEG格式的字节流。
 
     Args:
         sct_img (mss.screenshot.ScreenShot): mss捕获的截图对象。
         quality (int): JPEG的压缩质量，范围1-100，值越高质量越好，文件越大。
+        out: 可选的帧缓冲池缓冲区，给出时直接写入其中。
 
     Returns:
-        bytes: 返回JPEG格式的图像字节流。如果发生错误则返回None。
+        bytes: 返回JPEG格式的图像字节流（给出 out 时返回 out）。如果发生错误则返回None。
     """
     try:
         # 从原始BGRA像素数据创建Pillow图像对象
         img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
         
+        if out is not None:
+            img.save(out, format='JPEG', quality=quality, optimize=True)
+            return out
+        
         # 创建一个内存中的字节流IO对象
         img_byte_arr = io.BytesIO()
         
@@ -0,0 +1,153 @@
+import time
+
+from frame_protocol import pack_tile_frame
+from image_codecs import get_codec, DEFAULT_CODEC
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+class TileDiffEncoder:
+    """
+    分块差分编码器：将画面切成固定大小的块，与上一帧逐块比较，
+    只编码并发送发生变化的块，并按固定间隔插入完整关键帧。
+    """
+
+    def __init__(self, tile_size=64, keyframe_interval=60, strip_encoder=None, codec=None):
+        self.tile_size = tile_size
+        self.keyframe_interval = keyframe_interval
+        # 可选的并行编码器，用于多线程压缩关键帧和变化区域
+        self.strip_encoder = strip_encoder
+        # 关键帧和变化块使用的图像编码
+        self.codec = codec or get_codec(DEFAULT_CODEC)
+
+        self.prev_frame = None
+        # 逐像素比较用的工作数组，尺寸不变时每帧复用
+        self._diff = None
+        self._changed = None
+        self.frames_since_keyframe = 0
+        self.force_keyframe = True
+
+        # 统计信息
+        self.last_changed_ratio = 1.0
+        self.last_is_keyframe = True
+
+    def request_keyframe(self):
+        """要求下一帧发送完整关键帧（例如有新客户端连接时）。"""
+        self.force_keyframe = True
+
+    def encode(self, frame, quality=30, out=None):
+        """
+        对一帧画面进行差分编码。
+
+        Args:
+            frame: RGB格式的numpy数组 (H, W, 3) 或 PIL Image。
+            quality (int): JPEG压缩质量。
+            out: 可选的帧缓冲池缓冲区，给出时负载直接写入其中并返回它。
+
+        Returns:
+            bytes: 关键帧为完整图像（并行编码时为带关键帧标志的分块帧），
+                其余为分块帧负载（无变化时为空分块帧）。
+        """
+        frame = np.asarray(frame)
+        height, width = frame.shape[:2]
+
+        need_keyframe = (
+            self.force_keyframe
+            or self.prev_frame is None
+            or self.prev_frame.shape != frame.shape
+            or self.frames_since_keyframe >= self.keyframe_interval
+        )
+
+        if need_keyframe:
+            if self.strip_encoder:
+                payload = self.strip_encoder.encode(frame, quality, out, self.codec)
+            else:
+                payload = self.codec.encode(frame, quality, out)
+            self.force_keyframe = False
+            self.frames_since_keyframe = 0
+            self.last_changed_ratio = 1.0
+            self.last_is_keyframe = True
+        else:
+            rects, changed_tiles, total_tiles = self._find_changed_rects(frame)
+            if self.strip_encoder:
+                tiles = self.strip_encoder.encode_regions(frame, rects, quality, self.codec)
+            else:
+                tiles = [
+                    (x, y, w, h, self.codec.encode(frame[y:y + h, x:x + w], quality))
+                    for x, y, w, h in rects
+                ]
+            payload = pack_tile_frame(width, height, tiles, out=out)
+            self.frames_since_keyframe += 1
+            self.last_changed_ratio = changed_tiles / total_tiles if total_tiles else 0.0
+            self.last_is_keyframe = False
+
+        # 保存副本，调用方可能复用frame的内存；尺寸不变时复用上一帧的数组
+        if self.prev_frame is None or self.prev_frame.shape != frame.shape:
+            self.prev_frame = frame.copy()
+        else:
+            np.copyto(self.prev_frame, frame)
+        return payload
+
+    def _find_changed_rects(self, frame):
+        """比较当前帧和上一帧，返回变化块合并后的矩形列表。"""
+        ts = self.tile_size
+        height, width = frame.shape[:2]
+        rows = (height + ts - 1) // ts
+        cols = (width + ts - 1) // ts
+
+        # 逐像素比较后按块归约，结果写入复用的工作数组；
+        # 补齐到整块的边缘部分始终为False
+        if self._diff is None or self._diff.shape != frame.shape:
+            self._diff = np.empty(frame.shape, dtype=bool)
+            self._changed = np.zeros((rows * ts, cols * ts), dtype=bool)
+        np.not_equal(frame, self.prev_frame, out=self._diff)
+        np.any(self._diff, axis=2, out=self._changed[:height, :width])
+        tile_mask = self._changed.reshape(rows, ts, cols, ts).any(axis=(1, 3))
+
+        # 同一行内相邻的变化块合并为一个矩形，减少每块JPEG头部的开销
+        rects = []
+        for row in range(rows):
+            row_mask = tile_mask[row]
+            if not row_mask.any():
+                continue
+            y = row * ts
+            h = min(ts, height - y)
+            col = 0
+            while col < cols:
+                if not row_mask[col]:
+                    col += 1
+                    continue
+                start = col
+                while col < cols and row_mask[col]:
+                    col += 1
+                x = start * ts
+                w = min(col * ts, width) - x
+                rects.append((x, y, w, h))
+
+        return rects, int(tile_mask.sum()), rows * cols
+
+
+if __name__ == '__main__':
+    # 简单的自测：模拟一个只有"时钟"区域变化的静态桌面
+    if not NUMPY_AVAILABLE:
+        print("需要安装numpy才能运行差分编码测试")
+    else:
+        encoder = TileDiffEncoder(tile_size=64, keyframe_interval=60)
+        desktop = np.full((540, 960, 3), 200, dtype=np.uint8)
+
+        full_size = len(encoder.encode(desktop))
+        start_time = time.time()
+        total_size = 0
+        frames = 50
+        for i in range(frames):
+            desktop[500:520, 880:950] = (i * 37) % 256
+            total_size += len(encoder.encode(desktop))
+        elapsed = time.time() - start_time
+
+        print(f"关键帧大小: {full_size / 1024:.2f} KB")
+        print(f"差分帧平均大小: {total_size / frames / 1024:.2f} KB")
+        print(f"差分帧平均耗时: {elapsed / frames * 1000:.2f} ms")
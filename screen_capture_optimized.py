@@ -1,42 +1,56 @@
-import mss
-import mss.tools
 from PIL import Image
 import io
 
+from frame_source import MssFrameSource
+from image_scaling import bgra_to_rgb
+
 class OptimizedScreenCapture:
-    def __init__(self):
-        # 重用mss实例以减少初始化开销
-        self.sct = mss.mss()
-        self.monitor = self.sct.monitors[1]
+    def __init__(self, source=None):
+        # 重用画面来源（默认为mss实例）以减少初始化开销
+        self.owns_source = source is None
+        self.source = source if source is not None else MssFrameSource()
+        self.monitor = self.source.monitor
         
         # 可选的分辨率缩放以提升性能
         self.scale_factor = 0.75  # 缩放到75%以提升性能
         self.target_width = int(self.monitor['width'] * self.scale_factor)
         self.target_height = int(self.monitor['height'] * self.scale_factor)
         
+        # 复用的源尺寸RGB图像，避免每帧重新分配一张全尺寸图像
+        self.rgb_frame = None
+        
     def capture_screen(self):
         """优化的屏幕捕获"""
-        return self.sct.grab(self.monitor)
+        return self.source.grab()
     
-    def capture_screen_scaled(self):
+    def capture_screen_scaled(self, sct_img=None):
         """捕获并直接缩放屏幕以减少后续处理负担"""
-        sct_img = self.sct.grab(self.monitor)
+        if sct_img is None:
+            sct_img = self.source.grab()
         
-        # 如果需要缩放，直接在截图时处理
+        # 按实际截图尺寸计算目标分辨率（截取区域可能随时变化）
+        self.target_width = int(sct_img.width * self.scale_factor)
+        self.target_height = int(sct_img.height * self.scale_factor)
+        
+        # 转换结果写入复用的RGB图像；如果需要缩放，直接在截图时处理
+        self.rgb_frame = bgra_to_rgb(sct_img.raw, sct_img.width, sct_img.height, self.rgb_frame)
         if self.scale_factor != 1.0:
-            img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-            img_resized = img.resize((self.target_width, self.target_height), Image.LANCZOS)
+            img_resized = self.rgb_frame.resize((self.target_width, self.target_height), Image.LANCZOS)
             return img_resized
         else:
-            return Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
+            return self.rgb_frame
     
-    def compress_image_fast(self, img_or_sct, quality=50):
-        """快速图像压缩，移除一些慢速优化"""
+    def compress_image_fast(self, img_or_sct, quality=50, out=None):
+        """快速图像压缩，移除一些慢速优化；给出 out（帧缓冲池缓冲区）时直接写入并返回 out"""
         try:
             if hasattr(img_or_sct, 'bgra'):  # 这是mss截图对象
                 img = Image.frombytes("RGB", img_or_sct.size, img_or_sct.bgra, "raw", "BGRX")
             else:  # 这是PIL Image对象
                 img = img_or_sct
+            
+            if out is not None:
+                img.save(out, format='JPEG', quality=quality, optimize=False)
+                return out
                 
             # 创建内存中的字节流IO对象
             img_byte_arr = io.BytesIO()
@@ -51,8 +65,8 @@ class OptimizedScreenCapture:
     
     def __del__(self):
         """清理资源"""
-        if hasattr(self, 'sct'):
-            self.sct.close()
+        if getattr(self, 'owns_source', False):
+            self.source.close()
 
 # 全局实例，避免重复创建
 _capture_instance = None
@@ -1,70 +1,67 @@
-import mss
 from PIL import Image
 import io
 import time
 
-try:
-    import numpy as np
-    NUMPY_AVAILABLE = True
-except ImportError:
-    NUMPY_AVAILABLE = False
+from frame_source import MssFrameSource
+from image_scaling import area_downscale, bgra_to_rgb, scaled_size
 
 class UltraFastScreenCapture:
-    def __init__(self):
-        # 重用mss实例
-        self.sct = mss.mss()
-        self.monitor = self.sct.monitors[1]
-        
-        # 极度激进的性能优化设置
-        self.scale_factor = 0.5  # 50%缩放 -> 960x540
-        self.target_width = int(self.monitor['width'] * self.scale_factor)
-        self.target_height = int(self.monitor['height'] * self.scale_factor)
+    DEFAULT_SCALE_FACTOR = 0.5
+    
+    def __init__(self, source=None):
+        # 重用画面来源（默认为mss实例）
+        self.owns_source = source is None
+        self.source = source if source is not None else MssFrameSource()
+        self.monitor = self.source.monitor
         
-        # 区域采样优化
-        self.sample_rate = 2  # 每2个像素采样1个
+        # 极度激进的性能优化设置（支持任意比例，如0.3、0.4）
+        self.scale_factor = self.DEFAULT_SCALE_FACTOR  # 50%缩放 -> 960x540
+        self.target_width, self.target_height = scaled_size(
+            self.monitor['width'], self.monitor['height'], self.scale_factor)
         
-        # 预分配缓冲区
-        self.img_buffer = io.BytesIO()
+        # 复用的源尺寸RGB图像，避免每帧重新分配一张全尺寸图像
+        self.rgb_frame = None
         
         print(f"初始化超高速截图，目标分辨率: {self.target_width}x{self.target_height}")
     
+    def capture_frame(self, sct_img=None):
+        """截图并缩放到目标分辨率，返回RGB格式的PIL Image"""
+        # 1. 快速截图（调用方已截图时直接使用）
+        if sct_img is None:
+            sct_img = self.source.grab()
+        
+        # 2. 按实际截图尺寸计算目标分辨率（支持任意缩放比例）
+        self.target_width, self.target_height = scaled_size(sct_img.width, sct_img.height, self.scale_factor)
+        
+        # 3. BGRA→RGB 转换直接读取原始缓冲区并写入复用的RGB图像，再做区域平均缩放
+        self.rgb_frame = bgra_to_rgb(sct_img.raw, sct_img.width, sct_img.height, self.rgb_frame)
+        return area_downscale(self.rgb_frame, self.target_width, self.target_height)
+    
+    def compress(self, frame, quality=30, out=None):
+        """
+        将capture_frame的结果压缩为JPEG，返回直接指向编码缓冲区的memoryview（不复制）；
+        给出 out（帧缓冲池缓冲区）时直接写入并返回 out
+        """
+        img = Image.fromarray(frame, 'RGB') if not isinstance(frame, Image.Image) else frame
+        if out is not None:
+            img.save(out, format='JPEG', quality=quality, optimize=False)
+            return out
+        
+        # 每帧使用新的缓冲区：返回的memoryview会一直引用它，直到所有客户端发送完毕
+        img_buffer = io.BytesIO()
+        img.save(img_buffer, format='JPEG', quality=quality, optimize=False)
+        
+        return img_buffer.getbuffer()
+    
+    def __del__(self):
+        """清理资源"""
+        if getattr(self, 'owns_source', False):
+            self.source.close()
+    
     def capture_and_compress_ultra_fast(self, quality=30):
         """超快速截图+压缩一体化"""
         try:
-            # 1. 快速截图
-            sct_img = self.sct.grab(self.monitor)
-            
-            if NUMPY_AVAILABLE:
-                # 2. 直接从原始数据创建numpy数组（跳过PIL中间步骤）
-                raw_data = np.frombuffer(sct_img.bgra, dtype=np.uint8)
-                raw_data = raw_data.reshape((sct_img.height, sct_img.width, 4))
-                
-                # 3. 快速采样和缩放（跳过部分像素）
-                sampled_bgr = raw_data[::self.sample_rate, ::self.sample_rate, :3]  # 取BGR通道
-                
-                # 4. 修复颜色通道顺序：BGR → RGB
-                sampled_rgb = sampled_bgr[:, :, [2, 1, 0]]  # 交换蓝色和红色通道
-                
-                # 5. 转换为PIL Image进行快速压缩
-                img = Image.fromarray(sampled_rgb, 'RGB')
-            else:
-                # 回退到PIL方法
-                img = Image.frombytes("RGB", sct_img.size, sct_img.bgra, "raw", "BGRX")
-                # 采样缩放
-                sampled_size = (sct_img.width // self.sample_rate, sct_img.height // self.sample_rate)
-                img = img.resize(sampled_size, Image.NEAREST)
-            
-            # 6. 再次缩放到目标大小
-            if img.size != (self.target_width, self.target_height):
-                img = img.resize((self.target_width, self.target_height), Image.NEAREST)  # 使用最快的缩放算法
-            
-            # 7. 重用缓冲区压缩
-            self.img_buffer.seek(0)
-            self.img_buffer.truncate(0)
-            img.save(self.img_buffer, format='JPEG', quality=quality, optimize=False)
-            
-            return self.img_buffer.getvalue()
-            
+            return self.compress(self.capture_frame(), quality)
         except Exception as e:
             print(f"超快速压缩失败: {e}")
             return None
@@ -80,4 +77,8 @@ def get_ultra_capture():
 
 def capture_and_compress_ultra_fast(quality=30):
     """超快速一体化接口"""
-    return get_ultra_capture().capture_and_compress_ultra_fast(quality)
\ No newline at end of file
+    return get_ultra_capture().capture_and_compress_ultra_fast(quality)
+
+def capture_frame_ultra_fast():
+    """超快速截图接口（不压缩），供差分编码使用"""
+    return get_ultra_capture().capture_frame()
\ No newline at end of file
@@ -2,6 +2,8 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import json
 
+from image_codecs import available_codecs, DEFAULT_CODEC
+
 class SettingsDialog(tk.Toplevel):
     def __init__(self, parent, config):
         super().__init__(parent)
@@ -10,7 +12,7 @@ class SettingsDialog(tk.Toplevel):
         self.result = None
         
         self.title("设置")
-        self.geometry("400x500")
+        self.geometry("400x560")
         self.resizable(False, False)
         self.transient(parent)
         self.grab_set()
@@ -57,6 +59,18 @@ class SettingsDialog(tk.Toplevel):
         self.zoom_var = tk.StringVar(value=str(self.config['viewer']['zoom_scale']))
         ttk.Entry(viewer_frame, textvariable=self.zoom_var, width=10).grid(row=2, column=1, padx=5, pady=2)
         
+        # 连接时向对方请求的画面编码，对方不支持时自动回退到JPEG
+        ttk.Label(viewer_frame, text="画面编码:").grid(row=3, column=0, sticky="w", padx=5, pady=2)
+        self.codec_var = tk.StringVar(value=self.config['viewer'].get('codec', DEFAULT_CODEC))
+        ttk.Combobox(viewer_frame, textvariable=self.codec_var, values=available_codecs(),
+                     state='readonly', width=15).grid(row=3, column=1, padx=5, pady=2)
+        
+        # UDP避免丢包时的队头阻塞，适合丢包较多的无线网络；对方不支持时自动使用TCP
+        ttk.Label(viewer_frame, text="传输方式:").grid(row=4, column=0, sticky="w", padx=5, pady=2)
+        self.transport_var = tk.StringVar(value=self.config['viewer'].get('transport', 'tcp'))
+        ttk.Combobox(viewer_frame, textvariable=self.transport_var, values=["tcp", "udp"],
+                     state='readonly', width=15).grid(row=4, column=1, padx=5, pady=2)
+        
         # 性能设置
         performance_frame = ttk.LabelFrame(self, text="性能设置", padding=(10, 5))
         performance_frame.pack(padx=10, pady=5, fill="x")
@@ -64,7 +78,7 @@ class SettingsDialog(tk.Toplevel):
         ttk.Label(performance_frame, text="性能档案:").grid(row=0, column=0, sticky="w", padx=5, pady=2)
         self.profile_var = tk.StringVar(value=self.config.get('performance', {}).get('profile', 'balanced'))
         profile_combo = ttk.Combobox(performance_frame, textvariable=self.profile_var, 
-                                   values=['quality', 'balanced', 'performance'],
+                                   values=['quality', 'balanced', 'performance', 'adaptive'],
                                    state='readonly', width=15)
         profile_combo.grid(row=0, column=1, padx=5, pady=2)
         
@@ -72,7 +86,8 @@ class SettingsDialog(tk.Toplevel):
         profile_descriptions = {
             'quality': '高质量模式 - 最佳画质，适合演示',
             'balanced': '平衡模式 - 画质与性能平衡',
-            'performance': '高性能模式 - 最高帧率，适合游戏'
+            'performance': '高性能模式 - 最高帧率，适合游戏',
+            'adaptive': '自适应模式 - 根据网络和CPU状况自动调节'
         }
         
         self.profile_desc_var = tk.StringVar(value=profile_descriptions.get(self.profile_var.get(), ''))
@@ -126,7 +141,9 @@ class SettingsDialog(tk.Toplevel):
                 "viewer": {
                     "default_width": int(self.width_var.get()),
                     "default_height": int(self.height_var.get()),
-                    "zoom_scale": float(self.zoom_var.get())
+                    "zoom_scale": float(self.zoom_var.get()),
+                    "codec": self.codec_var.get(),
+                    "transport": self.transport_var.get()
                 },
                 "ui": {
                     "show_fps": self.show_fps_var.get(),
@@ -137,6 +154,13 @@ class SettingsDialog(tk.Toplevel):
                 }
             }
             
+            # 保留对话框中未展示的高级配置项（如差分编码参数）
+            for section, values in self.config.items():
+                if isinstance(values, dict):
+                    merged = dict(values)
+                    merged.update(new_config.get(section, {}))
+                    new_config[section] = merged
+            
             # 验证范围
             if not (1 <= new_config['network']['default_port'] <= 65535):
                 raise ValueError("端口号必须在1-65535之间")
@@ -175,6 +199,8 @@ class SettingsDialog(tk.Toplevel):
             self.width_var.set("480")
             self.height_var.set("270")
             self.zoom_var.set("2.0")
+            self.codec_var.set(DEFAULT_CODEC)
+            self.transport_var.set("tcp")
             self.show_fps_var.set(True)
             self.show_status_var.set(True)
             self.profile_var.set("balanced")  # 新增性能档案默认值
@@ -0,0 +1,536 @@
+"""
+UDP画面传输：分片、重组、迟到帧丢弃与可选的奇偶校验FEC。
+
+TCP在丢包时必须等重传完成才能交付后面的数据（队头阻塞），Wi-Fi上丢一个包就会让
+之后的所有画面一起卡住，而实时画面只关心最新的一帧。
+
+观看端在握手中给出自己的UDP端口（"udp_port"，可选 "fec"），发送端为它创建一个
+已连接的UDP套接字，画面按 fragment_size 切成数据报发送：
+- 每个数据报带分片头（FRAGMENT_HEADER），可按帧序号和分片序号乱序重组；
+- 开启FEC时每 fec_group 个数据分片附加一个异或校验分片，组内丢失一个分片可直接恢复；
+- 某一帧收齐后，比它旧的未完成帧全部丢弃，迟到的数据报直接忽略；
+- 观看端发现丢帧后经同一UDP套接字请求关键帧，在关键帧到达前跳过差分帧。
+
+TCP连接仍然保留，用于握手、保活消息和断线检测。
+"""
+import select
+import socket
+import struct
+import threading
+import time
+
+from frame_protocol import send_frame, frame_is_newer, is_keyframe, HAS_SENDMSG
+from frame_pool import release_payload
+from client_sender import FrameSlot, socket_backlog
+
+MAGIC_FRAGMENT = b'GHUD'
+# 分片头: 魔数, 帧序号, 帧总长度, 分片序号(校验分片为组序号), 数据分片数量, 分片大小, 标志, FEC分组大小
+FRAGMENT_HEADER = struct.Struct('>4sIIHHHBB')
+FLAG_PARITY = 0x01
+
+# 观看端 → 发送端：请求关键帧，附带最后收齐的帧序号
+MAGIC_KEYFRAME_REQUEST = b'GHUK'
+KEYFRAME_REQUEST = struct.Struct('>4sI')
+
+# 默认分片负载大小：加上IP/UDP头和分片头后不超过常见路径MTU（1280~1500）
+DEFAULT_FRAGMENT_SIZE = 1200
+MAX_FEC_GROUP = 16
+
+# 发送线程等待新帧时检查关键帧请求的间隔（秒）
+FEEDBACK_POLL_INTERVAL = 0.05
+
+
+def fragment_frame(frame_id, data, fragment_size=DEFAULT_FRAGMENT_SIZE, fec_group=0, prefix=b''):
+    """
+    将一帧切分为数据报。
+
+    Args:
+        frame_id (int): 帧序号（32位回绕）。
+        data: 帧数据，不会被复制。
+        fragment_size (int): 每个分片的最大负载字节数。
+        fec_group (int): 每多少个数据分片附加一个异或校验分片，0 表示不使用FEC。
+        prefix (bytes): 放在 data 之前一起发送的数据（如v2帧头），
+            只有与它落在同一分片中的那部分 data 会被复制。
+
+    Returns:
+        list: [(分片头, 负载), ...]，负载为 data 的 memoryview 切片（含 prefix 的分片和校验分片为bytes）。
+    """
+    view = memoryview(data)
+    prefix_size = len(prefix)
+    size = prefix_size + len(view)
+    count = max(1, -(-size // fragment_size))
+    frame_id &= 0xFFFFFFFF
+
+    datagrams = []
+    for index in range(count):
+        header = FRAGMENT_HEADER.pack(MAGIC_FRAGMENT, frame_id, size, index, count, fragment_size, 0, fec_group)
+        start, end = index * fragment_size, min((index + 1) * fragment_size, size)
+        if start >= prefix_size:
+            chunk = view[start - prefix_size:end - prefix_size]
+        else:
+            chunk = bytes(prefix[start:min(end, prefix_size)]) + bytes(view[:max(0, end - prefix_size)])
+        datagrams.append((header, chunk))
+
+    if fec_group:
+        for group, start in enumerate(range(0, count, fec_group)):
+            chunks = [chunk for _, chunk in datagrams[start:min(start + fec_group, count)]]
+            header = FRAGMENT_HEADER.pack(MAGIC_FRAGMENT, frame_id, size, group, count, fragment_size,
+                                          FLAG_PARITY, fec_group)
+            datagrams.append((header, xor_chunks(chunks, len(chunks[0]))))
+    return datagrams
+
+
+def xor_chunks(chunks, length):
+    """将若干数据块（不足 length 的按0补齐）按字节异或，返回 length 字节"""
+    parity = 0
+    for chunk in chunks:
+        parity ^= int.from_bytes(chunk, 'little')
+    return parity.to_bytes(length, 'little')
+
+
+class _PartialFrame:
+    """重组中的一帧"""
+
+    __slots__ = ('data', 'count', 'fragment_size', 'fec_group', 'received', 'parity')
+
+    def __init__(self, size, count, fragment_size, fec_group):
+        self.data = bytearray(size)
+        self.count = count
+        self.fragment_size = fragment_size
+        self.fec_group = fec_group
+        self.received = set()
+        self.parity = {}  # 组序号 → 校验分片
+
+    def chunk_range(self, index):
+        start = index * self.fragment_size
+        return start, min(start + self.fragment_size, len(self.data))
+
+
+class FrameAssembler:
+    """
+    将乱序到达的数据报重组为完整帧。
+
+    某一帧收齐时，比它旧的未完成帧被丢弃；之后到达的旧帧数据报直接忽略。
+    """
+
+    def __init__(self, max_frame_size=None, max_pending=8):
+        self.max_frame_size = max_frame_size
+        self.max_pending = max_pending
+        self.pending = {}  # 帧序号 → _PartialFrame
+        self.last_frame_id = None
+
+        # 统计信息
+        self.frames_completed = 0
+        self.frames_lost = 0        # 未能收齐就被更新的帧取代（含完全没收到的帧）
+        self.frames_recovered = 0   # 通过FEC恢复了丢失分片的帧
+        self.datagrams_late = 0
+        self.last_gap = 0           # 最近交付的帧与上一帧之间丢失的帧数
+
+    def add(self, datagram):
+        """
+        加入一个数据报。
+
+        Returns:
+            bytearray: 本数据报使一帧收齐时返回该帧，否则返回None。
+
+        Raises:
+            ValueError: 数据报格式错误。
+        """
+        if len(datagram) < FRAGMENT_HEADER.size:
+            raise ValueError("数据报过短")
+        magic, frame_id, size, index, count, fragment_size, flags, fec_group = \
+            FRAGMENT_HEADER.unpack_from(datagram, 0)
+        if magic != MAGIC_FRAGMENT or not fragment_size or count != max(1, -(-size // fragment_size)):
+            raise ValueError("分片头格式错误")
+        if self.max_frame_size is not None and size > self.max_frame_size:
+            raise ValueError(f"帧长度 {size} 超过上限 {self.max_frame_size}")
+
+        if self.last_frame_id is not None and not frame_is_newer(frame_id, self.last_frame_id):
+            if frame_id != self.last_frame_id:
+                self.datagrams_late += 1  # 已交付帧的剩余分片（如校验分片）不计入
+            return None
+
+        frame = self.pending.get(frame_id)
+        if frame is None:
+            if len(self.pending) >= self.max_pending:
+                # 积压过多未完成的帧，放弃最旧的
+                del self.pending[max(self.pending, key=lambda fid: (frame_id - fid) & 0xFFFFFFFF)]
+            frame = self.pending[frame_id] = _PartialFrame(size, count, fragment_size, fec_group)
+
+        payload = memoryview(datagram)[FRAGMENT_HEADER.size:]
+        if flags & FLAG_PARITY:
+            if index * max(fec_group, 1) >= count:
+                raise ValueError("校验分片序号错误")
+            frame.parity[index] = bytes(payload)
+            group = index
+        else:
+            if index >= count:
+                raise ValueError("分片序号错误")
+            if index not in frame.received:
+                start, end = frame.chunk_range(index)
+                frame.data[start:end] = payload[:end - start]
+                frame.received.add(index)
+            group = index // fec_group if fec_group else None
+
+        if group is not None and len(frame.received) < frame.count:
+            self._recover(frame, group)
+        if len(frame.received) < frame.count:
+            return None
+        return self._complete(frame_id)
+
+    def _recover(self, frame, group):
+        """组内恰好丢失一个数据分片且校验分片已到达时，用异或恢复它"""
+        parity = frame.parity.get(group)
+        if parity is None:
+            return
+        members = range(group * frame.fec_group, min((group + 1) * frame.fec_group, frame.count))
+        missing = [index for index in members if index not in frame.received]
+        if len(missing) != 1:
+            return
+        view = memoryview(frame.data)
+        chunks = [parity] + [view[slice(*frame.chunk_range(index))] for index in members if index != missing[0]]
+        start, end = frame.chunk_range(missing[0])
+        frame.data[start:end] = xor_chunks(chunks, len(parity))[:end - start]
+        frame.received.add(missing[0])
+        self.frames_recovered += 1
+
+    def _complete(self, frame_id):
+        frame = self.pending.pop(frame_id)
+        # 比它旧的未完成帧已经没有意义
+        for stale_id in [fid for fid in self.pending if not frame_is_newer(fid, frame_id)]:
+            del self.pending[stale_id]
+
+        self.last_gap = 0 if self.last_frame_id is None else ((frame_id - self.last_frame_id - 1) & 0xFFFFFFFF)
+        self.frames_lost += self.last_gap
+        self.frames_completed += 1
+        self.last_frame_id = frame_id
+        return frame.data
+
+    def stats(self):
+        """返回重组统计"""
+        return {
+            "frames_completed": self.frames_completed,
+            "frames_lost": self.frames_lost,
+            "frames_recovered": self.frames_recovered,
+            "datagrams_late": self.datagrams_late,
+        }
+
+
+class UdpSender(FrameSlot):
+    """
+    单个观看端的UDP发送线程。
+
+    画面经已连接的UDP套接字分片发送；零长度保活消息仍走TCP连接，顺便检测断线。
+    观看端的关键帧请求从同一UDP套接字读取，收到后跳过差分帧并通过 on_dropped 请求关键帧。
+    """
+
+    def __init__(self, udp_sock, tcp_sock, addr, fragment_size=DEFAULT_FRAGMENT_SIZE, fec_group=0,
+                 on_sent=None, on_closed=None, on_dropped=None):
+        super().__init__(addr, on_sent, on_closed, on_dropped)
+        self.udp_sock = udp_sock
+        self.tcp_sock = tcp_sock
+        self.fragment_size = fragment_size
+        self.fec_group = fec_group
+        self.frame_id = 0
+        self.datagrams_sent = 0
+        self.keyframe_requests = 0
+        self.udp_sock.settimeout(1.0)
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f"udp-sender-{addr[0]}:{addr[1]}")
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                with self.cond:
+                    if self.pending is None and self.running:
+                        self.cond.wait(FEEDBACK_POLL_INTERVAL)
+                    if not self.running:
+                        break
+                    payload, data = self._take()
+                self._poll_feedback()
+                if payload is None:
+                    continue
+
+                try:
+                    send_start = time.time()
+                    if len(data) == 0:
+                        if self.tcp_sock is not None:
+                            send_frame(self.tcp_sock, data)
+                    else:
+                        self._send_datagrams(data, self._frame_header(payload))
+                    self._record_sent(len(data), time.time() - send_start)
+                finally:
+                    del data
+                    release_payload(payload)
+        except OSError:
+            self._stop()
+            if self.on_closed:
+                self.on_closed(self)
+        finally:
+            self.udp_sock.close()
+
+    def _send_datagrams(self, data, frame_header=b''):
+        self.frame_id = (self.frame_id + 1) & 0xFFFFFFFF
+        for header, chunk in fragment_frame(self.frame_id, data, self.fragment_size, self.fec_group,
+                                            frame_header):
+            if HAS_SENDMSG:
+                self.udp_sock.sendmsg([header, chunk])
+            else:
+                self.udp_sock.send(header + chunk)
+            self.datagrams_sent += 1
+
+    def _poll_feedback(self):
+        """读取观看端的关键帧请求（不阻塞）"""
+        while select.select([self.udp_sock], [], [], 0)[0]:
+            message = self.udp_sock.recv(64)
+            if len(message) != KEYFRAME_REQUEST.size or message[:4] != MAGIC_KEYFRAME_REQUEST:
+                continue
+            self.keyframe_requests += 1
+            with self.cond:
+                self.needs_keyframe = True
+            if self.on_dropped:
+                self.on_dropped(self)
+
+    def send_backlog(self):
+        return socket_backlog(self.udp_sock)
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "transport": "udp",
+            "datagrams_sent": self.datagrams_sent,
+            "keyframe_requests": self.keyframe_requests,
+        })
+        return stats
+
+
+class UdpReceiver:
+    """
+    观看端的UDP接收：重组画面，丢帧后请求关键帧并跳过差分帧直到关键帧到达。
+
+    on_frame(memoryview) 在接收线程中调用。给出 peer_ip 时只接受来自该地址的数据报，
+    局域网内其他主机猜到端口也无法向观看窗口注入画面。
+    """
+
+    # 等待关键帧期间重复请求的间隔（秒），防止请求本身丢失
+    KEYFRAME_RETRY_INTERVAL = 0.25
+
+    def __init__(self, sock, on_frame, max_frame_size=None, peer_ip=None):
+        self.sock = sock
+        self.on_frame = on_frame
+        self.peer_ip = peer_ip
+        self.datagrams_rejected = 0  # 来自其他地址而被丢弃的数据报
+        self.assembler = FrameAssembler(max_frame_size)
+        self.needs_keyframe = True
+        self.frames_skipped = 0
+        self.last_request_time = 0.0
+
+    def run(self, is_running):
+        """接收循环，is_running() 返回False或套接字关闭时退出"""
+        buffer = bytearray(65536)
+        self.sock.settimeout(0.1)
+        while is_running():
+            try:
+                size, sender_addr = self.sock.recvfrom_into(buffer)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            if self.peer_ip is not None and sender_addr[0] != self.peer_ip:
+                self.datagrams_rejected += 1
+                continue
+            try:
+                frame = self.assembler.add(memoryview(buffer)[:size])
+            except ValueError:
+                continue  # 不是本程序的数据报
+            if frame is None:
+                continue
+
+            if self.assembler.last_gap:
+                self.needs_keyframe = True
+            if self.needs_keyframe and not is_keyframe(frame):
+                # 丢失的帧可能是差分基准，应用后续差分帧会出现花屏
+                self.frames_skipped += 1
+                self._request_keyframe(sender_addr)
+                continue
+            self.needs_keyframe = False
+            self.on_frame(memoryview(frame))
+
+    def _request_keyframe(self, sender_addr):
+        now = time.time()
+        if now - self.last_request_time < self.KEYFRAME_RETRY_INTERVAL:
+            return
+        self.last_request_time = now
+        try:
+            self.sock.sendto(KEYFRAME_REQUEST.pack(MAGIC_KEYFRAME_REQUEST, self.assembler.last_frame_id or 0),
+                             sender_addr)
+        except OSError:
+            pass
+
+    def stats(self):
+        stats = self.assembler.stats()
+        stats["frames_skipped"] = self.frames_skipped
+        stats["datagrams_rejected"] = self.datagrams_rejected
+        return stats
+
+
+if __name__ == '__main__':
+    # 回环测试：经注入丢包/乱序的链路发送画面，比较TCP与UDP（可选FEC）的帧延迟
+    import heapq
+    import os
+    import random
+    from client_sender import ClientSender
+    from frame_protocol import recv_message
+
+    frame_size = 40 * 1024
+    fps = 20
+    frames = 100
+    rtt = 0.02          # 模拟Wi-Fi往返时延，两种链路单程都延后 rtt / 2
+    rto = 0.2           # Linux TCP最小重传超时
+    segment_size = 1448
+    reorder_delay = 0.005
+    stamp = struct.Struct('>Id')  # 帧编号, 发送时间
+    filler = os.urandom(frame_size - stamp.size)
+
+    class LossyUdpLink:
+        """UDP中转：按概率丢弃或延后转发数据报；反方向（关键帧请求）原样转发"""
+
+        def __init__(self, target, loss, reorder):
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(('127.0.0.1', 0))
+            self.target, self.loss, self.reorder = target, loss, reorder
+            self.source = None
+            self.queue = []
+            self.running = True
+            threading.Thread(target=self._run, daemon=True).start()
+
+        def _run(self):
+            seq = 0
+            while self.running:
+                now = time.perf_counter()
+                while self.queue and self.queue[0][0] <= now:
+                    _, _, data, dest = heapq.heappop(self.queue)
+                    self.sock.sendto(data, dest)
+                timeout = max(0.0, self.queue[0][0] - now) if self.queue else 0.05
+                if not select.select([self.sock], [], [], timeout)[0]:
+                    continue
+                data, src = self.sock.recvfrom(65536)
+                if src == self.target:
+                    self.sock.sendto(data, self.source)
+                    continue
+                self.source = src
+                if random.random() < self.loss:
+                    continue
+                delay = rtt / 2 + (reorder_delay if random.random() < self.reorder else 0.0)
+                seq += 1
+                heapq.heappush(self.queue, (now + delay, seq, data, self.target))
+
+    class LossyTcpLink:
+        """
+        TCP中转：按段模拟丢包重传，丢失的段及其后所有数据都要等待重传（队头阻塞）。
+        后面还有至少3个段时靠重复ACK快速重传（约一个RTT），否则要等重传超时。
+        """
+
+        def __init__(self, target, loss):
+            self.server = socket.create_server(('127.0.0.1', 0))
+            self.target, self.loss = target, loss
+            self.segments = []
+            self.cond = threading.Condition()
+            threading.Thread(target=self._run, daemon=True).start()
+
+        def _run(self):
+            upstream, _ = self.server.accept()
+            downstream = socket.create_connection(self.target)
+            downstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._forward, args=(downstream,), daemon=True).start()
+            release_time = 0.0
+            while True:
+                data = upstream.recv(65536)
+                if not data:
+                    break
+                starts = range(0, len(data), segment_size)
+                for n, start in enumerate(starts):
+                    release_time = max(time.perf_counter() + rtt / 2, release_time)
+                    if random.random() < self.loss:
+                        release_time += rtt if len(starts) - n > 3 else rto
+                    with self.cond:
+                        self.segments.append((release_time, data[start:start + segment_size]))
+                        self.cond.notify()
+            with self.cond:
+                self.segments.append((0.0, None))
+                self.cond.notify()
+
+        def _forward(self, downstream):
+            while True:
+                with self.cond:
+                    while not self.segments:
+                        self.cond.wait()
+                    release_time, segment = self.segments.pop(0)
+                if segment is None:
+                    downstream.close()
+                    return
+                time.sleep(max(0.0, release_time - time.perf_counter()))
+                downstream.sendall(segment)
+
+    def run_frames(sender):
+        for i in range(frames):
+            sender.submit(stamp.pack(i, time.perf_counter()) + filler)
+            time.sleep(1 / fps)
+        time.sleep(rto * 3)
+        sender.close()
+
+    def record(latencies, frame):
+        _, sent_at = stamp.unpack_from(frame, 0)
+        latencies.append(time.perf_counter() - sent_at)
+
+    def run_tcp(loss, reorder):
+        latencies = []
+        receiver_server = socket.create_server(('127.0.0.1', 0))
+        link = LossyTcpLink(receiver_server.getsockname(), loss)
+
+        def receive():
+            sock, _ = receiver_server.accept()
+            try:
+                while True:
+                    record(latencies, recv_message(sock))
+            except OSError:
+                pass
+        thread = threading.Thread(target=receive, daemon=True)
+        thread.start()
+        sock = socket.create_connection(link.server.getsockname())
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        run_frames(ClientSender(sock, ('127.0.0.1', 0)))
+        sock.close()
+        thread.join(2)
+        return latencies
+
+    def run_udp(loss, reorder, fec_group):
+        latencies = []
+        receiver_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver_sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        receiver_sock.bind(('127.0.0.1', 0))
+        link = LossyUdpLink(receiver_sock.getsockname(), loss, reorder)
+        receiver = UdpReceiver(receiver_sock, lambda frame: record(latencies, frame))
+        running = [True]
+        threading.Thread(target=receiver.run, args=(lambda: running[0],), daemon=True).start()
+
+        sender_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sender_sock.connect(link.sock.getsockname())
+        run_frames(UdpSender(sender_sock, None, ('127.0.0.1', 0), fec_group=fec_group))
+        running[0] = False
+        link.running = False
+        return latencies
+
+    for loss, reorder in ((0.0, 0.0), (0.01, 0.05), (0.05, 0.05)):
+        for name, run in (("TCP", run_tcp),
+                          ("UDP", lambda l, r: run_udp(l, r, 0)),
+                          ("UDP+FEC(4)", lambda l, r: run_udp(l, r, 4))):
+            random.seed(1)
+            latencies = sorted(run(loss, reorder))
+            if not latencies:
+                print(f"[{name:>10} | 丢包 {loss:.0%}] 没有收到任何帧")
+                continue
+            pick = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q))] * 1000
+            print(f"[{name:>10} | 丢包 {loss:4.0%} 乱序 {reorder:3.0%}] 送达: {len(latencies):3d}/{frames}, "
+                  f"延迟 p50: {pick(0.5):6.1f} ms, p95: {pick(0.95):6.1f} ms, p99: {pick(0.99):6.1f} ms, "
+                  f"最大: {latencies[-1] * 1000:6.1f} ms")
@@ -1,10 +1,25 @@
 import tkinter as tk
 from PIL import Image, ImageTk
 import io
+import math
+import threading
 import time
+from frame_protocol import (is_tile_frame, unpack_tile_frame, unpack_frame, frame_is_newer, is_keyframe,
+                            FLAG_KEYFRAME)
+from image_codecs import decode_image, image_size, reduced_size
+
+# 缩小解码的倍数（JPEG的DCT缩放支持1/2、1/4、1/8），从大到小尝试
+DECODE_REDUCTIONS = (8, 4, 2)
+# 为放大时能以原尺寸重建画面而保留的最近关键帧及其后差分帧的总大小上限
+GOP_MAX_BYTES = 16 * 1024 * 1024
+# 一次显示中局部更新的矩形数上限，超过时合并为一个包围矩形
+MAX_DIRTY_RECTS = 16
+# 缩放滤波会影响变化区域周围的像素，局部更新时向外扩展的像素数（显示坐标）
+DIRTY_MARGIN = 3
 
 class ViewerWindow(tk.Toplevel):
-    def __init__(self, master, peer_addr, default_size=(480, 270), zoom_scale=1.5, show_fps=True):
+    def __init__(self, master, peer_addr, default_size=(480, 270), zoom_scale=1.5, show_fps=True,
+                 reduced_decode=True):
         super().__init__(master)
         
         self.peer_addr = peer_addr
@@ -12,6 +27,7 @@ class ViewerWindow(tk.Toplevel):
         self.zoom_scale = zoom_scale
         self.is_zoomed = False
         self.show_fps = show_fps
+        self.reduced_decode = reduced_decode
 
         # FPS tracking
         self.frame_count = 0
@@ -39,6 +55,36 @@ class ViewerWindow(tk.Toplevel):
             self.fps_label.place(x=5, y=5)  # 左上角显示
         
         self.last_image = None # Store the last raw PIL image for resizing
+        # 解码线程（见 decode_pool）修改 last_image，Tk线程缩放时读取它
+        self.image_lock = threading.Lock()
+        # 缩小解码：画面比窗口大时按 decode_scale 倍缩小解码，last_image 是缩小后的画面。
+        # frame_size 是对方画面的原始尺寸；gop 保存最近的关键帧及其后的差分帧，
+        # 放大后需要更高的分辨率时据此重新解码，不必等下一个关键帧
+        self.decode_scale = 1
+        self.frame_size = None
+        self.gop = None
+        self.gop_bytes = 0
+        # 本批帧中变化的区域（原始画面坐标 (x, y, w, h)），None 表示整幅画面都变了
+        self.changed_rects = None
+        # 当前画面缩放到各显示尺寸的结果，按画面版本（每应用一批有变化的帧加一）缓存，
+        # 鼠标进出窗口时直接取用，不在Tk线程中缩放
+        self.frame_version = 0
+        self.renditions = {}            # K: 显示尺寸, V: 缩放好的画面
+        self.renditions_version = 0
+        # 发布给Tk线程的 (画面版本, 各尺寸画面) 快照：只整体替换，Tk线程读取时不加锁
+        self.rendition_snapshot = (0, {})
+        self.decode_target = None       # 为非当前显示尺寸准备画面时，按该尺寸选择解码倍数
+        self.decode_pool = None         # 由 DecodePool.add_viewer 设置，用于在后台缩放
+
+        # 每种显示尺寸（正常/放大）各一个 PhotoImage，之后只把新画面 paste 进去，
+        # 不再每帧新建 Tk 图像并重新配置 Label；scratch_photo 用于局部更新时中转变化区域
+        self.tk_image = None
+        self.photos = {}
+        self.scratch_photo = None
+        
+        # 协议v2帧头：最近应用的帧，以及因过时（序号不比它新）而未解码就丢弃的帧数
+        self.last_frame_header = None
+        self.stale_frames = 0
 
         # --- Drag and Drop ---
         self._offset_x = 0
@@ -79,54 +125,362 @@ class ViewerWindow(tk.Toplevel):
             
     def _resize_and_update_image(self, target_size):
         """内部方法：根据目标尺寸缩放并更新显示的图像。"""
-        if self.last_image:
+        with self.image_lock:
+            if self.last_image is None:
+                return
             try:
-                resized_pil_img = self.last_image.resize(target_size, Image.Resampling.LANCZOS)
-                self.tk_image = ImageTk.PhotoImage(resized_pil_img)
-                self.image_label.config(image=self.tk_image)
-                self.image_label.image = self.tk_image  # Keep reference
+                resized_pil_img = self._rendition(target_size)
             except Exception as e:
                 print(f"图像缩放失败: {e}")
+                return
+        self._set_image(resized_pil_img)
+
+    def _show_rendition(self, target_size):
+        """
+        （Tk线程）显示当前画面在目标尺寸下的版本：已缓存时直接显示；
+        否则交给解码线程池在后台缩放，下一个刷新周期显示。
+        """
+        if self.last_image is None:
+            return
+        # 只读取解码线程发布的快照，不等待 image_lock（解码关键帧、重建画面时会持有较久）。
+        # 缓存的画面都已按其尺寸确保了足够的解码分辨率
+        _, renditions = self.rendition_snapshot
+        image = renditions.get(target_size)
+        if image is not None:
+            self._set_image(image)
+            return
+        if self.decode_pool is not None:
+            self.decode_pool.request_render(self.peer_addr)
+        else:
+            self._resize_and_update_image(target_size)
+
+    def _cached_rendition(self, target_size):
+        """当前画面版本在目标尺寸下已缩放好的画面，没有时返回None（调用方持有 image_lock）"""
+        if self.renditions_version != self.frame_version:
+            return None
+        return self.renditions.get(target_size)
+
+    def _rendition(self, target_size, previous=None, dirty=None):
+        """
+        取当前画面在目标尺寸下的版本，没有缓存时缩放并缓存（调用方持有 image_lock）。
+
+        Args:
+            previous: 上一版本画面在该尺寸下的缩放结果。
+            dirty: 相对上一版本变化的区域（显示坐标），与 previous 一起给出时只重新缩放这些区域。
+        """
+        if self._ensure_resolution(target_size):
+            previous = None
+        image = self._cached_rendition(target_size)
+        if image is None:
+            if self.renditions_version != self.frame_version:
+                self.renditions = {}
+                self.renditions_version = self.frame_version
+            if previous is not None and dirty is not None and previous.size == target_size:
+                image = self._patched_image(previous, dirty)
+            else:
+                image = self._scaled_image(target_size)
+            self.renditions[target_size] = image
+            self.rendition_snapshot = (self.frame_version, dict(self.renditions))
+        return image
+
+    def render(self):
+        """（解码线程）按当前显示尺寸取画面，返回 (画面, None) 或None，供 show_image 整幅显示"""
+        with self.image_lock:
+            if self.last_image is None:
+                return None
+            return self._rendition(self._target_size()), None
+
+    def prepare_renditions(self):
+        """（解码线程）预先准备放大和正常两种尺寸的画面，之后鼠标进出窗口不再需要缩放"""
+        with self.image_lock:
+            if self.last_image is None or self.renditions_prepared():
+                return
+            # 先准备放大尺寸：它可能需要以更高分辨率重新解码，使之前缓存的版本失效
+            self._rendition(self._zoomed_size())
+            self._rendition(self.default_size)
+
+    def renditions_prepared(self):
+        """当前画面版本的放大和正常两种尺寸是否都已发布在快照中（只读快照，不需要 image_lock）"""
+        version, renditions = self.rendition_snapshot
+        return (version == self.frame_version
+                and self._zoomed_size() in renditions and self.default_size in renditions)
+
+    def _scaled_image(self, target_size):
+        """将 last_image 缩放到目标尺寸（调用方持有 image_lock）"""
+        return self.last_image.resize(target_size, self._resample(target_size))
+
+    def _patched_image(self, previous, dirty):
+        """
+        在上一版本的缩放结果上只重新缩放变化区域（调用方持有 image_lock）。
+
+        resize() 的 box 参数按整幅缩放时的坐标映射取源区域，滤波也会读取区域外的像素，
+        结果与整幅缩放后对应位置的像素一致。previous 可能正被Tk线程读取，在副本上修改。
+        """
+        img = self.last_image
+        image = previous.copy()
+        resample = self._resample(image.size)
+        scale_x = img.width / image.width
+        scale_y = img.height / image.height
+        for left, top, right, bottom in dirty:
+            if right <= left or bottom <= top:
+                continue
+            box = (left * scale_x, top * scale_y, right * scale_x, bottom * scale_y)
+            image.paste(img.resize((right - left, bottom - top), resample, box=box), (left, top))
+        return image
+
+    def _resample(self, target_size):
+        img = self.last_image
+        if img.width < target_size[0] * 2 and img.height < target_size[1] * 2:
+            # 缩小解码后画面已接近窗口大小，双线性缩放即可，不必用开销大得多的LANCZOS
+            return Image.Resampling.BILINEAR
+        return Image.Resampling.LANCZOS
+
+    def _set_image(self, pil_img, dirty=None):
+        """
+        把缩放好的画面显示到窗口（Tk线程）。
+
+        Args:
+            dirty: 相对当前显示的画面变化了的矩形 [(left, top, right, bottom), ...]，
+                None 表示整幅更新。
+        """
+        photo = self.photos.get(pil_img.size)
+        if photo is None:
+            photo = self.photos[pil_img.size] = ImageTk.PhotoImage(pil_img)
+        elif dirty is None or photo is not self.tk_image:
+            # 切换尺寸后该 PhotoImage 里是旧画面，整幅更新
+            photo.paste(pil_img)
+        else:
+            for box in dirty:
+                self._paste_region(photo, pil_img, box)
+        if photo is not self.tk_image:
+            self.tk_image = photo
+            self.image_label.config(image=self.tk_image)
+            self.image_label.image = self.tk_image  # Keep reference
+
+    def _paste_region(self, photo, pil_img, box):
+        """只把画面中的一个矩形更新到 PhotoImage，Tk 也只重绘这一块"""
+        left, top, right, bottom = box
+        width, height = right - left, bottom - top
+        if width <= 0 or height <= 0:
+            return
+        scratch = self.scratch_photo
+        if scratch is None or scratch.width() < width or scratch.height() < height:
+            scratch = self.scratch_photo = ImageTk.PhotoImage("RGB", pil_img.size)
+        # ImageTk 只能从左上角整块写入，先写到中转图像，再由 Tk 复制到目标位置
+        scratch.paste(pil_img.crop(box))
+        photo.tk.call(str(photo), "copy", str(scratch),
+                      "-from", 0, 0, width, height, "-to", left, top)
+
+    def _target_size(self):
+        """当前的显示尺寸（放大时按 zoom_scale 放大）"""
+        if self.is_zoomed:
+            return self._zoomed_size()
+        return self.default_size
+
+    def _zoomed_size(self):
+        return (int(self.default_size[0] * self.zoom_scale), int(self.default_size[1] * self.zoom_scale))
             
     def zoom(self):
         """执行放大操作。"""
         if self.last_image is None:
             return  # 尚未收到图像时不执行缩放
-        zoomed_w = int(self.default_size[0] * self.zoom_scale)
-        zoomed_h = int(self.default_size[1] * self.zoom_scale)
+        zoomed_w, zoomed_h = self._target_size()
         self.geometry(f"{zoomed_w}x{zoomed_h}")
-        self._resize_and_update_image((zoomed_w, zoomed_h))
+        self._show_rendition((zoomed_w, zoomed_h))
         
     def unzoom(self):
         """执行缩小（复原）操作。"""
         self.geometry(f"{self.default_size[0]}x{self.default_size[1]}")
-        self._resize_and_update_image(self.default_size)
+        self._show_rendition(self.default_size)
 
     def update_image(self, image_bytes):
         """
-        公共方法：接收原始图像字节流，解码并更新到窗口中。
-        这应该是从外部（如网络线程）调用的主要方法。
+        在Tk线程中同步解码并显示一帧（未使用解码线程池时，例如本文件的测试代码）。
+
+        Args:
+            image_bytes (bytes): 完整帧或分块差分帧（可带v2帧头），图像编码由数据开头的魔数自动识别。
         """
+        result = self.decode_frames([image_bytes])
+        if result is not None:
+            self.show_image(*result)
+
+    def decode_frames(self, frames):
+        """
+        （解码线程）依次应用一批帧，返回 (缩放到当前显示尺寸的画面, 变化区域)，画面没有变化时返回None。
+
+        最后一个关键帧之前的帧都已过时，只从它开始依次应用差分帧，只在最后缩放一次。
+        变化区域是显示坐标中的矩形列表，None 表示整幅画面都变了。
+        差分帧只变了一部分时，在上一帧的缩放结果上只重新缩放变化区域。
+        """
+        start = 0
+        for i in range(len(frames) - 1, -1, -1):
+            if is_keyframe(frames[i]):
+                start = i
+                break
+
+        with self.image_lock:
+            previous = self._cached_rendition(self._target_size())
+            changed = False
+            self.changed_rects = []
+            for image_bytes in frames[start:]:
+                changed = self._apply_frame(image_bytes) or changed
+            if not changed or self.last_image is None:
+                return None
+            self.frame_version += 1
+            target_size = self._target_size()
+            if self._ensure_resolution(target_size):
+                previous = None  # 以更高分辨率重建了画面，变化区域随之变为整幅
+            dirty = self._display_rects(target_size)
+            return self._rendition(target_size, previous, dirty), dirty
+
+    def _display_rects(self, target_size):
+        """把本批帧的变化区域换算为显示坐标（调用方持有 image_lock）"""
+        rects = self.changed_rects
+        if rects is None or not rects:
+            return None
+        if len(rects) > MAX_DIRTY_RECTS:
+            left = min(x for x, _, _, _ in rects)
+            top = min(y for _, y, _, _ in rects)
+            right = max(x + w for x, _, w, _ in rects)
+            bottom = max(y + h for _, y, _, h in rects)
+            rects = [(left, top, right - left, bottom - top)]
+        target_w, target_h = target_size
+        scale_x = target_w / self.frame_size[0]
+        scale_y = target_h / self.frame_size[1]
+        return [(max(0, int(x * scale_x) - DIRTY_MARGIN),
+                 max(0, int(y * scale_y) - DIRTY_MARGIN),
+                 min(target_w, math.ceil((x + w) * scale_x) + DIRTY_MARGIN),
+                 min(target_h, math.ceil((y + h) * scale_y) + DIRTY_MARGIN))
+                for x, y, w, h in rects]
+
+    def show_image(self, image, dirty=None):
+        """（Tk线程）显示 decode_frames 缩放好的画面，dirty 为变化区域（None 为整幅）"""
+        if image.size != self._target_size():
+            # 解码期间窗口放大或复原了，改为显示新尺寸的版本
+            self._show_rendition(self._target_size())
+        else:
+            self._set_image(image, dirty)
+        if self.show_fps:
+            self._update_fps()
+
+    def _apply_frame(self, image_bytes):
+        """将一帧应用到 last_image（调用方持有 image_lock），返回画面是否发生变化。"""
         try:
-            image_stream = io.BytesIO(image_bytes)
-            self.last_image = Image.open(image_stream)
-            
-            # 根据当前是否缩放来决定显示尺寸
-            if self.is_zoomed:
-                target_size = (int(self.default_size[0] * self.zoom_scale), int(self.default_size[1] * self.zoom_scale))
-            else:
-                target_size = self.default_size
-                
-            self._resize_and_update_image(target_size)
-            
-            # 更新FPS计算
-            if self.show_fps:
-                self._update_fps()
+            header, image_bytes = unpack_frame(image_bytes)
+            if header:
+                last = self.last_frame_header
+                # 关键帧总是接受并重新作为序号基准：对方重启、切换转发等情况下序号会跳变，
+                # 否则之后的帧可能全部被当作过时丢弃
+                if last and not header.flags & FLAG_KEYFRAME and not frame_is_newer(header.frame_id, last.frame_id):
+                    self.stale_frames += 1
+                    return False
+                self.last_frame_header = header
             
+            return self._apply_payload(image_bytes)
         except Exception as e:
             # 在实际应用中，这里可能需要一个更优雅的处理，比如显示一个"信号丢失"的图像
             print(f"更新图像失败: {e}")
             self.last_image = None
+            self.gop = None
+            self.changed_rects = None
+            return False
+
+    def _apply_payload(self, payload):
+        """应用去掉帧头后的完整帧或分块差分帧"""
+        if is_tile_frame(payload):
+            return self._apply_tile_frame(payload)
+        # 解码为可修改的RGB图像，以便后续差分块贴入
+        self.frame_size = image_size(payload)
+        self.decode_scale = self._choose_decode_scale(self.frame_size)
+        self.last_image = decode_image(payload, self.decode_scale)
+        self._start_gop(payload)
+        self.changed_rects = None
+        return True
+    
+    def _apply_tile_frame(self, payload):
+        """将分块差分帧中的变化块贴到上一帧画面上，返回画面是否发生变化。"""
+        width, height, flags, tiles = unpack_tile_frame(payload)
+        if flags & FLAG_KEYFRAME:
+            # 多条带关键帧覆盖整个画面，直接建立新的底图
+            self.frame_size = (width, height)
+            self.decode_scale = self._choose_decode_scale(self.frame_size)
+            self.last_image = Image.new("RGB", reduced_size(self.frame_size, self.decode_scale))
+            self._start_gop(payload)
+            self.changed_rects = None
+        elif self.last_image is None or self.frame_size != (width, height):
+            return False  # 尚未收到匹配的关键帧，等待下一个关键帧
+        else:
+            self._append_gop(payload)
+            if self.changed_rects is not None:
+                self.changed_rects.extend((x, y, w, h) for x, y, w, h, _ in tiles)
+        
+        scale = self.decode_scale
+        for x, y, w, h, data in tiles:
+            if scale == 1:
+                self.last_image.paste(decode_image(data), (x, y))
+                continue
+            # 块的边界（64像素或16像素的倍数）能被缩小倍数整除，缩小后仍能无缝拼接
+            left, top = x // scale, y // scale
+            size = (-(-(x + w) // scale) - left, -(-(y + h) // scale) - top)
+            tile = decode_image(data, scale)
+            if tile.size != size:
+                tile = tile.resize(size, Image.Resampling.BILINEAR)
+            self.last_image.paste(tile, (left, top))
+        return bool(tiles)
+
+    def _choose_decode_scale(self, frame_size):
+        """选择解码缩小倍数：缩小后仍不小于当前显示尺寸的最大倍数，放大时通常回到原尺寸解码"""
+        if not self.reduced_decode:
+            return 1
+        target_w, target_h = self.decode_target or self._target_size()
+        for scale in DECODE_REDUCTIONS:
+            w, h = reduced_size(frame_size, scale)
+            if w >= target_w and h >= target_h:
+                return scale
+        return 1
+
+    def _start_gop(self, payload):
+        self.gop = [payload] if self.reduced_decode else None
+        self.gop_bytes = len(payload)
+
+    def _append_gop(self, payload):
+        if self.gop is None:
+            return
+        self.gop_bytes += len(payload)
+        if self.gop_bytes > GOP_MAX_BYTES:
+            self.gop = None  # 关键帧间隔太长，放弃重建，等下一个关键帧
+        else:
+            self.gop.append(payload)
+
+    def _needs_rebuild(self, target_size):
+        """缩小解码的画面对目标尺寸不够清晰，且能从保存的关键帧重建（调用方持有 image_lock）"""
+        if self.decode_scale == 1 or not self.gop or self.frame_size is None:
+            return False
+        self.decode_target = target_size
+        try:
+            return self._choose_decode_scale(self.frame_size) < self.decode_scale
+        finally:
+            self.decode_target = None
+
+    def _ensure_resolution(self, target_size):
+        """
+        （调用方持有 image_lock）窗口放大后缩小解码的画面不够清晰时，
+        从保存的关键帧开始以新的倍数重新解码；无法重建时暂时放大显示旧画面，直到下一个关键帧。
+
+        Returns:
+            bool: 是否重建了画面。
+        """
+        if not self._needs_rebuild(target_size):
+            return False
+        self.decode_target = target_size
+        try:
+            for payload in self.gop[:]:
+                self._apply_payload(payload)
+        finally:
+            self.decode_target = None
+        # 画面内容不变，但分辨率提高了，之前缓存的缩放结果作废
+        self.frame_version += 1
+        return True
     
     def _update_fps(self):
         """更新FPS显示 - 优化版本减少time.time()调用"""
@@ -143,11 +497,80 @@ class ViewerWindow(tk.Toplevel):
                 self.frame_count = 0
                 self.fps_start_time = current_time
     
+    def mark_static(self):
+        """收到保活消息时调用：对方画面静止，保持当前画面并提示状态。"""
+        if self.decode_pool is not None and not self.renditions_prepared():
+            # 画面静止期间在后台准备好两种尺寸，鼠标悬浮放大时直接显示；
+            # 每个画面版本只准备一次，之后的保活消息不再占用解码线程
+            self.decode_pool.request_prepare(self.peer_addr)
+        if self.show_fps and self.winfo_exists():
+            self.frame_count = 0
+            self.fps_start_time = time.time()
+            self.fps_label.config(text="FPS: 0 (画面静止)")
+    
     def close_window(self):
         """关闭窗口。"""
         self.destroy()
 
 if __name__ == '__main__':
+    import sys
+
+    if sys.argv[1:] == ['bench']:
+        # 基准测试（python viewer_window.py bench）：Tk线程每帧的显示耗时（含重绘）和写入Tk图像的像素数，
+        # 每帧新建 PhotoImage vs 复用 PhotoImage 并只更新变化区域。需要图形界面（或Xvfb）。
+        # 对方画面960x540，每帧4个64x64的块变化（光标、数字跳动一类的局部变化）
+        import numpy as np
+        from frame_protocol import pack_tile_frame
+        from image_codecs import CODECS
+
+        rounds = 60
+        codec = CODECS['jpeg']
+        rng = np.random.default_rng(0)
+        screen = rng.integers(0, 256, (540, 960, 3), dtype=np.uint8)
+        keyframe = bytes(codec.encode(screen, quality=30))
+        deltas = []
+        for i in range(rounds):
+            tiles = []
+            for j in range(4):
+                x, y = 64 * ((i + 3 * j) % 15), 64 * ((i + j) % 8)
+                screen[y:y + 64, x:x + 64] = rng.integers(0, 256, 3, dtype=np.uint8)
+                tiles.append((x, y, 64, 64, bytes(codec.encode(screen[y:y + 64, x:x + 64], quality=30))))
+            deltas.append(pack_tile_frame(960, 540, tiles))
+
+        def legacy_show(viewer, image, dirty):
+            viewer.tk_image = ImageTk.PhotoImage(image)
+            viewer.image_label.config(image=viewer.tk_image)
+            viewer.image_label.image = viewer.tk_image
+
+        root = tk.Tk()
+        root.withdraw()
+        for count in (1, 4, 16):
+            for name, show in (("每帧新建PhotoImage", legacy_show), ("复用并局部更新", ViewerWindow.show_image)):
+                viewers = [ViewerWindow(root, ('127.0.0.1', i), show_fps=False) for i in range(count)]
+                for viewer in viewers:
+                    show(viewer, *viewer.decode_frames([keyframe]))
+                root.update()
+                elapsed = 0
+                pixels = 0
+                for delta in deltas:
+                    results = [viewer.decode_frames([delta]) for viewer in viewers]
+                    for image, dirty in results:
+                        if dirty is None or show is legacy_show:
+                            pixels += image.width * image.height
+                        else:
+                            pixels += sum((right - left) * (bottom - top) for left, top, right, bottom in dirty)
+                    start_time = time.perf_counter()
+                    for viewer, (image, dirty) in zip(viewers, results):
+                        show(viewer, image, dirty)
+                    root.update()
+                    elapsed += time.perf_counter() - start_time
+                print(f"[{count:>2} 个窗口 | {name:>12}] Tk线程每帧耗时: {elapsed / rounds * 1000:6.2f} ms, "
+                      f"每帧写入Tk: {pixels / rounds / 1000:7.1f} K像素")
+                for viewer in viewers:
+                    viewer.destroy()
+        root.destroy()
+        sys.exit()
+
     # --- 测试代码 ---
     # 直接运行此文件可以测试窗口的拖动、缩放等交互功能。
     